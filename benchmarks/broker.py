@@ -0,0 +1,172 @@
+"""Minimal MQTT 3.1.1 broker for the load tests.
+
+Only QoS 0 delivery is supported (QoS 1 publishes are acknowledged and delivered with QoS 0),
+without retained messages, wills nor persistent sessions.
+"""
+
+import socket
+import socketserver
+import struct
+import threading
+
+from paho.mqtt.client import topic_matches_sub
+
+CONNECT = 1
+PUBLISH = 3
+SUBSCRIBE = 8
+UNSUBSCRIBE = 10
+PINGREQ = 12
+DISCONNECT = 14
+
+
+def _encode_length(length):
+    encoded = bytearray()
+    while True:
+        byte, length = length % 128, length // 128
+        encoded.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(encoded)
+
+
+def _read_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("connection closed")
+        data += chunk
+    return bytes(data)
+
+
+def _read_packet(sock):
+    header = _read_exactly(sock, 1)[0]
+    length, multiplier = 0, 1
+    while True:
+        byte = _read_exactly(sock, 1)[0]
+        length += (byte & 0x7F) * multiplier
+        multiplier *= 128
+        if not byte & 0x80:
+            break
+    return header >> 4, header & 0x0F, _read_exactly(sock, length)
+
+
+def _read_string(data, offset):
+    (length,) = struct.unpack_from("!H", data, offset)
+    end = offset + 2 + length
+    return data[offset + 2 : end].decode("utf-8"), end
+
+
+class _Session:
+    def __init__(self, sock):
+        self.sock = sock
+        self.filters = set()
+        self.send_lock = threading.Lock()
+
+    def send(self, packet):
+        with self.send_lock:
+            self.sock.sendall(packet)
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        broker = self.server.broker
+        session = _Session(self.request)
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        broker.add_session(session)
+        try:
+            while True:
+                packet_type, flags, body = _read_packet(self.request)
+                if packet_type == CONNECT:
+                    session.send(b"\x20\x02\x00\x00")
+                elif packet_type == PUBLISH:
+                    self._publish(broker, session, flags, body)
+                elif packet_type == SUBSCRIBE:
+                    self._subscribe(session, body)
+                elif packet_type == UNSUBSCRIBE:
+                    offset = 2
+                    while offset < len(body):
+                        topic_filter, offset = _read_string(body, offset)
+                        session.filters.discard(topic_filter)
+                    session.send(b"\xb0\x02" + body[:2])
+                elif packet_type == PINGREQ:
+                    session.send(b"\xd0\x00")
+                elif packet_type == DISCONNECT:
+                    return
+        except (ConnectionError, OSError):
+            return
+        finally:
+            broker.remove_session(session)
+
+    @staticmethod
+    def _publish(broker, session, flags, body):
+        topic, offset = _read_string(body, 0)
+        if (flags >> 1) & 0x03:
+            # QoS 1 (or 2, handled as 1): acknowledged, then delivered with QoS 0
+            session.send(b"\x40\x02" + body[offset : offset + 2])
+            offset += 2
+        broker.deliver(topic, body[offset:])
+
+    @staticmethod
+    def _subscribe(session, body):
+        granted = bytearray()
+        offset = 2
+        while offset < len(body):
+            topic_filter, offset = _read_string(body, offset)
+            offset += 1
+            session.filters.add(topic_filter)
+            granted.append(0)
+        session.send(b"\x90" + _encode_length(2 + len(granted)) + body[:2] + bytes(granted))
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class MiniBroker:
+    """MQTT broker running in a thread, listening on `port` (a free port by default)."""
+
+    def __init__(self, host="127.0.0.1", port=0):
+        self._server = _Server((host, port), _Handler)
+        self._server.broker = self
+        self._sessions = set()
+        self._lock = threading.Lock()
+        self.delivered = 0
+
+    @property
+    def port(self):
+        """Port the broker is listening on."""
+        return self._server.server_address[1]
+
+    def start(self):
+        """Start serving in a daemon thread."""
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        """Stop serving."""
+        self._server.shutdown()
+        self._server.server_close()
+
+    def add_session(self, session):
+        with self._lock:
+            self._sessions.add(session)
+
+    def remove_session(self, session):
+        with self._lock:
+            self._sessions.discard(session)
+
+    def deliver(self, topic, payload):
+        """Send a message to the sessions subscribed to its topic."""
+        encoded_topic = topic.encode("utf-8")
+        body = struct.pack("!H", len(encoded_topic)) + encoded_topic + payload
+        packet = b"\x30" + _encode_length(len(body)) + body
+        with self._lock:
+            sessions = list(self._sessions)
+        for session in sessions:
+            if any(topic_matches_sub(sub, topic) for sub in tuple(session.filters)):
+                try:
+                    session.send(packet)
+                    self.delivered += 1
+                except OSError:
+                    self.remove_session(session)
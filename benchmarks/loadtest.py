@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+"""End-to-end load test: publisher -> MQTT broker -> exporter -> concurrent scrapers.
+
+The exporter runs in a subprocess (`run()`, the real paho network path) against a local
+mosquitto if requested and available, or the embedded minimal broker. Messages are published
+at increasing rates, and each step reports:
+- the publish rate achieved, and the rate of messages counted by the exporter
+- dropped messages: published but not counted by the exporter once the step is over
+- the latency from publish to visibility on /metrics, and the messages visible too late
+- the scrape duration
+
+Usage: python benchmarks/loadtest.py --rates 500,1000,2000 --duration 5 --mix zigbee
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+from collections import deque
+from pathlib import Path
+
+import paho.mqtt.client as mqtt
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from broker import MiniBroker
+
+ROOT = Path(__file__).resolve().parent.parent
+TOPIC_PREFIX = "loadtest"
+SEQ_SAMPLE_RE = re.compile(rb'^mqtt_seq\{topic="loadtest_(device_\d+)"\} (\S+)$', re.MULTILINE)
+MESSAGE_TOTAL_RE = re.compile(rb'^mqtt_message_total\{topic="loadtest_device_\d+"\} (\S+)$', re.M)
+
+
+def _payload_small(seq):
+    return {"seq": seq, "temperature": 21.5}
+
+
+def _payload_zigbee(seq):
+    return {
+        "seq": seq,
+        "temperature": round(random.uniform(15, 25), 2),
+        "humidity": round(random.uniform(30, 60), 1),
+        "battery": 97,
+        "linkquality": random.randint(0, 255),
+        "voltage": 3025,
+        "update": {"state": "idle", "installed_version": 268513281},
+        "state": "ON",
+    }
+
+
+def _payload_large(seq):
+    return {"seq": seq, "cells": [round(random.uniform(3.1, 3.4), 3) for _ in range(200)]}
+
+
+MIXES = {
+    "small": [(_payload_small, 1)],
+    "zigbee": [(_payload_zigbee, 1)],
+    "large": [(_payload_large, 1)],
+    "mixed": [(_payload_small, 6), (_payload_zigbee, 3), (_payload_large, 1)],
+}
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _start_broker(use_mosquitto):
+    """Start mosquitto if requested and installed, else the embedded broker."""
+    mosquitto = shutil.which("mosquitto") if use_mosquitto else None
+    if mosquitto is None:
+        broker = MiniBroker().start()
+        return "embedded", broker.port, broker.stop
+
+    port = _free_port()
+    process = subprocess.Popen([mosquitto, "-p", str(port)], stderr=subprocess.DEVNULL)
+    time.sleep(0.5)
+    return "mosquitto", port, process.terminate
+
+
+def _start_exporter(mqtt_port, prometheus_port, extra_env):
+    env = dict(
+        os.environ,
+        MQTT_ADDRESS="127.0.0.1",
+        MQTT_PORT=str(mqtt_port),
+        MQTT_TOPIC=f"{TOPIC_PREFIX}/#",
+        PROMETHEUS_ADDRESS="127.0.0.1",
+        PROMETHEUS_PORT=str(prometheus_port),
+        MAX_METRICS="0",
+        LOG_LEVEL="WARNING",
+        **extra_env,
+    )
+    process = subprocess.Popen([sys.executable, str(ROOT / "exporter.py")], env=env, cwd=ROOT)
+    url = f"http://127.0.0.1:{prometheus_port}/metrics"
+    for _ in range(100):
+        try:
+            urllib.request.urlopen(url, timeout=1).read()
+            return process, url
+        except OSError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("exporter did not start")
+
+
+class Tracker:
+    """Publish times of the messages of each topic, until they are visible on /metrics."""
+
+    def __init__(self):
+        self.pending = {}
+        self.latencies = []
+        self.lock = threading.Lock()
+
+    def published(self, device, seq, now):
+        with self.lock:
+            self.pending.setdefault(device, deque()).append((seq, now))
+
+    def visible(self, device, seq, now):
+        """A scrape shows `seq`: it and the previous messages of the topic are visible."""
+        with self.lock:
+            pending = self.pending.get(device)
+            while pending and pending[0][0] <= seq:
+                self.latencies.append(now - pending.popleft()[1])
+
+    def reset(self):
+        with self.lock:
+            not_visible = sum(len(pending) for pending in self.pending.values())
+            latencies, self.latencies = self.latencies, []
+            self.pending = {}
+        return latencies, not_visible
+
+
+class Scraper(threading.Thread):
+    """Scrape /metrics continuously, reporting the visible sequence numbers."""
+
+    def __init__(self, url, tracker):
+        super().__init__(daemon=True)
+        self.url = url
+        self.tracker = tracker
+        self.durations = []
+        self.errors = 0
+        self.running = True
+
+    def run(self):
+        while self.running:
+            start = time.perf_counter()
+            try:
+                body = urllib.request.urlopen(self.url, timeout=10).read()
+            except OSError:
+                self.errors += 1
+                continue
+            now = time.perf_counter()
+            self.durations.append(now - start)
+            for device, value in SEQ_SAMPLE_RE.findall(body):
+                self.tracker.visible(device.decode(), int(float(value)), now)
+
+
+def _received_messages(url):
+    body = urllib.request.urlopen(url, timeout=10).read()
+    return sum(float(value) for value in MESSAGE_TOTAL_RE.findall(body))
+
+
+def _percentile(values, percent):
+    if not values:
+        return float("nan")
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[percent - 1]
+
+
+def _publish_step(client, tracker, rate, duration, topics, mix, seq):
+    """Publish at `rate` messages per second during `duration` seconds, return the count."""
+    payload_types = [payload for payload, _ in mix]
+    weights = [weight for _, weight in mix]
+    count = int(rate * duration)
+    start = time.perf_counter()
+    for i in range(count):
+        # pace the messages, without sleeping for each message at high rates
+        delay = start + i / rate - time.perf_counter()
+        if delay > 0.001:
+            time.sleep(delay)
+        seq += 1
+        device = f"device_{i % topics}"
+        payload = json.dumps(random.choices(payload_types, weights)[0](seq))
+        tracker.published(device, seq, time.perf_counter())
+        client.publish(f"{TOPIC_PREFIX}/{device}", payload)
+    return count, time.perf_counter() - start, seq
+
+
+def main():
+    """Run the load test and print the report."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", 1)[0])
+    parser.add_argument("--rates", default="200,500,1000,2000,5000", help="messages per second")
+    parser.add_argument("--duration", type=float, default=5, help="seconds per rate step")
+    parser.add_argument("--topics", type=int, default=100, help="number of device topics")
+    parser.add_argument("--mix", choices=sorted(MIXES), default="zigbee", help="payloads mix")
+    parser.add_argument("--scrapers", type=int, default=2, help="concurrent scrapers")
+    parser.add_argument("--late", type=float, default=1.0, help="late visibility (seconds)")
+    parser.add_argument("--settle", type=float, default=2.0, help="wait after each step")
+    parser.add_argument("--mosquitto", action="store_true", help="use a local mosquitto")
+    parser.add_argument(
+        "--env", action="append", default=[], help="exporter setting, e.g. DEDUP_CACHE_SIZE=1000"
+    )
+    args = parser.parse_args()
+    extra_env = dict(setting.split("=", 1) for setting in args.env)
+
+    broker_name, mqtt_port, stop_broker = _start_broker(args.mosquitto)
+    exporter, url = _start_exporter(mqtt_port, _free_port(), extra_env)
+    tracker = Tracker()
+    scrapers = [Scraper(url, tracker) for _ in range(args.scrapers)]
+    client = mqtt.Client(callback_api_version=mqtt.CallbackAPIVersion.VERSION2)
+    client.connect("127.0.0.1", mqtt_port)
+    client.loop_start()
+    # let the exporter subscribe
+    time.sleep(1)
+    for scraper in scrapers:
+        scraper.start()
+
+    print(
+        f"broker: {broker_name}, mix: {args.mix}, topics: {args.topics}, scrapers: {args.scrapers}"
+    )
+    print(
+        f"{'target/s':>9} {'sent/s':>8} {'recv/s':>8} {'dropped':>8} {'vis p50':>8} "
+        f"{'vis p99':>8} {'late':>6} {'scrape p50':>11} {'scrape p99':>11}"
+    )
+    saturation = None
+    seq = 0
+    try:
+        for rate in [int(rate) for rate in args.rates.split(",")]:
+            received_before = _received_messages(url)
+            for scraper in scrapers:
+                scraper.durations = []
+            sent, elapsed, seq = _publish_step(
+                client, tracker, rate, args.duration, args.topics, MIXES[args.mix], seq
+            )
+            time.sleep(args.settle)
+            received = _received_messages(url) - received_before
+            latencies, not_visible = tracker.reset()
+            durations = [duration for scraper in scrapers for duration in scraper.durations]
+
+            dropped = max(0, sent - received)
+            late = not_visible + sum(latency > args.late for latency in latencies)
+            print(
+                f"{rate:>9} {sent / elapsed:>8.0f} {received / elapsed:>8.0f} "
+                f"{dropped:>8.0f} {_percentile(latencies, 50) * 1000:>6.0f}ms "
+                f"{_percentile(latencies, 99) * 1000:>6.0f}ms {late / sent:>6.1%} "
+                f"{_percentile(durations, 50) * 1000:>9.1f}ms {_percentile(durations, 99) * 1000:>9.1f}ms"
+            )
+            if saturation is None and (dropped > sent * 0.01 or late > sent * 0.01):
+                saturation = rate
+    finally:
+        for scraper in scrapers:
+            scraper.running = False
+        client.loop_stop()
+        client.disconnect()
+        exporter.terminate()
+        exporter.wait()
+        stop_broker()
+
+    if saturation is None:
+        print("saturation point: not reached")
+    else:
+        print(f"saturation point: {saturation} messages/s (>1% dropped or late messages)")
+
+
+if __name__ == "__main__":
+    main()
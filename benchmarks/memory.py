@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""Memory used per series exposed by the exporter.
+
+Usage: python benchmarks/memory.py [number of series ...]
+"""
+
+import gc
+import json
+import logging
+import sys
+import tracemalloc
+from pathlib import Path
+from types import SimpleNamespace
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import prometheus_client  # noqa: E402
+
+from mqtt_exporter import main  # noqa: E402
+from mqtt_exporter.brokers import BrokerConfig  # noqa: E402
+from mqtt_exporter.main import MessagePipeline, PipelineConfig  # noqa: E402
+
+# series per device
+FIELDS = ("temperature", "humidity", "battery", "linkquality")
+DEFAULT_SERIES = (10_000, 100_000)
+
+
+def _reset():
+    # pylama: ignore=W0212
+    for collector in list(prometheus_client.REGISTRY._collector_to_names):
+        prometheus_client.REGISTRY.unregister(collector)
+    main.prom_metrics = {}
+    main.metric_refs.clear()
+    main.ts_metric_ids.clear()
+    main._create_msg_counter_metrics()
+
+
+def _messages(series):
+    payload = json.dumps(dict.fromkeys(FIELDS, 21.5)).encode()
+    for device in range(series // len(FIELDS)):
+        # topics built for each message, like the ones decoded by paho
+        yield SimpleNamespace(
+            topic=f"zigbee2mqtt/room_{device % 100}/device_{device}",
+            payload=payload,
+            properties=None,
+        )
+
+
+def measure(series, messages_per_device=2):
+    """Return the memory in bytes used by `series` series."""
+    _reset()
+    pipeline = MessagePipeline(PipelineConfig(max_metrics=0))
+    userdata = {"client_id": "", "broker": BrokerConfig()}
+
+    gc.collect()
+    tracemalloc.start()
+    for _ in range(messages_per_device):
+        for msg in _messages(series):
+            pipeline.on_message(None, userdata, msg)
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return size
+
+
+def main_benchmark(sizes):
+    """Print the memory used per series for each number of series."""
+    logging.disable(logging.INFO)
+    print(f"{'series':>10} {'MiB':>8} {'bytes/series':>13}")
+    for series in sizes:
+        size = measure(series)
+        print(f"{series:>10} {size / 2**20:>8.1f} {size / series:>13.0f}")
+
+
+if __name__ == "__main__":
+    main_benchmark([int(arg) for arg in sys.argv[1:]] or DEFAULT_SERIES)
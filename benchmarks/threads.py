@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""Message throughput of the exporter for several numbers of ingestion threads.
+
+On the standard CPython build, the GIL runs one thread at a time: the throughput should not
+drop with more threads. On free-threaded builds (python3.13t...), it should scale with them.
+
+Usage: python benchmarks/threads.py [number of threads ...]
+"""
+
+import json
+import logging
+import sys
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import prometheus_client
+
+from mqtt_exporter import main
+from mqtt_exporter.brokers import BrokerConfig
+from mqtt_exporter.ingest import IngestWorkers
+from mqtt_exporter.main import PipelineConfig
+
+DEVICES = 2000
+MESSAGES = 200_000
+DEFAULT_THREADS = (0, 1, 2, 4, 8)
+
+
+def _reset():
+    # pylama: ignore=W0212
+    for collector in list(prometheus_client.REGISTRY._collector_to_names):
+        prometheus_client.REGISTRY.unregister(collector)
+    main.prom_metrics = {}
+    main.metric_refs.clear()
+    main.ts_metric_ids.clear()
+    main._create_msg_counter_metrics()
+
+
+def _messages():
+    messages = []
+    for i in range(MESSAGES):
+        payload = {
+            "temperature": 20 + i % 50 / 10,
+            "humidity": 40 + i % 30,
+            "battery": 100 - i % 100,
+            "linkquality": i % 255,
+            "state": "ON" if i % 2 else "OFF",
+        }
+        messages.append(
+            SimpleNamespace(
+                topic=f"zigbee2mqtt/device_{i % DEVICES}",
+                payload=json.dumps(payload).encode(),
+                properties=None,
+            )
+        )
+    return messages
+
+
+def measure(threads, messages):
+    """Return the messages processed per second by `threads` threads (0: caller thread)."""
+    _reset()
+    main.build_pipeline(PipelineConfig.from_settings(max_metrics=0, ingest_threads=threads))
+    userdata = {"client_id": "", "broker": BrokerConfig()}
+    workers = IngestWorkers(threads, main._process_message).start() if threads else None
+
+    start = time.perf_counter()
+    for msg in messages:
+        if workers is None:
+            main._process_message(None, userdata, msg)
+        else:
+            workers.submit(msg.topic, None, userdata, msg)
+    if workers is not None:
+        workers.stop()
+    return len(messages) / (time.perf_counter() - start)
+
+
+def main_benchmark(thread_counts):
+    """Print the throughput for each number of threads."""
+    logging.disable(logging.INFO)
+    gil = getattr(sys, "_is_gil_enabled", lambda: True)()
+    print(f"Python {sys.version.split()[0]}, GIL {'enabled' if gil else 'disabled'}")
+    messages = _messages()
+    print(f"{'threads':>8} {'messages/s':>11} {'speedup':>8}")
+    baseline = None
+    for threads in thread_counts:
+        rate = measure(threads, messages)
+        baseline = baseline or rate
+        print(f"{threads:>8} {rate:>11.0f} {rate / baseline:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main_benchmark([int(arg) for arg in sys.argv[1:]] or DEFAULT_THREADS)
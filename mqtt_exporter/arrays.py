@@ -0,0 +1,92 @@
+"""Numeric arrays of the payloads, converted in one pass instead of one metric per element."""
+
+import array
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# one metric, with the position of each value as label
+INDEX = "index"
+# min, max, mean and sum of the values
+STATS = "stats"
+
+INDEX_LABEL = "index"
+
+
+class ArrayValues(tuple):
+    """Values of a numeric array, exposed as one series per index."""
+
+    __slots__ = ()
+
+
+def parse_array_modes(value):
+    """Parse the array modes per topic pattern: "pattern1=index;pattern2=stats"."""
+    modes = []
+    for definition in value.split(";"):
+        if not definition.strip():
+            continue
+        pattern, sep, mode = definition.rpartition("=")
+        mode = mode.strip()
+        if not sep or not pattern.strip() or mode not in (INDEX, STATS):
+            raise ValueError(f"invalid array mode definition: {definition}")
+        modes.append((pattern.strip(), mode))
+
+    return tuple(modes)
+
+
+if numpy is not None:
+
+    def to_numbers(values):
+        """Convert a list to an array of floats, None if it is not a flat list of numbers."""
+        try:
+            numbers = numpy.asarray(values)
+        except (ValueError, TypeError, OverflowError):
+            return None
+        # strings, None or nested lists are handled element by element
+        if numbers.ndim != 1 or numbers.dtype.kind not in "biuf":
+            return None
+        return numbers.astype(float)
+
+    def summarize(numbers):
+        """Min, max, mean and sum of a non empty array of floats."""
+        return (
+            ("min", float(numbers.min())),
+            ("max", float(numbers.max())),
+            ("mean", float(numbers.mean())),
+            ("sum", float(numbers.sum())),
+        )
+
+else:
+
+    def to_numbers(values):
+        """Convert a list to an array of floats, None if it is not a flat list of numbers."""
+        try:
+            return array.array("d", values)
+        except (TypeError, OverflowError):
+            return None
+
+    def summarize(numbers):
+        """Min, max, mean and sum of a non empty array of floats."""
+        total = math.fsum(numbers)
+        return (
+            ("min", min(numbers)),
+            ("max", max(numbers)),
+            ("mean", total / len(numbers)),
+            ("sum", total),
+        )
+
+
+def array_samples(prefix, metric, numbers, mode):
+    """Yield the samples (prefix, field, value) of an array of floats."""
+    if not len(numbers):
+        return
+
+    if mode == INDEX:
+        yield prefix, metric, ArrayValues(numbers.tolist())
+        return
+
+    for statistic, value in summarize(numbers):
+        yield f"{prefix}{metric}_", statistic, value
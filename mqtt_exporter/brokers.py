@@ -0,0 +1,106 @@
+"""MQTT brokers definition."""
+
+import json
+from dataclasses import dataclass, fields
+
+from mqtt_exporter import settings
+
+
+@dataclass(frozen=True)
+class BrokerConfig:
+    """Connection settings of one MQTT broker.
+
+    `topic` is None when the broker uses MQTT_TOPIC, which can then be changed at runtime.
+    With `persistent_session`, the broker keeps the session of `client_id` for
+    `session_expiry` seconds (MQTTv5), and queues the QoS 1 messages while disconnected.
+    """
+
+    name: str = ""
+    address: str = "127.0.0.1"
+    port: int = 1883
+    keepalive: int = 60
+    topic: str | None = None
+    username: str | None = None
+    password: str | None = None
+    client_id: str = ""
+    v5_protocol: bool = False
+    enable_tls: bool = False
+    tls_no_verify: bool = False
+    tls_ca_cert: str | None = None
+    tls_client_cert: str | None = None
+    tls_client_key: str | None = None
+    persistent_session: bool = False
+    session_expiry: int = 3600
+
+    def __post_init__(self):
+        if self.persistent_session and not self.client_id:
+            raise ValueError("a persistent session requires a client id")
+
+    @property
+    def qos(self):
+        """QoS of the subscriptions, messages are only queued for a session with QoS 1."""
+        return 1 if self.persistent_session else 0
+
+    @property
+    def topics(self):
+        """Topics to subscribe to."""
+        return (self.topic if self.topic is not None else settings.TOPIC).split(",")
+
+    @classmethod
+    def from_settings(cls, **overrides):
+        """Create the broker configuration from the MQTT_* settings, with optional overrides."""
+        config = {
+            "address": settings.MQTT_ADDRESS,
+            "port": settings.MQTT_PORT,
+            "keepalive": settings.MQTT_KEEPALIVE,
+            "username": settings.MQTT_USERNAME,
+            "password": settings.MQTT_PASSWORD,
+            "client_id": settings.MQTT_CLIENT_ID,
+            "v5_protocol": settings.MQTT_V5_PROTOCOL,
+            "enable_tls": settings.MQTT_ENABLE_TLS,
+            "tls_no_verify": settings.MQTT_TLS_NO_VERIFY,
+            "tls_ca_cert": settings.MQTT_TLS_CA_CERT,
+            "tls_client_cert": settings.MQTT_TLS_CLIENT_CERT,
+            "tls_client_key": settings.MQTT_TLS_CLIENT_KEY,
+            "persistent_session": settings.MQTT_PERSISTENT_SESSION,
+            "session_expiry": settings.MQTT_SESSION_EXPIRY,
+        }
+        config.update(overrides)
+        return cls(**config)
+
+
+def load_brokers(path):
+    """Load the brokers from a JSON file containing a list of broker definitions.
+
+    Each definition uses the `BrokerConfig` field names, and must have a unique `name`.
+    Missing fields are taken from the MQTT_* settings. `password_file` can be used
+    instead of `password`.
+    """
+    with open(path, "r") as f:
+        definitions = json.load(f)
+
+    known_fields = {field.name for field in fields(BrokerConfig)}
+    brokers = []
+    for raw_definition in definitions:
+        definition = dict(raw_definition)
+        if not definition.get("name"):
+            raise ValueError(f"missing broker name in {path}: {definition}")
+
+        password_file = definition.pop("password_file", None)
+        if password_file:
+            if definition.get("password"):
+                raise ValueError("password_file is mutually exclusive with password")
+            with open(password_file, "r") as f:
+                definition["password"] = f.read()
+
+        unknown = definition.keys() - known_fields
+        if unknown:
+            raise ValueError(f"unknown broker settings in {path}: {', '.join(sorted(unknown))}")
+
+        brokers.append(BrokerConfig.from_settings(**definition))
+
+    names = [broker.name for broker in brokers]
+    if len(set(names)) != len(names):
+        raise ValueError(f"broker names must be unique in {path}")
+
+    return brokers
@@ -0,0 +1,76 @@
+"""Bounded caches used on the message hot path."""
+
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """Dict-like cache keeping at most `maxsize` entries, evicting the least recently used."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        # configured size, restored after the cache was shrunk
+        self.capacity = maxsize
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        """Return the cached value and mark it as recently used."""
+        try:
+            self._data.move_to_end(key)
+            return self._data[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def pop(self, key, default=None):
+        """Remove an entry and return its value."""
+        return self._data.pop(key, default)
+
+    def clear(self):
+        """Remove all entries."""
+        self._data.clear()
+
+    def resize(self, maxsize):
+        """Change the maximum number of entries, evicting the least recently used ones."""
+        self.maxsize = maxsize
+        while len(self._data) > maxsize:
+            self._data.popitem(last=False)
+
+
+class LockedLRUCache(LRUCache):
+    """LRUCache which can be shared by threads processing messages concurrently."""
+
+    def __init__(self, maxsize):
+        super().__init__(maxsize)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            return super().get(key, default)
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            super().__setitem__(key, value)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return super().pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            super().clear()
+
+    def resize(self, maxsize):
+        with self._lock:
+            super().resize(maxsize)
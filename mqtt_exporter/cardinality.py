@@ -0,0 +1,143 @@
+"""Estimation and limitation of the number of distinct label values."""
+
+import math
+import threading
+
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+_HASH_MASK = (1 << 64) - 1
+
+DROP = "drop"
+BUCKET = "bucket"
+# label value replacing the values over the limit with the bucket action
+OVERFLOW_VALUE = "other"
+
+
+def parse_limits(value):
+    """Parse the limits per label: "label1=limit1,label2=limit2"."""
+    limits = {}
+    for definition in value.split(","):
+        if not definition.strip():
+            continue
+        label, sep, limit = definition.partition("=")
+        if not sep:
+            raise ValueError(f"invalid label limit definition: {definition}")
+        limits[label.strip()] = int(limit)
+
+    return limits
+
+
+class HyperLogLog:
+    """Estimate the number of distinct strings added, in 2^precision bytes.
+
+    The standard error is about 1.04 / sqrt(2^precision), i.e. 3% with the default precision.
+    """
+
+    __slots__ = ("precision", "_registers")
+
+    def __init__(self, precision=10):
+        self.precision = precision
+        self._registers = bytearray(1 << precision)
+
+    def add(self, value):
+        """Add a string to the estimated set."""
+        hashed = hash(value) & _HASH_MASK
+        index = hashed >> (64 - self.precision)
+        remaining = (hashed << self.precision) & _HASH_MASK
+        # position of the leftmost 1 in the bits not used by the index
+        rank = min(65 - remaining.bit_length(), 65 - self.precision)
+        self._registers[index] = max(self._registers[index], rank)
+
+    def estimate(self):
+        """Estimated number of distinct strings added."""
+        registers = self._registers
+        m = len(registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw = alpha * m * m / sum(2.0**-register for register in registers)
+        zeros = registers.count(0)
+        if raw <= 2.5 * m and zeros:
+            # small range correction (linear counting)
+            return m * math.log(m / zeros)
+        return raw
+
+
+class _LabelState:
+    __slots__ = ("estimator", "allowed", "limited")
+
+    def __init__(self):
+        self.estimator = HyperLogLog()
+        self.allowed = set()
+        self.limited = 0
+
+
+class LabelCardinality:
+    """Distinct values estimation per metric and label, with a limit of values per label.
+
+    Up to `limit` values of a label are accepted for each metric, the next ones are dropped
+    (empty value, i.e. no label for Prometheus) or bucketed in one `other` value. Exposes the
+    estimated number of distinct values, including the rejected ones (collector).
+    """
+
+    def __init__(self, default_limit=0, limits=None, action=DROP, prefix="mqtt_"):
+        if action not in (DROP, BUCKET):
+            raise ValueError(f"invalid label cardinality action: {action}")
+        self.default_limit = default_limit
+        self.limits = limits or {}
+        self.replacement = "" if action == DROP else OVERFLOW_VALUE
+        self.prefix = prefix
+        self._states = {}
+        # messages of several brokers are processed concurrently
+        self._lock = threading.Lock()
+
+    @property
+    def states(self):
+        """Number of (metric, label) tracked, each with its estimator."""
+        return len(self._states)
+
+    def check(self, metric_name, labels):
+        """Return the labels of a sample, with the values over the limits replaced."""
+        replaced = None
+        with self._lock:
+            for label, value in labels.items():
+                state = self._states.get((metric_name, label))
+                if state is None:
+                    state = self._states[(metric_name, label)] = _LabelState()
+                state.estimator.add(value)
+                limit = self.limits.get(label, self.default_limit)
+                if not limit or value in state.allowed:
+                    continue
+                if len(state.allowed) < limit:
+                    state.allowed.add(value)
+                    continue
+
+                state.limited += 1
+                if replaced is None:
+                    replaced = dict(labels)
+                replaced[label] = self.replacement
+
+        return labels if replaced is None else replaced
+
+    def estimates(self):
+        """Estimated distinct values and number of limited samples, per (metric, label)."""
+        with self._lock:
+            return {
+                key: (state.estimator.estimate(), state.limited)
+                for key, state in self._states.items()
+            }
+
+    def collect(self):
+        estimates = GaugeMetricFamily(
+            f"{self.prefix}label_cardinality_estimate",
+            "Estimated number of distinct values of a label",
+            labels=["metric", "label"],
+        )
+        limited = CounterMetricFamily(
+            f"{self.prefix}label_values_limited",
+            "Samples having a label value over the cardinality limit",
+            labels=["metric", "label"],
+        )
+        for (metric_name, label), (estimate, limited_count) in self.estimates().items():
+            estimates.add_metric([metric_name, label], round(estimate))
+            limited.add_metric([metric_name, label], limited_count)
+        yield estimates
+        yield limited
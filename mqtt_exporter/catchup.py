@@ -0,0 +1,97 @@
+"""Catch-up of the messages queued by the broker while the exporter was disconnected."""
+
+import logging
+import threading
+
+LOG = logging.getLogger("mqtt-exporter")
+
+# consecutive checks without bytes waiting in the socket before the catch-up ends
+QUIET_CHECKS = 3
+
+
+class CatchUp:
+    """Coalesce the backlog of a persistent session, then process it with `process(*message)`.
+
+    When the exporter reconnects to an existing session, the broker first sends the messages
+    published while it was disconnected. From `start()`, `add()` only keeps the latest message
+    of each topic instead of processing it: the intermediate values are superseded anyway. The
+    catch-up ends when no bytes are waiting in the socket (`backlog()`) for QUIET_CHECKS checks,
+    or after `max_duration` seconds. The latest message of each topic is then processed, before
+    the messages received next (the messages received meanwhile are kept until it is processed).
+    """
+
+    def __init__(self, process, backlog, max_duration=60.0):
+        self.process = process
+        self.backlog = backlog
+        self.max_duration = max_duration
+        self.active = False
+        # messages received during the current or last catch-up
+        self.messages = 0
+        # duration of the last catch-up
+        self.duration = 0.0
+        self._started = 0.0
+        self._quiet = 0
+        # topic: latest message
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    @property
+    def pending(self):
+        """Number of topics whose latest message is waiting to be processed."""
+        return len(self._pending)
+
+    def start(self, now):
+        """Start coalescing the messages, on reconnection to an existing session."""
+        with self._lock:
+            if self.active:
+                return
+            LOG.info("catching up with the messages queued by the broker")
+            self.active = True
+            self.messages = 0
+            self._started = now
+            self._quiet = 0
+
+    def add(self, topic, message):
+        """Return True if the message is kept to be processed at the end of the catch-up."""
+        if not self.active:
+            return False
+
+        with self._lock:
+            # the catch-up ended in the meantime
+            if not self.active:
+                return False
+            self.messages += 1
+            self._pending[topic] = message
+            return True
+
+    def check(self, now):
+        """End the catch-up once the backlog is drained, processing the coalesced messages."""
+        if not self.active:
+            return
+
+        self._quiet = 0 if self.backlog() else self._quiet + 1
+        if self._quiet < QUIET_CHECKS and now - self._started < self.max_duration:
+            return
+
+        # the messages received while draining are kept, and processed after the older ones
+        self.duration = now - self._started
+        topics = 0
+        while True:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                if not pending:
+                    self.active = False
+                    break
+            topics += len(pending)
+            for message in pending.values():
+                try:
+                    self.process(*message)
+                except Exception:
+                    LOG.exception("failed to process message")
+
+        LOG.info(
+            "caught up with %d messages of %d topics in %.1fs",
+            self.messages,
+            topics,
+            self.duration,
+        )
@@ -0,0 +1,125 @@
+"""Detection of the cumulative fields, exposed as counters."""
+
+import threading
+
+from prometheus_client import Counter
+from prometheus_client.samples import Sample
+
+from mqtt_exporter.matcher import TopicMatcher
+
+
+class ValueCounter(Counter):
+    """Counter of the values published by the devices, exposed without `_created` series.
+
+    The creation time of the series is meaningless for these values, and would double the
+    number of series (the sharded endpoints do not expose it either).
+    """
+
+    def _child_samples(self):
+        return (Sample("_total", {}, self._value.get(), None, None),)
+
+
+class CounterDetector:
+    """Decide which metrics are counters, and keep their series monotonic across device resets.
+
+    Metrics matching one of `patterns` (shell-style wildcards on the metric name) are counters
+    from the start. With `learning_samples`, the other metrics are observed: a metric whose
+    values never decreased during its first `learning_samples` samples, and increased at least
+    once, is a counter; `on_learned(prom_metric_id)` then replaces its gauge by a counter, and
+    returns it.
+
+    When the value of a counter series decreases, the device was reset: the last exposed value
+    becomes the offset added to the next values. Only the series which were reset have a state.
+    """
+
+    def __init__(self, patterns=(), learning_samples=0, on_learned=None):
+        self.matcher = TopicMatcher(patterns, cache_size=0) if patterns else None
+        self.learning_samples = learning_samples
+        self.on_learned = on_learned
+        # metric ids exposed as counters
+        self.counters = set()
+        # metric id: [samples, increases] while learning, None once known not to be a counter
+        self._learning = {}
+        # (metric id, label values): offset, for the series which were reset
+        self._offsets = {}
+        self._lock = threading.Lock()
+
+    @property
+    def offsets(self):
+        """Number of series which were reset, having an offset."""
+        return len(self._offsets)
+
+    def is_counter(self, metric_name):
+        """Return True if a new metric must be created as a counter."""
+        return self.matcher is not None and self.matcher.match(metric_name) is not None
+
+    def update(self, prom_metric_id, series, value):
+        """Set the value of a counter series, return False if the metric is not a counter."""
+        if prom_metric_id in self.counters:
+            self._set_counter(prom_metric_id, series, value)
+            return True
+        if not self.learning_samples:
+            return False
+
+        counter = self._learn(prom_metric_id, series, value)
+        if counter is None:
+            return False
+        # pylama: ignore=W0212
+        self._set_counter(prom_metric_id, counter.labels(*series._labelvalues), value)
+        return True
+
+    def _set_counter(self, prom_metric_id, series, value):
+        # pylama: ignore=W0212
+        if value < 0:
+            # not a counter value, the series keeps its value
+            return
+
+        key = (prom_metric_id, series._labelvalues)
+        offset = self._offsets.get(key, 0)
+        exposed = series._value.get()
+        if value + offset < exposed:
+            with self._lock:
+                offset = self._offsets[key] = exposed
+        series._value.set(value + offset)
+
+    def _learn(self, prom_metric_id, series, value):
+        # pylama: ignore=W0212
+        if self._learning.get(prom_metric_id, ()) is None:
+            return None
+
+        previous = series._value.get()
+        with self._lock:
+            if prom_metric_id in self.counters:
+                # learned by another thread
+                return None
+            state = self._learning.setdefault(prom_metric_id, [0, 0])
+            if state is None:
+                return None
+            if value < previous:
+                self._learning[prom_metric_id] = None
+                return None
+            state[0] += 1
+            # a new series (previous value 0) is not an increase
+            if previous and value > previous:
+                state[1] += 1
+            if state[0] < self.learning_samples:
+                return None
+            if not state[1]:
+                # constant during the learning window: not a counter
+                self._learning[prom_metric_id] = None
+                return None
+            self.counters.add(prom_metric_id)
+            del self._learning[prom_metric_id]
+
+        counter = self.on_learned(prom_metric_id)
+        if counter is None:
+            with self._lock:
+                self.counters.discard(prom_metric_id)
+                self._learning[prom_metric_id] = None
+        return counter
+
+    def forget(self, prom_metric_id, label_values):
+        """Remove the state of a removed series."""
+        if self._offsets:
+            with self._lock:
+                self._offsets.pop((prom_metric_id, label_values), None)
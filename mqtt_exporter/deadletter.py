@@ -0,0 +1,74 @@
+"""Ring buffer of recently rejected messages, to debug payload formats."""
+
+import threading
+import time
+
+from mqtt_exporter.cache import LRUCache
+
+# rejection reasons
+INVALID_PAYLOAD = "invalid_payload"
+UNSUPPORTED_FORMAT = "unsupported_format"
+NOT_A_NUMBER = "not_a_number"
+
+# number of topics for which the time of the last recorded message is kept
+TOPIC_CACHE_SIZE = 10000
+
+
+class DeadLetters:
+    """Last `size` rejected messages, with their payload truncated to `payload_size` bytes.
+
+    All the rejected messages are counted with `on_rejected(reason)`, but a topic is recorded at
+    most once every `topic_interval` seconds, so a single chatty topic does not evict the
+    messages of the other topics. The memory used is bounded by the size of the buffer.
+    """
+
+    def __init__(self, size=100, payload_size=256, topic_interval=60.0, on_rejected=None):
+        self.payload_size = payload_size
+        self.topic_interval = topic_interval
+        self.on_rejected = on_rejected
+        self._entries = [None] * size
+        self._next = 0
+        self._recorded = LRUCache(TOPIC_CACHE_SIZE)
+        self._lock = threading.Lock()
+
+    def add(self, topic, payload, reason, detail=""):
+        """Account for a rejected message, and record it unless its topic was recorded recently.
+
+        `detail` can be a function, only called when the message is recorded.
+        """
+        if self.on_rejected is not None:
+            self.on_rejected(reason)
+
+        now = time.time()
+        with self._lock:
+            recorded = self._recorded.get(topic)
+            if recorded is not None and now - recorded < self.topic_interval:
+                return
+            self._recorded[topic] = now
+
+            if callable(detail):
+                detail = detail()
+            if isinstance(payload, str):
+                payload = payload.encode("utf-8")
+            entry = {
+                "timestamp": now,
+                "topic": topic,
+                "reason": reason,
+                "detail": detail[: self.payload_size],
+                "payload": payload[: self.payload_size].decode("utf-8", "replace"),
+                "payload_size": len(payload),
+            }
+            self._entries[self._next] = entry
+            self._next = (self._next + 1) % len(self._entries)
+
+    def entries(self, topic=None, reason=None):
+        """Recorded messages, most recent first."""
+        with self._lock:
+            entries = self._entries[self._next :] + self._entries[: self._next]
+        return [
+            entry
+            for entry in reversed(entries)
+            if entry is not None
+            and (topic is None or entry["topic"] == topic)
+            and (reason is None or entry["reason"] == reason)
+        ]
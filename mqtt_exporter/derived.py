@@ -0,0 +1,246 @@
+"""Derived metrics, computed from the samples of a topic when they are updated."""
+
+import ast
+import math
+import operator
+import re
+
+_METRIC_NAME = re.compile(r"^[a-zA-Z_][a-zA-Z0-9_]*$")
+
+_BINARY_OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.Mod: operator.mod,
+    # float power: raises OverflowError instead of computing huge integers
+    ast.Pow: math.pow,
+}
+_UNARY_OPERATORS = {ast.USub: operator.neg, ast.UAdd: operator.pos}
+
+
+def dew_point(temperature, humidity):
+    """Dew point in °C from the temperature in °C and the relative humidity in % (Magnus)."""
+    gamma = math.log(humidity / 100) + 17.62 * temperature / (243.12 + temperature)
+    return 243.12 * gamma / (17.62 - gamma)
+
+
+FUNCTIONS = {
+    "abs": abs,
+    "min": min,
+    "max": max,
+    "round": round,
+    "sqrt": math.sqrt,
+    "exp": math.exp,
+    "log": math.log,
+    "log10": math.log10,
+    "dewpoint": dew_point,
+}
+RATE = "rate"
+
+
+def _rate_key(name):
+    return (RATE, name)
+
+
+class Expression:
+    """Arithmetic expression on metrics, compiled once to closures (no eval).
+
+    Supported: numbers, metric names, + - * / % **, and the functions of FUNCTIONS.
+    `rate(metric)` is the per-second increase of a metric between its last two samples.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.variables = set()
+        self.rates = set()
+        try:
+            tree = ast.parse(source.strip(), mode="eval")
+        except SyntaxError as error:
+            raise ValueError(f"invalid expression '{source}': {error.msg}")
+        self.evaluate = self._compile(tree.body)
+
+    def _compile(self, node):  # noqa: PLR0911
+        if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+            value = node.value
+            return lambda _values: value
+
+        if isinstance(node, ast.Name):
+            name = node.id
+            self.variables.add(name)
+            return lambda values: values[name]
+
+        if isinstance(node, ast.BinOp) and type(node.op) in _BINARY_OPERATORS:
+            binary_operator = _BINARY_OPERATORS[type(node.op)]
+            left = self._compile(node.left)
+            right = self._compile(node.right)
+            return lambda values: binary_operator(left(values), right(values))
+
+        if isinstance(node, ast.UnaryOp) and type(node.op) in _UNARY_OPERATORS:
+            unary_operator = _UNARY_OPERATORS[type(node.op)]
+            operand = self._compile(node.operand)
+            return lambda values: unary_operator(operand(values))
+
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and not node.keywords:
+            if node.func.id == RATE:
+                if len(node.args) != 1 or not isinstance(node.args[0], ast.Name):
+                    raise ValueError(f"invalid expression '{self.source}': rate() takes a metric")
+                key = _rate_key(node.args[0].id)
+                self.rates.add(node.args[0].id)
+                return lambda values: values[key]
+
+            function = FUNCTIONS.get(node.func.id)
+            if function is not None:
+                args = [self._compile(arg) for arg in node.args]
+                return lambda values: function(*(arg(values) for arg in args))
+
+        raise ValueError(f"invalid expression '{self.source}': unsupported {type(node).__name__}")
+
+
+def parse_derived_metrics(value):
+    """Parse derived metrics: "name1=expression1;name2=expression2"."""
+    definitions = []
+    for definition in value.split(";"):
+        if not definition.strip():
+            continue
+        name, sep, expression = definition.partition("=")
+        name = name.strip()
+        if not sep or not _METRIC_NAME.match(name):
+            raise ValueError(f"invalid derived metric definition: {definition}")
+        definitions.append((name, expression.strip()))
+
+    return tuple(definitions)
+
+
+class DerivedMetrics:
+    """Derived metrics of `definitions` (name, expression), computed incrementally per topic.
+
+    The dependency graph is compiled once: each input metric maps to the derivations depending
+    on it, directly or through other derived metrics, in evaluation order. When samples of a
+    topic are updated, only these derivations are evaluated, with the latest values of the
+    topic inputs.
+    """
+
+    def __init__(self, definitions):
+        self.expressions = {name: Expression(expression) for name, expression in definitions}
+        order = self._evaluation_order()
+        self._rank = {name: index for index, name in enumerate(order)}
+        # metric names whose values are kept, per topic
+        self.inputs = set()
+        for expression in self.expressions.values():
+            self.inputs |= expression.variables | expression.rates
+        self.rate_inputs = set()
+        for expression in self.expressions.values():
+            self.rate_inputs |= expression.rates
+
+        # metric: derivations to evaluate when it is updated, in evaluation order
+        self._affected = {}
+        for name in self.inputs | set(self.expressions):
+            affected = self._dependents(name)
+            self._affected[name] = tuple(derived for derived in order if derived in affected)
+        # inputs whose rate is computed, directly or through derived metrics
+        self.rate_sources = {
+            name
+            for name in self.inputs
+            if name in self.rate_inputs or not self.rate_inputs.isdisjoint(self._affected[name])
+        }
+        # topics having rate sources: their rates change even when their values do not
+        self.rate_topics = set()
+        # topic: latest values of the inputs and derived metrics
+        self._values = {}
+
+    def _evaluation_order(self):
+        """Topological order of the derived metrics, raise ValueError on cycles."""
+        order = []
+        visiting = set()
+
+        def visit(name):
+            if name in order:
+                return
+            if name in visiting:
+                raise ValueError(f"derived metric '{name}' depends on itself")
+            visiting.add(name)
+            expression = self.expressions[name]
+            for dependency in expression.variables | expression.rates:
+                if dependency in self.expressions:
+                    visit(dependency)
+            visiting.discard(name)
+            order.append(name)
+
+        for name in self.expressions:
+            visit(name)
+        return order
+
+    def _dependents(self, name):
+        dependents = set()
+        pending = [name]
+        while pending:
+            dependency = pending.pop()
+            for derived, expression in self.expressions.items():
+                if derived not in dependents and (
+                    dependency in expression.variables or dependency in expression.rates
+                ):
+                    dependents.add(derived)
+                    pending.append(derived)
+        return dependents
+
+    def update(self, topic, samples, now, source=None):
+        """Update the inputs of a topic (metric name: value), return the derived values updated.
+
+        The values of a topic are kept per `source` (e.g. the broker of the messages).
+        """
+        values = self._values.setdefault(topic, {}).setdefault(source, {})
+        if topic not in self.rate_topics and not self.rate_sources.isdisjoint(samples):
+            self.rate_topics.add(topic)
+        affected = set()
+        for name, value in samples.items():
+            if name in self.rate_inputs:
+                self._update_rate(values, name, value, now)
+            values[name] = value
+            affected.update(self._affected[name])
+
+        return self._evaluate(values, affected, now)
+
+    def _evaluate(self, values, affected, now):
+        if not affected:
+            return []
+
+        results = []
+        for name in sorted(affected, key=self._rank.__getitem__):
+            try:
+                value = self.expressions[name].evaluate(values)
+            except (KeyError, ArithmeticError, ValueError, TypeError):
+                # missing input, or not defined for these inputs (e.g. log of a negative value)
+                values.pop(name, None)
+                continue
+            if name in self.rate_inputs:
+                self._update_rate(values, name, value, now)
+            values[name] = value
+            results.append((name, value))
+        return results
+
+    @staticmethod
+    def _update_rate(values, name, value, now):
+        key = _rate_key(name)
+        previous = values.get(("last", name))
+        values[("last", name)] = (value, now)
+        if previous is None or now <= previous[1] or value < previous[0]:
+            # first sample, or reset of a counter
+            values.pop(key, None)
+            return
+        values[key] = (value - previous[0]) / (now - previous[1])
+
+    @property
+    def size(self):
+        """Number of values kept, for all the topics and sources."""
+        # snapshots, the values are updated by the threads processing the messages
+        return sum(
+            len(values)
+            for sources in list(self._values.values())
+            for values in list(sources.values())
+        )
+
+    def forget(self, topic):
+        """Remove the values of a topic, of all its sources."""
+        self._values.pop(topic, None)
+        self.rate_topics.discard(topic)
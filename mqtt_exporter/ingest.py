@@ -0,0 +1,60 @@
+"""Processing of the messages by a pool of threads."""
+
+import logging
+import queue
+import threading
+
+LOG = logging.getLogger("mqtt-exporter")
+
+_STOP = object()
+
+
+class IngestWorkers:
+    """Threads calling `process(*args)`, the messages of a topic always going to the same thread.
+
+    Messages of a topic are processed in order, messages of different topics concurrently: on
+    free-threaded Python builds, parsing scales with the number of threads. Each thread has a
+    queue of `queue_size` messages, `submit()` blocks when it is full (backpressure to the MQTT
+    network loop).
+    """
+
+    def __init__(self, threads, process, queue_size=10000):
+        self.process = process
+        self._queues = [queue.Queue(queue_size) for _ in range(threads)]
+        self._threads = [
+            threading.Thread(target=self._work, args=(work_queue,), daemon=True)
+            for work_queue in self._queues
+        ]
+
+    def start(self):
+        """Start the threads."""
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    @property
+    def pending(self):
+        """Number of messages waiting in the queues."""
+        return sum(work_queue.qsize() for work_queue in self._queues)
+
+    def submit(self, topic, *args):
+        """Queue a message of `topic` for processing."""
+        self._queues[hash(topic) % len(self._queues)].put(args)
+
+    def stop(self):
+        """Process the queued messages, then stop the threads."""
+        for work_queue in self._queues:
+            work_queue.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+
+    def _work(self, work_queue):
+        process = self.process
+        while True:
+            args = work_queue.get()
+            if args is _STOP:
+                return
+            try:
+                process(*args)
+            except Exception:
+                LOG.exception("failed to process message")
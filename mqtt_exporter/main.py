@@ -2,251 +2,617 @@
 """MQTT exporter."""
 
 import argparse
-import fnmatch
 import json
 import logging
+import multiprocessing
 import re
 import signal
 import ssl
 import sys
+import threading
 import time
 from collections import defaultdict
-from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, replace
+from functools import partial
+from operator import attrgetter
 
 import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
 from prometheus_client import (
     REGISTRY,
     Counter,
     Gauge,
+    Histogram,
     generate_latest,
-    start_http_server,
     validation,
 )
-
-from mqtt_exporter import settings
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+from mqtt_exporter import server, settings
+from mqtt_exporter.arrays import (
+    INDEX_LABEL,
+    ArrayValues,
+    array_samples,
+    parse_array_modes,
+    to_numbers,
+)
+from mqtt_exporter.brokers import BrokerConfig, load_brokers
+from mqtt_exporter.cache import LockedLRUCache, LRUCache
+from mqtt_exporter.cardinality import LabelCardinality, parse_limits
+from mqtt_exporter.catchup import CatchUp
+from mqtt_exporter.counters import CounterDetector, ValueCounter
+from mqtt_exporter.deadletter import (
+    INVALID_PAYLOAD,
+    NOT_A_NUMBER,
+    UNSUPPORTED_FORMAT,
+    DeadLetters,
+)
+from mqtt_exporter.derived import DerivedMetrics, parse_derived_metrics
 from mqtt_exporter.exceptions import MaximumMetricReached
+from mqtt_exporter.ingest import IngestWorkers
+from mqtt_exporter.matcher import TopicMatcher
+from mqtt_exporter.memory import (
+    CACHE_ENTRY_BYTES,
+    DEAD_LETTER_BYTES,
+    DERIVED_VALUE_BYTES,
+    LABEL_BYTES,
+    LABEL_STATE_BYTES,
+    MESSAGE_BYTES,
+    POINT_BYTES,
+    SERIES_BYTES,
+    TOP_TOPIC_BYTES,
+    TOPIC_BYTES,
+    MemoryBudget,
+    parse_size,
+)
+from mqtt_exporter.offload import Offloader
+from mqtt_exporter.ratelimit import COALESCE, RateLimiter, parse_rate_limits
+from mqtt_exporter.shards import TopicIndex, parse_shards
+from mqtt_exporter.sinks import parse_sinks
+from mqtt_exporter.sketch import TopicStats
+from mqtt_exporter.sources import parse_source
+from mqtt_exporter.store import SeriesStore
+from mqtt_exporter.watchdog import Watchdog, socket_backlog
 
 logging.basicConfig(level=settings.LOG_LEVEL)
 LOG = logging.getLogger("mqtt-exporter")
 
 ZIGBEE2MQTT_AVAILABILITY_SUFFIX = "/availability"
 
+# MQTTv5 subscription identifiers: generic topics, then one per integration route
+GENERIC_SUBSCRIPTION_ID = 1
+FIRST_ROUTE_SUBSCRIPTION_ID = 2
+
+# sentinel returned by the decoder for payloads which cannot be decoded
+_REJECTED = object()
+
+# number of metric names kept already normalized by each pipeline
+METRIC_ID_CACHE_SIZE = 10000
+# units recognized after a number (upper case), with an optional SI prefix
+_UNITS = (
+    *("%", "°", "°C", "°F", "K", "LQI", "DB", "DBM", "DBA", "PPM", "PPB", "RPM", "BPM"),
+    *("W", "WH", "VA", "VAR", "VARH", "V", "A", "AH", "Ω", "OHM", "J", "HZ", "LX", "LM"),
+    *("PA", "HPA", "BAR", "PSI", "S", "MIN", "H", "M", "M²", "M³", "M2", "M3", "L", "G"),
+    *("M/S", "KM/H", "M³/H", "M3/H", "L/H", "L/MIN", "G/M³", "G/M3", "W/M²", "W/M2"),
+)
+# number with an optional unit suffix (upper case), e.g. "23.5 °C", "12%", "3.2 KWH"
+_NUMBER_WITH_UNIT = re.compile(
+    r"\s*([-+]?(?:\d+\.?\d*|\.\d+)(?:E[-+]?\d+)?)\s*(?:[GKMNUΜµ]?(?:"
+    + "|".join(re.escape(unit) for unit in sorted(_UNITS, key=len, reverse=True))
+    + r"))?\s*"
+)
+# seconds between two checks of the coalesced messages due
+RATE_LIMIT_FLUSH_INTERVAL = 0.1
+# seconds between two checks of the backlog of the sessions catching up
+CATCH_UP_CHECK_INTERVAL = 0.1
+# a message is usually processed in tens of microseconds
+CALLBACK_DURATION_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1, 1)
+# caches are not shrunk below this number of entries by the memory budget
+MIN_CACHE_SIZE = 100
 
-@dataclass(frozen=True)
+
+@dataclass(frozen=True, slots=True)
 class PromMetricId:
     name: str
     labels: tuple = ()
 
 
+@dataclass(slots=True)
+class DedupEntry:
+    fingerprint: int
+    msg_counter: Counter | None = None
+    last_seen: tuple = ()
+
+
 # global variables
-metric_refs: dict[str, list[tuple]] = defaultdict(list)
+# last seen timestamp gauge of each metric
+ts_metric_ids: dict[PromMetricId, PromMetricId] = {}
+# label names tuples shared by all the metrics having the same labels
+_label_keys: dict[tuple, tuple] = {}
+# topics having series, partitioned for the sharded scrape endpoints
+topic_index = TopicIndex()
 prom_metrics: dict[PromMetricId, Gauge] = {}
 prom_msg_counter = None
-
-
-def _create_msg_counter_metrics():
+prom_ignored_counter = None
+prom_suppressed_counter = None
+prom_broker_messages = None
+prom_broker_connected = None
+message_pipeline = None
+_create_metric_lock = threading.Lock()
+mqtt_clients: list[mqtt.Client] = []
+prom_dedup_counter = None
+dedup_stats = {"hit": 0, "miss": 0}
+topic_stats: TopicStats | None = None
+label_cardinality: LabelCardinality | None = None
+offloader: Offloader | None = None
+ingest_workers: IngestWorkers | None = None
+counter_detector: CounterDetector | None = None
+dead_letters: DeadLetters | None = None
+watchdog: Watchdog | None = None
+memory_budget: MemoryBudget | None = None
+output_sinks: list = []
+
+
+def _create_msg_counter_metrics(expose_broker=False):
     global prom_msg_counter  # noqa: PLW0603
+    labels = [settings.TOPIC_LABEL]
     if settings.MQTT_EXPOSE_CLIENT_ID:
-        prom_msg_counter = Counter(  # noqa: PLW0603
-            f"{settings.PREFIX}message_total",
-            "Counter of received messages",
-            [settings.TOPIC_LABEL, "client_id"],
-        )
-    else:
-        prom_msg_counter = Counter(  # noqa: PLW0603
-            f"{settings.PREFIX}message_total",
-            "Counter of received messages",
-            [settings.TOPIC_LABEL],
-        )
+        labels.append("client_id")
+    if expose_broker:
+        labels.append("broker")
+
+    prom_msg_counter = Counter(
+        f"{settings.PREFIX}message_total",
+        "Counter of received messages",
+        labels,
+    )
 
 
-def subscribe(client, _, __, reason_code, properties):
-    """Subscribe to mqtt events (callback)."""
-    user_data = {"client_id": settings.MQTT_CLIENT_ID}
-    if not settings.MQTT_CLIENT_ID and settings.MQTT_V5_PROTOCOL:
-        user_data["client_id"] = properties.AssignedClientIdentifier
+def _create_ignore_metrics():
+    global prom_ignored_counter  # noqa: PLW0603
+    prom_ignored_counter = Counter(
+        f"{settings.PREFIX}ignored_messages_total",
+        "Counter of messages ignored by MQTT_IGNORED_TOPICS",
+        ["pattern"],
+    )
 
-    client.user_data_set(user_data)
 
-    for s in settings.TOPIC.split(","):
-        LOG.info('subscribing to "%s"', s)
-        client.subscribe(s)
-    if reason_code != mqtt.CONNACK_ACCEPTED:
-        LOG.error("MQTT %s", mqtt.connack_string(reason_code))
+def _create_rate_limit_metrics():
+    global prom_suppressed_counter  # noqa: PLW0603
+    prom_suppressed_counter = Counter(
+        f"{settings.PREFIX}suppressed_messages_total",
+        "Counter of messages not processed because of RATE_LIMITS",
+        ["pattern"],
+    )
 
 
-def _normalize_prometheus_metric_name(prom_metric_name):
-    """Transform an invalid prometheus metric to a valid one.
+def _create_broker_metrics():
+    """Create the ingestion and connection state metrics of each broker."""
+    global prom_broker_messages, prom_broker_connected  # noqa: PLW0603
+    prom_broker_messages = Counter(
+        f"{settings.PREFIX}broker_messages_total",
+        "Counter of messages received from the broker",
+        ["broker"],
+    )
+    prom_broker_connected = Gauge(
+        f"{settings.PREFIX}broker_connected",
+        "Connection state to the broker (1 connected, 0 disconnected)",
+        ["broker"],
+    )
 
-    https://prometheus.io/docs/concepts/data_model/#metric-names-and-labels
-    """
-    if validation.METRIC_NAME_RE.match(prom_metric_name):
-        return prom_metric_name
 
-    # clean invalid characters
-    prom_metric_name = re.sub(r"[^a-zA-Z0-9_:]", "", prom_metric_name)
+def _create_dedup_metrics():
+    """Create the metrics of the repeated payload cache."""
+    global prom_dedup_counter  # noqa: PLW0603
+    prom_dedup_counter = Counter(
+        f"{settings.PREFIX}dedup_lookups_total",
+        "Counter of repeated payload cache lookups",
+        ["result"],
+    )
 
-    # ensure to start with valid character
-    if not re.match(r"^[a-zA-Z_:]", prom_metric_name):
-        prom_metric_name = ":" + prom_metric_name
+    def _hit_ratio():
+        lookups = dedup_stats["hit"] + dedup_stats["miss"]
+        return dedup_stats["hit"] / lookups if lookups else 0.0
 
-    return prom_metric_name
+    Gauge(
+        f"{settings.PREFIX}dedup_hit_ratio", "Ratio of payloads skipped as repeated"
+    ).set_function(_hit_ratio)
 
 
-def _normalize_prometheus_metric_label_name(prom_metric_label_name):
-    """Transform an invalid prometheus metric to a valid one.
+def _create_top_topics_metrics():
+    """Create the heavy hitters sketch of the topics, exposed as metrics."""
+    global topic_stats  # noqa: PLW0603
+    topic_stats = TopicStats(
+        settings.TOP_TOPICS_CAPACITY, settings.TOP_TOPICS_EXPOSED, settings.PREFIX
+    )
+    REGISTRY.register(topic_stats)
 
-    https://prometheus.io/docs/concepts/data_model/#metric-names-and-labels
-    """
-    # clean invalid characters
-    prom_metric_label_name = re.sub(r"[^a-zA-Z0-9_]", "", prom_metric_label_name)
 
-    # ensure to start with valid character
-    if not re.match(r"^[a-zA-Z_]", prom_metric_label_name):
-        prom_metric_label_name = "_" + prom_metric_label_name
-    if prom_metric_label_name.startswith("__"):
-        prom_metric_label_name = prom_metric_label_name[1:]
+def _create_label_cardinality_metrics():
+    """Create the label values estimators and limits, exposed as metrics."""
+    global label_cardinality  # noqa: PLW0603
+    label_cardinality = LabelCardinality(
+        settings.LABEL_CARDINALITY_LIMIT,
+        parse_limits(settings.LABEL_CARDINALITY_LIMITS),
+        settings.LABEL_CARDINALITY_ACTION,
+        settings.PREFIX,
+    )
+    REGISTRY.register(label_cardinality)
 
-    return prom_metric_label_name
 
+def _create_dead_letters():
+    """Create the buffer of the rejected messages, and their counter."""
+    global dead_letters  # noqa: PLW0603
+    rejected = Counter(
+        f"{settings.PREFIX}rejected_messages_total",
+        "Counter of messages which could not be parsed, or with fields which are not numbers",
+        ["reason"],
+    )
+    dead_letters = DeadLetters(
+        settings.DEAD_LETTER_SIZE,
+        settings.DEAD_LETTER_PAYLOAD_SIZE,
+        settings.DEAD_LETTER_TOPIC_INTERVAL,
+        lambda reason: rejected.labels(reason).inc(),
+    )
 
-def _create_prometheus_metric(prom_metric_id, original_topic):
-    """Create Prometheus metric if does not exist."""
-    if not prom_metrics.get(prom_metric_id):
-        if settings.MAX_METRICS > 0 and len(prom_metrics) >= settings.MAX_METRICS:
-            raise MaximumMetricReached(
-                f"metric limit reached ({settings.MAX_METRICS}): cannot create new metric {prom_metric_id}"
-            )
 
-        labels = [settings.TOPIC_LABEL]
-        if settings.MQTT_EXPOSE_CLIENT_ID:
-            labels.append("client_id")
-        labels.extend(prom_metric_id.labels)
+def _create_counter_detector():
+    """Create the detector of the cumulative fields, exposed as counters."""
+    global counter_detector  # noqa: PLW0603
+    counter_detector = CounterDetector(
+        [pattern for pattern in settings.COUNTER_METRICS if pattern],
+        settings.COUNTER_LEARNING_SAMPLES,
+        _replace_by_counter,
+    )
 
-        prom_metrics[prom_metric_id] = Gauge(
-            prom_metric_id.name, "metric generated from MQTT message.", labels
-        )
-        metric_refs[original_topic].append((prom_metric_id, labels))
 
-        if settings.EXPOSE_LAST_SEEN:
-            ts_metric_id = PromMetricId(f"{prom_metric_id.name}_ts", prom_metric_id.labels)
-            prom_metrics[ts_metric_id] = Gauge(
-                ts_metric_id.name, "timestamp of metric generated from MQTT message.", labels
-            )
-            metric_refs[original_topic].append((ts_metric_id, labels))
+def _replace_by_counter(prom_metric_id):
+    """Replace the gauge of a metric by a counter with the same series, return the counter."""
+    # pylama: ignore=W0212
+    with _create_metric_lock:
+        gauge = prom_metrics.get(prom_metric_id)
+        if gauge is None or gauge._type == "counter":
+            return gauge
 
-        LOG.info("creating prometheus metric: %s", prom_metric_id)
+        REGISTRY.unregister(gauge)
+        try:
+            counter = ValueCounter(gauge._name, gauge._documentation, gauge._labelnames)
+        except ValueError as error:
+            LOG.error("unable to expose metric '%s' as a counter: %s", prom_metric_id, error)
+            REGISTRY.register(gauge)
+            return None
+        for label_values, series in list(gauge._metrics.items()):
+            counter.labels(*label_values)._value.set(series._value.get())
+        prom_metrics[prom_metric_id] = counter
+
+    LOG.info("exposing metric %s as a counter", prom_metric_id)
+    return counter
+
+
+def _create_ingest_workers():
+    """Start the threads processing the messages, with the active pipeline."""
+    global ingest_workers  # noqa: PLW0603
+    ingest_workers = IngestWorkers(
+        settings.INGEST_THREADS, _process_message, settings.INGEST_QUEUE_SIZE
+    ).start()
+
+
+def _create_output_sinks():
+    """Start the sinks sending the samples to other systems, and their metrics."""
+    global output_sinks  # noqa: PLW0603
+    sent = Counter(
+        f"{settings.PREFIX}sink_points_total", "Counter of samples sent by the sink", ["sink"]
+    )
+    dropped = Counter(
+        f"{settings.PREFIX}sink_dropped_points_total",
+        "Counter of samples dropped by the sink",
+        ["sink", "reason"],
+    )
 
+    output_sinks = parse_sinks(
+        settings.OUTPUT_SINKS,
+        buffer_size=settings.OUTPUT_SINK_BUFFER_SIZE,
+        flush_interval=settings.OUTPUT_SINK_FLUSH_INTERVAL,
+        on_sent=lambda sink, count: sent.labels(sink).inc(count),
+        on_dropped=lambda sink, count, reason: dropped.labels(sink, reason).inc(count),
+    )
+    for sink in output_sinks:
+        LOG.info('sending the samples to sink "%s"', sink.name)
+        sink.start()
+
+
+def _create_watchdog():
+    """Start the watchdog of the network loop lag, and its metrics."""
+    global watchdog  # noqa: PLW0603
+    duration = Histogram(
+        f"{settings.PREFIX}callback_duration_seconds",
+        "Time spent processing a message in the MQTT network loop",
+        buckets=CALLBACK_DURATION_BUCKETS,
+    )
+    lag = Gauge(
+        f"{settings.PREFIX}network_loop_lag_seconds",
+        "Estimated delay of the MQTT network loop, behind the messages received",
+    )
+    shedding = Gauge(
+        f"{settings.PREFIX}load_shedding",
+        "Load shedding state (1 when the messages are only counted, not processed)",
+    )
+    shed = Counter(
+        f"{settings.PREFIX}shed_messages_total", "Counter of messages not processed to shed load"
+    )
 
-def _add_prometheus_sample(
-    topic, original_topic, prom_metric_id, metric_value, client_id, additional_labels
-):
-    if prom_metric_id not in prom_metrics:
+    def on_check(current_lag, current_shedding):
+        lag.set(current_lag)
+        shedding.set(1 if current_shedding else 0)
+
+    watchdog = Watchdog(
+        settings.WATCHDOG_LAG_THRESHOLD,
+        settings.WATCHDOG_INTERVAL,
+        settings.WATCHDOG_SLOW_TOPICS,
+        settings.WATCHDOG_LOAD_SHEDDING,
+        backlog=lambda: sum(socket_backlog(client.socket()) for client in mqtt_clients),
+        on_duration=duration.observe,
+        on_shed=shed.inc,
+        on_check=on_check,
+    ).start()
+
+
+def _create_memory_budget():
+    """Start the memory budget of the exporter data, and its metrics."""
+    global memory_budget  # noqa: PLW0603
+    estimated = Gauge(
+        f"{settings.PREFIX}memory_estimated_bytes",
+        "Estimated memory of the exporter data, per component",
+        ["component"],
+    )
+    limit = Gauge(
+        f"{settings.PREFIX}memory_limit_bytes", "Ceiling of the estimated memory of the data"
+    )
+    stage = Gauge(
+        f"{settings.PREFIX}memory_degradation_stage",
+        "Degradation stage (0 normal, 1 caches shrunk, 2 new series refused, 3 series evicted)",
+    )
+    evicted = Counter(
+        f"{settings.PREFIX}memory_evicted_series_total",
+        "Counter of series removed to stay within the memory limit",
+    )
+    refused = Counter(
+        f"{settings.PREFIX}memory_refused_samples_total",
+        "Counter of samples of new series refused to stay within the memory limit",
+    )
+
+    def on_check(usage, current_stage):
+        for component, size in usage.items():
+            estimated.labels(component).set(size)
+        stage.set(current_stage)
+
+    def on_evict(size, recent):
+        evicted.inc(_evict_stale_series(size, recent))
+
+    memory_budget = MemoryBudget(
+        parse_size(settings.MEMORY_LIMIT),
+        _memory_usage,
+        settings.MEMORY_HIGH_WATERMARK,
+        settings.MEMORY_LOW_WATERMARK,
+        settings.MEMORY_CHECK_INTERVAL,
+        on_shrink=_shrink_caches,
+        on_restore=_restore_caches,
+        on_evict=on_evict,
+        on_refused=refused.inc,
+        on_check=on_check,
+    ).start()
+    limit.set(memory_budget.ceiling)
+
+
+def _memory_usage():
+    """Estimated bytes of the exporter data, per component."""
+    # pylama: ignore=W0212
+    series = labels = 0
+    for prom_metric_id, metric in list(prom_metrics.items()):
+        count = len(metric._metrics)
+        series += count
+        labels += count * len(prom_metric_id.labels)
+    if prom_msg_counter is not None:
+        count = len(prom_msg_counter._metrics)
+        series += count
+        if "broker" in prom_msg_counter._labelnames:
+            labels += count
+
+    pipeline = message_pipeline
+    caches = sum(len(cache) for cache in pipeline.caches()) if pipeline is not None else 0
+    derived = 0
+    if pipeline is not None and pipeline.derived is not None:
+        derived = pipeline.derived.size * DERIVED_VALUE_BYTES
+    if pipeline is not None and pipeline.rate_limiter is not None:
+        caches += pipeline.rate_limiter.states
+    if counter_detector is not None:
+        caches += counter_detector.offsets
+    sketches = 0
+    if label_cardinality is not None:
+        sketches += label_cardinality.states * LABEL_STATE_BYTES
+    if topic_stats is not None:
+        sketches += topic_stats.entries * TOP_TOPIC_BYTES
+
+    messages = ingest_workers.pending if ingest_workers is not None else 0
+    if pipeline is not None and pipeline.rate_limiter is not None:
+        messages += pipeline.rate_limiter.pending
+    for client in mqtt_clients:
+        catch_up = client.user_data_get().get("catch_up")
+        if catch_up is not None:
+            messages += catch_up.pending
+    queues = messages * MESSAGE_BYTES + sum(sink.pending for sink in output_sinks) * POINT_BYTES
+    if dead_letters is not None:
+        queues += settings.DEAD_LETTER_SIZE * (
+            DEAD_LETTER_BYTES + settings.DEAD_LETTER_PAYLOAD_SIZE
+        )
+
+    return {
+        "series": series * SERIES_BYTES,
+        "labels": labels * LABEL_BYTES,
+        "topics": len(metric_refs) * TOPIC_BYTES,
+        "caches": caches * CACHE_ENTRY_BYTES,
+        "queues": queues,
+        "sketches": sketches,
+        "derived": derived,
+    }
+
+
+def _shrink_caches():
+    """Halve the caches of the pipeline, down to MIN_CACHE_SIZE entries."""
+    if message_pipeline is None:
         return
+    for cache in message_pipeline.caches():
+        cache.resize(max(cache.maxsize // 2, min(cache.capacity, MIN_CACHE_SIZE)))
 
-    labels = {settings.TOPIC_LABEL: topic}
-    if settings.MQTT_EXPOSE_CLIENT_ID:
-        labels["client_id"] = client_id
-    labels.update(additional_labels)
 
-    prom_metrics[prom_metric_id].labels(**labels).set(metric_value)
-    if not (prom_metric_id, labels) not in metric_refs[original_topic]:
-        metric_refs[original_topic].append((prom_metric_id, labels))
+def _restore_caches():
+    """Restore the configured size of the caches of the pipeline."""
+    if message_pipeline is None:
+        return
+    for cache in message_pipeline.caches():
+        cache.resize(cache.capacity)
+
+
+def _evict_stale_series(size, recent):
+    """Remove the series of topics not in `recent` to free about `size` bytes, return their number."""
+    topics = len(metric_refs)
+    if not topics:
+        return 0
+    usage = _memory_usage()
+    per_topic = (usage["series"] + usage["labels"] + usage["topics"] + usage["derived"]) / topics
+    count = int(size // per_topic) + 1 if per_topic else topics
+
+    stale = []
+    for topic in metric_refs:
+        if topic not in recent:
+            stale.append(topic)
+            if len(stale) >= count:
+                break
+    if not stale:
+        LOG.warning("no stale series to evict, all the topics were updated recently")
+        return 0
+
+    # the message counters and dedup entries of the topics are removed too
+    removed = delete_series(stale)
+    LOG.warning("evicted %d series of %d stale topics to free memory", removed, len(stale))
+    return removed
+
+
+def _create_offloader(concurrent=False):
+    """Create the process pool parsing heavy payloads, and its metrics.
+
+    `concurrent` when messages are processed by several threads, see `PipelineConfig.concurrent`.
+    """
+    global offloader  # noqa: PLW0603
+    messages = Counter(
+        f"{settings.PREFIX}offloaded_messages_total", "Counter of messages parsed in the pool"
+    )
+    payload_bytes = Counter(
+        f"{settings.PREFIX}offloaded_bytes_total", "Payload bytes parsed in the pool"
+    )
+    latency = Histogram(
+        f"{settings.PREFIX}offload_latency_seconds",
+        "Time from the reception of an offloaded message until its samples are exposed",
+    )
+
+    def on_applied(size, duration):
+        messages.inc()
+        payload_bytes.inc(size)
+        latency.observe(duration)
 
-    if settings.EXPOSE_LAST_SEEN:
-        ts_metric_id = PromMetricId(f"{prom_metric_id.name}_ts", prom_metric_id.labels)
-        prom_metrics[ts_metric_id].labels(**labels).set(int(time.time()))
-        if not (ts_metric_id, labels) not in metric_refs[original_topic]:
-            metric_refs[original_topic].append((ts_metric_id, labels))
+    # spawn: the exporter already runs threads (MQTT loop, HTTP server) when the pool starts
+    executor = ProcessPoolExecutor(
+        settings.OFFLOAD_WORKERS, mp_context=multiprocessing.get_context("spawn")
+    )
+    offloader = Offloader(
+        executor,
+        settings.OFFLOAD_MIN_SIZE,
+        [topic for topic in settings.OFFLOAD_TOPICS if topic],
+        on_applied,
+        thread_safe=concurrent,
+    )
 
-    LOG.debug("new value for %s: %s", prom_metric_id, metric_value)
 
+def subscribe(client, userdata, flags, reason_code, properties):
+    """Subscribe to mqtt events (callback)."""
+    broker = userdata["broker"]
+    userdata["client_id"] = broker.client_id
+    if not broker.client_id and broker.v5_protocol:
+        userdata["client_id"] = properties.AssignedClientIdentifier
 
-def _parse_metric(data):
-    """Attempt to parse the value and extract a number out of it.
+    if prom_broker_connected is not None:
+        prom_broker_connected.labels(broker.name).set(1)
 
-    Note that `data` is untrusted input at this point.
+    catch_up = userdata.get("catch_up")
+    if catch_up is not None and flags.session_present:
+        catch_up.start(time.monotonic())
 
-    Raise ValueError is the data can't be parsed.
-    """
-    if isinstance(data, (int, float)):
-        return data
+    _subscribe_topics(client, broker, broker.topics)
+    if reason_code != mqtt.CONNACK_ACCEPTED:
+        LOG.error("MQTT %s", mqtt.connack_string(reason_code))
 
-    if isinstance(data, bytes):
-        data = data.decode()
 
-    if isinstance(data, str):
-        data = data.upper()
+def _subscribe_topics(client, broker, topics):
+    """Subscribe to topics, with one SUBSCRIBE per integration when identifiers are enabled."""
+    if not (broker.v5_protocol and message_pipeline and message_pipeline.routes_by_id):
+        for s in topics:
+            LOG.info('subscribing to "%s"', s)
+            client.subscribe(s, qos=broker.qos)
+        return
 
-        # Handling of switch data where their state is reported as ON/OFF
-        if data in settings.STATE_VALUES:
-            return settings.STATE_VALUES[data]
+    for subscription_id, sub_topics in message_pipeline.subscriptions(topics).items():
+        LOG.info('subscribing to "%s" (identifier %d)', ",".join(sub_topics), subscription_id)
+        properties = Properties(PacketTypes.SUBSCRIBE)
+        properties.SubscriptionIdentifier = subscription_id
+        client.subscribe([(topic, broker.qos) for topic in sub_topics], properties=properties)
 
-        # Last ditch effort, we got a string, let's try to cast it
-        return float(data)
 
-    # We were not able to extract anything, let's bubble it up.
-    raise ValueError(f"Can't parse '{data}' to a number.")
+def _on_disconnect(_client, userdata, _flags, reason_code, _properties):
+    """Update the broker connection state (callback)."""
+    broker = userdata["broker"]
+    LOG.warning('disconnected from broker "%s": %s', broker.name or broker.address, reason_code)
+    if prom_broker_connected is not None:
+        prom_broker_connected.labels(broker.name).set(0)
 
 
-def _parse_metrics(data, topic, original_topic, client_id, prefix="", labels=None):
-    """Attempt to parse a set of metrics.
+def _normalize_prometheus_metric_name(prom_metric_name):
+    """Transform an invalid prometheus metric to a valid one.
 
-    Note when `data` contains nested metrics this function will be called recursively.
+    https://prometheus.io/docs/concepts/data_model/#metric-names-and-labels
     """
-    if labels is None:
-        labels = {}
-    label_keys = tuple(sorted(labels.keys()))
-
-    for metric, value in data.items():
-        # when value is a list recursively call _parse_metrics to handle these messages
-        if isinstance(value, list):
-            LOG.debug("parsing list %s: %s", metric, value)
-            _parse_metrics(
-                dict(enumerate(value)),
-                topic,
-                original_topic,
-                client_id,
-                f"{prefix}{metric}_",
-                labels,
-            )
-            continue
+    if validation.METRIC_NAME_RE.match(prom_metric_name):
+        return prom_metric_name
 
-        # when value is a dict recursively call _parse_metrics to handle these messages
-        if isinstance(value, dict):
-            LOG.debug("parsing dict %s: %s", metric, value)
-            _parse_metrics(value, topic, original_topic, client_id, f"{prefix}{metric}_", labels)
-            continue
+    # clean invalid characters
+    prom_metric_name = re.sub(r"[^a-zA-Z0-9_:]", "", prom_metric_name)
 
-        try:
-            metric_value = _parse_metric(value)
-        except ValueError as err:
-            LOG.debug("Failed to convert %s: %s", metric, err)
-            continue
+    # ensure to start with valid character
+    if not re.match(r"^[a-zA-Z_:]", prom_metric_name):
+        prom_metric_name = ":" + prom_metric_name
 
-        # create metric if does not exist
-        prom_metric_name = (
-            f"{settings.PREFIX}{prefix}{metric}".replace(".", "")
-            .replace(" ", "_")
-            .replace("-", "_")
-            .replace("/", "_")
-        )
-        prom_metric_name = re.sub(r"\((.*?)\)", "", prom_metric_name)
-        prom_metric_name = _normalize_prometheus_metric_name(prom_metric_name)
-        prom_metric_id = PromMetricId(prom_metric_name, label_keys)
-        try:
-            _create_prometheus_metric(prom_metric_id, original_topic)
-        except (ValueError, MaximumMetricReached) as error:
-            LOG.error("unable to create prometheus metric '%s': %s", prom_metric_id, error)
-            return
+    return prom_metric_name
 
-        # expose the sample to prometheus
-        _add_prometheus_sample(
-            topic, original_topic, prom_metric_id, metric_value, client_id, labels
-        )
 
+def _normalize_prometheus_metric_label_name(prom_metric_label_name):
+    """Transform an invalid prometheus metric to a valid one.
+
+    https://prometheus.io/docs/concepts/data_model/#metric-names-and-labels
+    """
+    # clean invalid characters
+    prom_metric_label_name = re.sub(r"[^a-zA-Z0-9_]", "", prom_metric_label_name)
+
+    # ensure to start with valid character
+    if not re.match(r"^[a-zA-Z_]", prom_metric_label_name):
+        prom_metric_label_name = "_" + prom_metric_label_name
+    if prom_metric_label_name.startswith("__"):
+        prom_metric_label_name = prom_metric_label_name[1:]
 
-def _normalize_name_in_topic_msg(topic, payload):
+    return prom_metric_label_name
+
+
+def _normalize_name_in_topic_msg(topic, payload, keep_full_topic=False):
     """Normalize message to classic topic payload format.
 
     Used when payload is containing only the value, and the sensor metric name is in the topic.
@@ -267,7 +633,7 @@ def _normalize_name_in_topic_msg(topic, payload):
 
     # Shellies format
     try:
-        if settings.KEEP_FULL_TOPIC:  # options instead of hardcoded length
+        if keep_full_topic:  # options instead of hardcoded length
             topic = "/".join(info[:-1]).lower()
         else:
             topic = f"{info[0]}/{info[1]}".lower()
@@ -362,201 +728,1695 @@ def _normalize_meshtastic_format(topic, payload):
     return topic, payload
 
 
-def _is_esphome_topic(topic):
-    for prefix in settings.ESPHOME_TOPIC_PREFIXES:
-        if prefix and topic.startswith(prefix):
-            return True
+def _parse_properties(properties):
+    """Convert MQTTv5 properties to a dict."""
+    if not hasattr(properties, "UserProperty"):
+        return {}
 
-    return False
+    return {
+        sys.intern(_normalize_prometheus_metric_label_name(key)): sys.intern(value)
+        for key, value in properties.UserProperty
+    }
 
 
-def _is_hubitat_topic(topic):
-    for prefix in settings.HUBITAT_TOPIC_PREFIXES:
-        if prefix and topic.startswith(prefix):
-            return True
+def _index_topic(topic):
+    topic_index.add(topic)
 
-    return False
 
+def _unindex_topic(topic):
+    topic_index.remove(topic)
 
-def _parse_message(raw_topic, raw_payload):
-    """Parse topic and payload to have exposable information."""
-    # parse MQTT payload
+
+# series exposed for each original topic: {(PromMetricId, label values), ...}
+# the series of the last seen timestamp gauges are not stored, see ts_metric_ids
+metric_refs = SeriesStore(on_new_topic=_index_topic, on_removed_topic=_unindex_topic)
+
+
+def _remove_series(original_topic):
+    """Remove all the series exposed for a topic, return the number of removed series."""
+    samples = metric_refs.pop(original_topic, ())
+    if message_pipeline is not None and message_pipeline.derived is not None:
+        message_pipeline.derived.forget(original_topic)
+    removed = 0
+    for prom_metric_id, label_values in samples:
+        if counter_detector is not None:
+            counter_detector.forget(prom_metric_id, label_values)
+        for metric_id in (prom_metric_id, ts_metric_ids.get(prom_metric_id)):
+            if metric_id is None:
+                continue
+            try:
+                prom_metrics[metric_id].remove(*label_values)
+                removed += 1
+            except KeyError:
+                pass
+
+    return removed
+
+
+def _shared_label_keys(labels):
+    """Sorted label names, as a tuple shared by all the metrics having these labels."""
+    label_keys = tuple(sorted(labels))
+    return _label_keys.setdefault(label_keys, label_keys)
+
+
+def _zigbee2mqtt_rename(msg, zigbee2mqtt_availability):
+    # Remove old metrics following renaming
+
+    payload = json.loads(msg.payload)
+    old_topic = f"zigbee2mqtt/{payload['data']['from']}"
+    if old_topic not in metric_refs:
+        return
+
+    _remove_series(old_topic)
+
+    # Remove old availability metrics following renaming
+
+    if not zigbee2mqtt_availability:
+        return
+
+    _remove_series(f"{old_topic}{ZIGBEE2MQTT_AVAILABILITY_SUFFIX}")
+
+
+def _payload_error(raw_payload):
+    """Describe why a payload cannot be decoded."""
     try:
         if not isinstance(raw_payload, str):
             raw_payload = raw_payload.decode(json.detect_encoding(raw_payload))
-    except UnicodeDecodeError as err:
-        LOG.debug('encountered undecodable payload: "%s" (%s)', raw_payload, err)
-        return None, None
+        json.loads(raw_payload)
+    except (UnicodeDecodeError, json.JSONDecodeError) as error:
+        return str(error)
+    return ""
 
-    if raw_payload in settings.STATE_VALUES:
-        payload = settings.STATE_VALUES[raw_payload]
-    else:
+
+def _payload_fingerprint(msg):
+    """Hash the raw payload of a message."""
+    return hash(msg.payload)
+
+
+def _payload_fingerprint_v5(msg):
+    """Hash the raw payload and MQTTv5 user properties of a message."""
+    if hasattr(msg.properties, "UserProperty"):
+        return hash((msg.payload, tuple(msg.properties.UserProperty)))
+    return hash(msg.payload)
+
+
+def _replay_dedup_entry(entry):
+    """Account for a payload identical to the previous one without parsing it again."""
+    dedup_stats["hit"] += 1
+    prom_dedup_counter.labels(result="hit").inc()
+
+    # no counter when the previous identical payload was rejected, or topic counters are disabled
+    if entry.msg_counter is not None:
+        entry.msg_counter.inc()
+    if entry.last_seen:
+        now = int(time.time())
+        for last_seen in entry.last_seen:
+            last_seen.set(now)
+
+
+@dataclass(frozen=True)
+class PipelineConfig:
+    """Immutable snapshot of the settings used to process messages."""
+
+    prefix: str = "mqtt_"
+    topic_label: str = "topic"
+    ignored_topics: tuple = ()
+    ignored_topics_cache_size: int = 10000
+    zwave_topic_prefix: str = "zwave/"
+    meshtastic_topic_prefix: str = "msh/"
+    esphome_topic_prefixes: tuple = ()
+    hubitat_topic_prefixes: tuple = ("hubitat/",)
+    keep_full_topic: bool = False
+    zigbee2mqtt_availability: bool = False
+    state_values: tuple = ()
+    parse_msg_payload: bool = True
+    expose_last_seen: bool = False
+    expose_client_id: bool = False
+    mqtt_v5_protocol: bool = False
+    log_mqtt_message: bool = False
+    max_metrics: int = 2000
+    dedup_cache_size: int = 0
+    expose_broker: bool = False
+    subscription_identifiers: bool = False
+    topic_message_counter: bool = True
+    track_top_topics: bool = False
+    limit_label_cardinality: bool = False
+    rate_limits: tuple = ()
+    value_cache_size: int = 10000
+    parse_units: bool = False
+    offload: bool = False
+    ingest_threads: int = 0
+    output_sinks: bool = False
+    detect_counters: bool = False
+    derived_metrics: tuple = ()
+    dead_letters: bool = False
+    array_modes: tuple = ()
+    memory_limit: int = 0
+    catch_up: bool = False
+    admin_api: bool = False
+    config_reload: bool = False
+
+    @property
+    def concurrent(self):
+        """True if messages are processed by several threads (brokers, ingestion, offload...)."""
+        return (
+            self.ingest_threads > 0
+            or self.expose_broker
+            or self.offload
+            # the coalesced messages are processed by their own thread
+            or any(policy.kind == COALESCE for _, policy in self.rate_limits)
+            # the memory budget shrinks and clears the caches from its own thread
+            or self.memory_limit > 0
+            # the backlog of the persistent sessions is processed by the catch-up thread
+            or self.catch_up
+            # the series deleted by the HTTP server or reload thread are removed from the caches
+            or self.admin_api
+            or self.config_reload
+        )
+
+    @classmethod
+    def from_settings(cls, **overrides):
+        """Snapshot the current settings, with optional overrides of the fields."""
+        config = cls(
+            prefix=settings.PREFIX,
+            topic_label=settings.TOPIC_LABEL,
+            ignored_topics=tuple(topic for topic in settings.IGNORED_TOPICS if topic),
+            ignored_topics_cache_size=settings.IGNORED_TOPICS_CACHE_SIZE,
+            zwave_topic_prefix=settings.ZWAVE_TOPIC_PREFIX,
+            meshtastic_topic_prefix=settings.MESHTASTIC_TOPIC_PREFIX,
+            esphome_topic_prefixes=tuple(settings.ESPHOME_TOPIC_PREFIXES),
+            hubitat_topic_prefixes=tuple(settings.HUBITAT_TOPIC_PREFIXES),
+            keep_full_topic=settings.KEEP_FULL_TOPIC,
+            zigbee2mqtt_availability=settings.ZIGBEE2MQTT_AVAILABILITY,
+            state_values=tuple(settings.STATE_VALUES.items()),
+            parse_msg_payload=settings.PARSE_MSG_PAYLOAD,
+            expose_last_seen=settings.EXPOSE_LAST_SEEN,
+            expose_client_id=settings.MQTT_EXPOSE_CLIENT_ID,
+            mqtt_v5_protocol=settings.MQTT_V5_PROTOCOL,
+            log_mqtt_message=settings.LOG_MQTT_MESSAGE,
+            max_metrics=settings.MAX_METRICS,
+            dedup_cache_size=settings.DEDUP_CACHE_SIZE,
+            subscription_identifiers=settings.MQTT_SUBSCRIPTION_IDENTIFIERS,
+            topic_message_counter=settings.EXPOSE_TOPIC_MESSAGE_COUNTER,
+            track_top_topics=settings.TOP_TOPICS_CAPACITY > 0,
+            limit_label_cardinality=settings.LABEL_CARDINALITY_ENABLED,
+            rate_limits=parse_rate_limits(settings.RATE_LIMITS),
+            value_cache_size=settings.VALUE_CACHE_SIZE,
+            parse_units=settings.PARSE_UNITS,
+            offload=settings.OFFLOAD_WORKERS > 0,
+            ingest_threads=settings.INGEST_THREADS,
+            output_sinks=bool(settings.OUTPUT_SINKS),
+            detect_counters=any(settings.COUNTER_METRICS) or settings.COUNTER_LEARNING_SAMPLES > 0,
+            derived_metrics=parse_derived_metrics(settings.DERIVED_METRICS),
+            dead_letters=settings.DEAD_LETTER_SIZE > 0,
+            array_modes=parse_array_modes(settings.ARRAY_METRICS),
+            memory_limit=parse_size(settings.MEMORY_LIMIT),
+            catch_up=settings.MQTT_PERSISTENT_SESSION,
+            admin_api=settings.ADMIN_API,
+            config_reload=bool(settings.CONFIG_FILE),
+        )
+        return replace(config, **overrides) if overrides else config
+
+
+class MessagePipeline:
+    """Message processing engine compiled once from a `PipelineConfig`.
+
+    Each stage is specialised when the pipeline is built, so features which are
+    disabled are not evaluated for each message:
+    - ignore filter: `is_ignored(topic)`, None when no topic is ignored
+    - decoder: `decode(raw_payload)`
+    - router: `route(raw_topic, payload)`, normalizes integration specific formats,
+      or `routes_by_id` when the route is given by the MQTTv5 subscription identifier
+    - flattener: `parse_metrics(...)`, walks the payload to extract the samples
+    - sink: `add_sample(...)`, exposes the samples to Prometheus, refusing the new series
+      while the memory budget is exceeded
+    """
+
+    def __init__(self, config, rate_limiter=None):
+        """`rate_limiter` of the previous pipeline is reused if it has the same limits."""
+        self.config = config
+        self.state_values = dict(config.state_values)
+        self.base_label_names = (config.topic_label,)
+        if config.expose_client_id:
+            self.base_label_names += ("client_id",)
+        # the caches are only locked when they are shared by several threads
+        cache_type = LockedLRUCache if config.concurrent else LRUCache
+        self.metric_ids = cache_type(METRIC_ID_CACHE_SIZE)
+        self.value_cache = None
+        if config.value_cache_size > 0:
+            self.value_cache = cache_type(config.value_cache_size)
+        self._parse_value = self._build_value_parser()
+        self.label_limiter = label_cardinality if config.limit_label_cardinality else None
+        self.counters = counter_detector if config.detect_counters else None
+        self.memory = memory_budget if config.memory_limit > 0 else None
+        self.derived = None
+        if config.derived_metrics:
+            self.derived = DerivedMetrics(config.derived_metrics)
+        self.dedup_cache = None
+        if config.dedup_cache_size > 0:
+            self.dedup_cache = cache_type(config.dedup_cache_size)
+
+        self.ignore_matcher = None
+        if config.ignored_topics:
+            self.ignore_matcher = TopicMatcher(
+                config.ignored_topics, config.ignored_topics_cache_size, config.concurrent
+            )
+        self.is_ignored = self._build_ignore_filter()
+        self.array_modes = dict(config.array_modes)
+        self.array_matcher = None
+        if config.array_modes:
+            self.array_matcher = TopicMatcher(
+                [pattern for pattern, _ in config.array_modes], thread_safe=config.concurrent
+            )
+        self.rate_limiter = self._build_rate_limiter(rate_limiter)
+        self.decode = self._build_decoder()
+        self.routes = self._build_routes()
+        self.route = self._build_router()
+        self.routes_by_id = self._build_routes_by_id()
+        self.base_label_values = self._build_base_label_values()
+        self.add_sample = self._build_sink()
+        self.on_message = self._build_on_message()
+
+    def caches(self):
+        """Caches of the pipeline, shrunk by the memory budget."""
+        matchers = (self.ignore_matcher, self.array_matcher)
+        caches = (
+            self.metric_ids,
+            self.value_cache,
+            self.dedup_cache,
+            *(matcher.cache for matcher in matchers if matcher is not None),
+        )
+        return [cache for cache in caches if cache is not None]
+
+    def _build_ignore_filter(self):
+        matcher = self.ignore_matcher
+        if matcher is None:
+            return None
+
+        counters = {}
+        if prom_ignored_counter is not None:
+            counters = {
+                pattern: prom_ignored_counter.labels(pattern) for pattern in matcher.patterns
+            }
+
+        def is_ignored(topic):
+            ignore = matcher.match(topic)
+            if ignore is None:
+                return False
+
+            LOG.debug('Topic "%s" was ignored by entry "%s"', topic, ignore)
+            counter = counters.get(ignore)
+            if counter is not None:
+                counter.inc()
+            return True
+
+        return is_ignored
+
+    def _build_rate_limiter(self, previous=None):
+        if not self.config.rate_limits:
+            return None
+        if (
+            previous is not None
+            and previous.limits == self.config.rate_limits
+            and previous.thread_safe == self.config.concurrent
+        ):
+            # keeps the state of the topics and the coalesced messages across rebuilds
+            return previous
+
+        counters = {}
+        if prom_suppressed_counter is not None:
+            counters = {
+                pattern: prom_suppressed_counter.labels(pattern)
+                for pattern, _ in self.config.rate_limits
+            }
+
+        def on_suppressed(pattern):
+            counter = counters.get(pattern)
+            if counter is not None:
+                counter.inc()
+
+        return RateLimiter(self.config.rate_limits, on_suppressed, self.config.concurrent)
+
+    def _build_decoder(self):
+        state_values = self.state_values
+
+        def decode(raw_payload):
+            try:
+                if not isinstance(raw_payload, str):
+                    raw_payload = raw_payload.decode(json.detect_encoding(raw_payload))
+            except UnicodeDecodeError as err:
+                LOG.debug('encountered undecodable payload: "%s" (%s)', raw_payload, err)
+                return _REJECTED
+
+            if raw_payload in state_values:
+                return state_values[raw_payload]
+
+            try:
+                return json.loads(raw_payload)
+            except json.JSONDecodeError as err:
+                LOG.debug('failed to parse payload as JSON: "%s" (%s)', raw_payload, err)
+                return _REJECTED
+
+        return decode
+
+    def _build_routes(self):
+        """List the integration specific formats, by order of precedence."""
+        config = self.config
+        routes = [
+            (config.zwave_topic_prefix, _normalize_zwave2mqtt_format),
+            (config.meshtastic_topic_prefix, _normalize_meshtastic_format),
+        ]
+        routes.extend(
+            (prefix, _normalize_hubitat_format)
+            for prefix in config.hubitat_topic_prefixes
+            if prefix
+        )
+        routes.extend(
+            (prefix, _normalize_esphome_format)
+            for prefix in config.esphome_topic_prefixes
+            if prefix
+        )
+        return tuple(routes)
+
+    def _with_availability(self, route):
+        if not self.config.zigbee2mqtt_availability:
+            return route
+
+        def route_with_availability(raw_topic, payload):
+            topic, payload = route(raw_topic, payload)
+
+            # handle device availability (only support non-legacy mode)
+            if topic.endswith(ZIGBEE2MQTT_AVAILABILITY_SUFFIX) and "state" in payload:
+                # move availability suffix added by Zigbee2MQTT from topic to payload
+                # the goal is to have this kind of metric:
+                #   mqtt_zigbee_availability{sensor="zigbee2mqtt_garage"} = 1.0
+                topic = topic[: -len(ZIGBEE2MQTT_AVAILABILITY_SUFFIX)]
+                payload = {"zigbee_availability": payload["state"]}
+
+            return topic, payload
+
+        return route_with_availability
+
+    def _build_router(self):
+        routes = self.routes
+        prefixes = tuple(prefix for prefix, _ in routes)
+        keep_full_topic = self.config.keep_full_topic
+
+        def route(raw_topic, payload):
+            if raw_topic.startswith(prefixes):
+                for prefix, normalize in routes:
+                    if raw_topic.startswith(prefix):
+                        return normalize(raw_topic, payload)
+
+            if not isinstance(payload, dict):
+                return _normalize_name_in_topic_msg(raw_topic, payload, keep_full_topic)
+
+            return raw_topic, payload
+
+        return self._with_availability(route)
+
+    def _build_routes_by_id(self):
+        """Map MQTTv5 subscription identifiers to the route of their integration."""
+        if not self.config.subscription_identifiers:
+            return None
+
+        return {
+            FIRST_ROUTE_SUBSCRIPTION_ID + index: self._with_availability(normalize)
+            for index, (_, normalize) in enumerate(self.routes)
+        }
+
+    def subscriptions(self, topics):
+        """Group the topics to subscribe to by MQTTv5 subscription identifier.
+
+        A topic only gets the identifier of an integration when all its messages would be routed
+        to this integration by prefix matching, otherwise it gets the generic identifier.
+        """
+        subscriptions = defaultdict(list)
+        for topic in topics:
+            # part of the topic filter which is the same for all matching topics
+            head = re.split(r"[+#]", topic, maxsplit=1)[0]
+            subscription_id = GENERIC_SUBSCRIPTION_ID
+            for index, (prefix, _) in enumerate(self.routes):
+                if head.startswith(prefix):
+                    subscription_id = FIRST_ROUTE_SUBSCRIPTION_ID + index
+                    break
+                if prefix.startswith(head):
+                    # only some of the matching topics belong to this integration
+                    break
+            subscriptions[subscription_id].append(topic)
+
+        return dict(subscriptions)
+
+    def _build_base_label_values(self):
+        if self.config.expose_client_id:
+
+            def base_label_values(topic, client_id):
+                return (topic, client_id)
+
+        else:
+
+            def base_label_values(topic, _client_id):
+                return (topic,)
+
+        return base_label_values
+
+    def _build_sink(self):
+        base_label_values = self.base_label_values
+        counters = self.counters
+
+        def series_label_values(topic, prom_metric_id, client_id, additional_labels):
+            label_values = base_label_values(topic, client_id)
+            if prom_metric_id.labels:
+                label_values += tuple(additional_labels[key] for key in prom_metric_id.labels)
+            return label_values
+
+        def add_sample(
+            topic, original_topic, prom_metric_id, metric_value, client_id, additional_labels
+        ):
+            gauge = prom_metrics.get(prom_metric_id)
+            if gauge is None:
+                return None
+
+            label_values = series_label_values(topic, prom_metric_id, client_id, additional_labels)
+            series = gauge.labels(*label_values)
+            if counters is None or not counters.update(prom_metric_id, series, metric_value):
+                series.set(metric_value)
+            # pylama: ignore=W0212
+            # reference the label values tuple of the series instead of keeping a copy
+            metric_refs.add(original_topic, (prom_metric_id, series._labelvalues))
+
+            LOG.debug("new value for %s: %s", prom_metric_id, metric_value)
+            return None
+
+        if not self.config.expose_last_seen:
+            return self._with_output_sinks(
+                self._with_memory_budget(add_sample, series_label_values)
+            )
+
+        def add_sample_with_last_seen(
+            topic, original_topic, prom_metric_id, metric_value, client_id, additional_labels
+        ):
+            gauge = prom_metrics.get(prom_metric_id)
+            if gauge is None:
+                return None
+
+            label_values = series_label_values(topic, prom_metric_id, client_id, additional_labels)
+            series = gauge.labels(*label_values)
+            if counters is None or not counters.update(prom_metric_id, series, metric_value):
+                series.set(metric_value)
+
+            last_seen = prom_metrics[ts_metric_ids[prom_metric_id]].labels(*label_values)
+            last_seen.set(int(time.time()))
+            metric_refs.add(original_topic, (prom_metric_id, series._labelvalues))
+
+            LOG.debug("new value for %s: %s", prom_metric_id, metric_value)
+            return last_seen
+
+        return self._with_output_sinks(
+            self._with_memory_budget(add_sample_with_last_seen, series_label_values)
+        )
+
+    def _with_memory_budget(self, add_sample, series_label_values):
+        """Record the topics updated, and refuse the samples of new series while over budget."""
+        budget = self.memory
+        if budget is None:
+            return add_sample
+
+        def add_sample_within_budget(
+            topic, original_topic, prom_metric_id, metric_value, client_id, additional_labels
+        ):
+            budget.note(original_topic)
+            if budget.refuse_series:
+                gauge = prom_metrics.get(prom_metric_id)
+                label_values = series_label_values(
+                    topic, prom_metric_id, client_id, additional_labels
+                )
+                # pylama: ignore=W0212
+                if gauge is not None and label_values not in gauge._metrics:
+                    LOG.debug("memory limit reached: new series of %s refused", prom_metric_id)
+                    if budget.on_refused is not None:
+                        budget.on_refused()
+                    return None
+            return add_sample(
+                topic, original_topic, prom_metric_id, metric_value, client_id, additional_labels
+            )
+
+        return add_sample_within_budget
+
+    def _with_output_sinks(self, add_sample):
+        """Send the samples to the output sinks too, labelled like the Prometheus series."""
+        sinks = tuple(output_sinks) if self.config.output_sinks else ()
+        if not sinks:
+            return add_sample
+
+        base_label_names = self.base_label_names
+        base_label_values = self.base_label_values
+
+        def add_sample_to_sinks(
+            topic, original_topic, prom_metric_id, metric_value, client_id, additional_labels
+        ):
+            labels = tuple(
+                zip(base_label_names, base_label_values(topic, client_id), strict=True)
+            ) + tuple((key, additional_labels[key]) for key in prom_metric_id.labels)
+            timestamp = time.time_ns()
+            for sink in sinks:
+                sink.add(prom_metric_id.name, labels, metric_value, timestamp)
+            return add_sample(
+                topic, original_topic, prom_metric_id, metric_value, client_id, additional_labels
+            )
+
+        return add_sample_to_sinks
+
+    def _build_on_message(self):
+        config = self.config
+        is_ignored = self.is_ignored
+        parse_message = self.parse_message
+        flatten = self.flatten if config.parse_msg_payload else None
+        array_mode = self.array_mode if self.array_matcher is not None else None
+        apply_samples = self.apply_samples
+        parse_properties = _parse_properties if config.mqtt_v5_protocol else None
+        base_label_values = self.base_label_values
+        log_mqtt_message = config.log_mqtt_message
+        expose_last_seen = config.expose_last_seen
+        dedup_cache = self.dedup_cache
+        memory = self.memory
+        fingerprint = _payload_fingerprint_v5 if config.mqtt_v5_protocol else _payload_fingerprint
+        expose_broker = config.expose_broker
+        routes_by_id = self.routes_by_id
+        route_for = self.route_for
+        topic_message_counter = config.topic_message_counter
+        offload = offloader if config.offload else None
+        rejections = dead_letters if config.dead_letters else None
+        # identical payloads still update the rates computed from them
+        rate_topics = None
+        if self.derived is not None and self.derived.rate_inputs:
+            rate_topics = self.derived.rate_topics
+
+        def reject(msg, reason):
+            """Record a message which could not be parsed."""
+            # the error is only described for the messages recorded
+            detail = partial(_payload_error, msg.payload) if reason == INVALID_PAYLOAD else ""
+            rejections.add(msg.topic, msg.payload, reason, detail)
+
+        def complete(userdata, msg, broker, entry, last_seen, result):
+            """Expose the samples of a parsed message, and count it."""
+            topic, samples = result
+            if not topic:
+                return
+
+            if samples is not None:
+                additional_labels = parse_properties(msg.properties) if parse_properties else {}
+                if expose_broker:
+                    additional_labels["broker"] = broker
+                apply_samples(
+                    samples,
+                    topic,
+                    msg.topic,
+                    userdata["client_id"],
+                    labels=additional_labels,
+                    last_seen=last_seen,
+                )
+
+            # increment received message counter
+            msg_counter = None
+            if topic_message_counter:
+                counter_label_values = base_label_values(topic, userdata["client_id"])
+                if expose_broker:
+                    counter_label_values += (broker,)
+                msg_counter = prom_msg_counter.labels(*counter_label_values)
+                msg_counter.inc()
+
+            if entry is not None:
+                entry.msg_counter = msg_counter
+                entry.last_seen = tuple(last_seen or ())
+
+        def complete_offloaded(userdata, msg, broker, entry, dedup_key, last_seen, result):
+            topic, samples, rejected = result
+            if entry is not None:
+                dedup_cache[dedup_key] = entry
+            complete(userdata, msg, broker, entry, last_seen, (topic, samples))
+            if rejections is not None and rejected:
+                if topic:
+                    rejections.add(msg.topic, msg.payload, NOT_A_NUMBER, ", ".join(rejected))
+                else:
+                    reject(msg, rejected[0])
+
+        def on_message(_, userdata, msg):
+            raw_topic = msg.topic
+            if raw_topic.startswith("zigbee2mqtt/") and raw_topic.endswith("/rename"):
+                self.rename(msg)
+                return
+
+            if is_ignored is not None and is_ignored(raw_topic):
+                return
+
+            broker = userdata["broker"].name if expose_broker else None
+
+            entry = None
+            dedup_key = None
+            last_seen = None
+            # while new series are refused, the payloads are parsed to retry their samples
+            if dedup_cache is not None and (memory is None or not memory.refuse_series):
+                dedup_key = (broker, raw_topic) if expose_broker else raw_topic
+                payload_fingerprint = fingerprint(msg)
+                entry = dedup_cache.get(dedup_key)
+                if (
+                    entry is not None
+                    and entry.fingerprint == payload_fingerprint
+                    and (rate_topics is None or raw_topic not in rate_topics)
+                ):
+                    _replay_dedup_entry(entry)
+                    if memory is not None:
+                        memory.note(raw_topic)
+                    return
+                dedup_stats["miss"] += 1
+                prom_dedup_counter.labels(result="miss").inc()
+                entry = DedupEntry(payload_fingerprint)
+                dedup_cache[dedup_key] = entry
+                if expose_last_seen:
+                    last_seen = []
+
+            if log_mqtt_message:
+                LOG.debug("New message from MQTT: %s - %s", raw_topic, msg.payload)
+
+            subscription_ids = ()
+            if routes_by_id is not None:
+                subscription_ids = getattr(msg.properties, "SubscriptionIdentifier", ())
+
+            size = len(msg.payload)
+            if offload is not None and offload.should_offload(raw_topic, size):
+                if entry is not None:
+                    # cached again once parsed, identical payloads are parsed in the meantime
+                    dedup_cache.pop(dedup_key)
+                offload.submit(
+                    raw_topic,
+                    size,
+                    _offloaded_parse,
+                    (config, raw_topic, msg.payload, tuple(subscription_ids)),
+                    partial(complete_offloaded, userdata, msg, broker, entry, dedup_key, last_seen),
+                )
+                return
+
+            route = route_for(subscription_ids) if subscription_ids else None
+            rejected = [] if rejections is not None else None
+            topic, payload = parse_message(raw_topic, msg.payload, route, rejected)
+
+            if not topic or not payload:
+                if rejected:
+                    reject(msg, rejected[0])
+                return
+
+            arrays = array_mode(raw_topic) if array_mode is not None else None
+            if rejections is None or flatten is None:
+                samples = flatten(payload, "", None, arrays) if flatten is not None else None
+                complete(userdata, msg, broker, entry, last_seen, (topic, samples))
+                return
+
+            samples = flatten(payload, "", rejected, arrays)
+            complete(userdata, msg, broker, entry, last_seen, (topic, samples))
+            if rejected:
+                rejections.add(raw_topic, msg.payload, NOT_A_NUMBER, ", ".join(rejected))
+
+        # rate limited messages are dropped before being parsed
+        self.process_message = on_message
+        rate_limiter = self.rate_limiter
+        if rate_limiter is not None:
+
+            def on_message_rate_limited(client, userdata, msg):
+                if rate_limiter.check(msg.topic, (client, userdata, msg), time.monotonic()):
+                    self.process_message(client, userdata, msg)
+
+            on_message = on_message_rate_limited
+
+        stats = topic_stats if config.track_top_topics else None
+        if stats is None:
+            return on_message
+
+        def on_message_with_stats(client, userdata, msg):
+            start = time.perf_counter()
+            on_message(client, userdata, msg)
+            stats.record(msg.topic, len(msg.payload), time.perf_counter() - start)
+
+        return on_message_with_stats
+
+    def route_for(self, subscription_ids):
+        """Route of a message given by its MQTTv5 subscription identifiers, None if unknown."""
+        for subscription_id in subscription_ids:
+            route = self.routes_by_id.get(subscription_id)
+            if route is not None:
+                return route
+        return None
+
+    def flush_coalesced(self):
+        """Process the latest coalesced message of each topic, when due."""
+        if self.rate_limiter is None:
+            return
+
+        for client, userdata, msg in self.rate_limiter.flush(time.monotonic()):
+            self.process_message(client, userdata, msg)
+
+    def parse_value(self, data):
+        """Attempt to parse the value and extract a number out of it.
+
+        Note that `data` is untrusted input at this point.
+
+        Raise ValueError is the data can't be parsed.
+        """
+        value = self._parse_value(data)
+        if value is _REJECTED:
+            raise ValueError(f"Can't parse '{data}' to a number.")
+        return value
+
+    def _build_value_parser(self):
+        state_values = self.state_values
+        value_cache = self.value_cache
+        number_with_unit = _NUMBER_WITH_UNIT if self.config.parse_units else None
+
+        def parse_string(data):
+            data = data.upper()
+
+            # Handling of switch data where their state is reported as ON/OFF
+            if data in state_values:
+                return state_values[data]
+
+            if number_with_unit is not None:
+                match = number_with_unit.fullmatch(data)
+                if match is not None:
+                    return float(match.group(1))
+
+            # Last ditch effort, we got a string, let's try to cast it
+            try:
+                return float(data)
+            except ValueError:
+                return _REJECTED
+
+        def parse_value(data):
+            """Return the parsed value, or _REJECTED."""
+            if isinstance(data, (int, float)):
+                return data
+
+            if isinstance(data, bytes):
+                data = data.decode()
+
+            # We were not able to extract anything
+            if not isinstance(data, str):
+                return _REJECTED
+
+            if value_cache is None:
+                return parse_string(data)
+
+            # the parsing result of recurring strings (states, units...) is cached, rejects included
+            value = value_cache.get(data)
+            if value is None:
+                value = parse_string(data)
+                value_cache[data] = value
+            return value
+
+        return parse_value
+
+    def create_metric(self, prom_metric_id, original_topic):
+        """Create Prometheus metric if does not exist, return its gauge."""
+        # the metric is used by other threads once complete, i.e. with its last seen gauge
+        gauge = prom_metrics.get(prom_metric_id)
+        if gauge is not None and (
+            not self.config.expose_last_seen or prom_metric_id in ts_metric_ids
+        ):
+            return gauge
+
+        # messages are processed concurrently by several brokers or ingestion threads
+        with _create_metric_lock:
+            gauge = prom_metrics.get(prom_metric_id)
+            if gauge is None:
+                gauge = self._create_metric(prom_metric_id)
+        return gauge
+
+    def _create_metric(self, prom_metric_id):
+        max_metrics = self.config.max_metrics
+        if max_metrics > 0 and len(prom_metrics) >= max_metrics:
+            raise MaximumMetricReached(
+                f"metric limit reached ({max_metrics}): cannot create new metric {prom_metric_id}"
+            )
+        if self.memory is not None and self.memory.refuse_series:
+            raise MaximumMetricReached(
+                f"memory limit reached: cannot create new metric {prom_metric_id}"
+            )
+
+        labels = [*self.base_label_names, *prom_metric_id.labels]
+
+        if self.counters is not None and self.counters.is_counter(prom_metric_id.name):
+            gauge = ValueCounter(
+                prom_metric_id.name, "counter generated from MQTT message.", labels
+            )
+            self.counters.counters.add(prom_metric_id)
+        else:
+            gauge = Gauge(prom_metric_id.name, "metric generated from MQTT message.", labels)
+        prom_metrics[prom_metric_id] = gauge
+
+        if self.config.expose_last_seen:
+            ts_metric_id = PromMetricId(f"{prom_metric_id.name}_ts", prom_metric_id.labels)
+            prom_metrics[ts_metric_id] = Gauge(
+                ts_metric_id.name, "timestamp of metric generated from MQTT message.", labels
+            )
+            ts_metric_ids[prom_metric_id] = ts_metric_id
+
+        LOG.info("creating prometheus metric: %s", prom_metric_id)
+        return gauge
+
+    def array_mode(self, raw_topic):
+        """Mode of the numeric arrays of a topic (index or stats), None if not configured."""
+        pattern = self.array_matcher.match(raw_topic)
+        return self.array_modes[pattern] if pattern is not None else None
+
+    def flatten(self, data, prefix="", rejected=None, arrays=None):
+        """Yield (prefix, field, value) for each number of a payload, walking nested values.
+
+        When `rejected` is a list, the fields which are not numbers are appended. With an
+        `arrays` mode, the numeric arrays are converted at once (see arrays.py).
+        """
+        parse_value = self._parse_value
+        for metric, value in data.items():
+            # when value is a list recursively flatten it to handle these messages
+            if isinstance(value, list):
+                if arrays is not None:
+                    numbers = to_numbers(value)
+                    if numbers is not None:
+                        yield from array_samples(prefix, metric, numbers, arrays)
+                        continue
+                LOG.debug("parsing list %s: %s", metric, value)
+                yield from self.flatten(
+                    dict(enumerate(value)), f"{prefix}{metric}_", rejected, arrays
+                )
+                continue
+
+            # when value is a dict recursively flatten it to handle these messages
+            if isinstance(value, dict):
+                LOG.debug("parsing dict %s: %s", metric, value)
+                yield from self.flatten(value, f"{prefix}{metric}_", rejected, arrays)
+                continue
+
+            metric_value = parse_value(value)
+            if metric_value is _REJECTED:
+                LOG.debug("Failed to convert %s: can't parse '%s' to a number.", metric, value)
+                if rejected is not None:
+                    rejected.append(f"{prefix}{metric}")
+                continue
+
+            yield prefix, metric, metric_value
+
+    def parse_metrics(
+        self, data, topic, original_topic, client_id, prefix="", labels=None, last_seen=None
+    ):
+        """Attempt to parse a set of metrics.
+
+        When `last_seen` is a list, the last seen timestamp gauges which were updated are appended.
+        """
+        self.apply_samples(
+            self.flatten(data, prefix), topic, original_topic, client_id, labels, last_seen
+        )
+
+    def apply_samples(self, samples, topic, original_topic, client_id, labels=None, last_seen=None):
+        """Expose samples (prefix, field, value), creating their metrics if needed."""
+        if labels is None:
+            labels = {}
+        label_keys = _shared_label_keys(labels)
+        metric_ids = self.metric_ids
+        label_limiter = self.label_limiter
+        derived = self.derived
+        derived_inputs = {} if derived is not None else None
+        indexed_arrays = self.array_matcher is not None
+
+        for prefix, metric, metric_value in samples:
+            if indexed_arrays and type(metric_value) is ArrayValues:
+                if not self._apply_array(
+                    prefix,
+                    metric,
+                    metric_value,
+                    topic,
+                    original_topic,
+                    client_id,
+                    labels,
+                    last_seen,
+                ):
+                    return
+                continue
+
+            # create metric if does not exist
+            metric_key = (prefix, metric, label_keys)
+            prom_metric_id = metric_ids.get(metric_key)
+            if prom_metric_id is None:
+                prom_metric_id = self._metric_id(prefix, metric, label_keys)
+                metric_ids[metric_key] = prom_metric_id
+            try:
+                self.create_metric(prom_metric_id, original_topic)
+            except (ValueError, MaximumMetricReached) as error:
+                LOG.error("unable to create prometheus metric '%s': %s", prom_metric_id, error)
+                return
+
+            sample_labels = labels
+            if label_limiter is not None and labels:
+                sample_labels = label_limiter.check(prom_metric_id.name, labels)
+
+            # expose the sample to prometheus
+            ts_gauge = self.add_sample(
+                topic, original_topic, prom_metric_id, metric_value, client_id, sample_labels
+            )
+            if ts_gauge is not None and last_seen is not None:
+                last_seen.append(ts_gauge)
+            if derived_inputs is not None and prom_metric_id.name in derived.inputs:
+                derived_inputs[prom_metric_id.name] = metric_value
+
+        if derived_inputs:
+            # the same topic can be published on several brokers
+            broker = labels.get("broker") if self.config.expose_broker else None
+            derived_samples = derived.update(
+                original_topic, derived_inputs, time.monotonic(), broker
+            )
+            derived_labels = {"broker": broker} if broker is not None else {}
+            self._apply_derived(
+                derived_samples, topic, original_topic, client_id, derived_labels, last_seen
+            )
+
+    def _apply_array(
+        self, prefix, metric, values, topic, original_topic, client_id, labels, last_seen
+    ):
+        """Expose the values of a numeric array as one metric, labelled with their index."""
+        index_labels = {**labels, INDEX_LABEL: ""}
+        metric_key = (prefix, metric, _shared_label_keys(index_labels))
+        prom_metric_id = self.metric_ids.get(metric_key)
+        if prom_metric_id is None:
+            prom_metric_id = self._metric_id(prefix, metric, metric_key[2])
+            self.metric_ids[metric_key] = prom_metric_id
         try:
-            payload = json.loads(raw_payload)
-        except json.JSONDecodeError as err:
-            LOG.debug('failed to parse payload as JSON: "%s" (%s)', raw_payload, err)
+            self.create_metric(prom_metric_id, original_topic)
+        except (ValueError, MaximumMetricReached) as error:
+            LOG.error("unable to create prometheus metric '%s': %s", prom_metric_id, error)
+            return False
+
+        # the labels are only read by add_sample, the same dict is updated for each value
+        add_sample = self.add_sample
+        for index, value in enumerate(values):
+            index_labels[INDEX_LABEL] = str(index)
+            ts_gauge = add_sample(
+                topic, original_topic, prom_metric_id, value, client_id, index_labels
+            )
+            if ts_gauge is not None and last_seen is not None:
+                last_seen.append(ts_gauge)
+        return True
+
+    def _apply_derived(self, derived_samples, topic, original_topic, client_id, labels, last_seen):
+        """Expose the derived metrics updated, labelled with the topic (and broker) only."""
+        label_keys = _shared_label_keys(labels)
+        for name, metric_value in derived_samples:
+            prom_metric_id = PromMetricId(name, label_keys)
+            try:
+                self.create_metric(prom_metric_id, original_topic)
+            except (ValueError, MaximumMetricReached) as error:
+                LOG.error("unable to create derived metric '%s': %s", name, error)
+                continue
+
+            ts_gauge = self.add_sample(
+                topic, original_topic, prom_metric_id, metric_value, client_id, labels
+            )
+            if ts_gauge is not None and last_seen is not None:
+                last_seen.append(ts_gauge)
+
+    def _metric_id(self, prefix, metric, label_keys):
+        prom_metric_name = (
+            f"{self.config.prefix}{prefix}{metric}".replace(".", "")
+            .replace(" ", "_")
+            .replace("-", "_")
+            .replace("/", "_")
+        )
+        prom_metric_name = re.sub(r"\((.*?)\)", "", prom_metric_name)
+        prom_metric_name = _normalize_prometheus_metric_name(prom_metric_name)
+        return PromMetricId(sys.intern(prom_metric_name), label_keys)
+
+    def parse_message(self, raw_topic, raw_payload, route=None, rejected=None):
+        """Parse topic and payload to have exposable information.
+
+        `route` normalizes the integration specific format, found by prefix matching by default.
+        The reason of a rejected message is appended to `rejected`.
+        """
+        payload = self.decode(raw_payload)
+        if payload is _REJECTED:
+            if rejected is not None:
+                rejected.append(INVALID_PAYLOAD)
             return None, None
 
-    if raw_topic.startswith(settings.ZWAVE_TOPIC_PREFIX):
-        topic, payload = _normalize_zwave2mqtt_format(raw_topic, payload)
-    elif raw_topic.startswith(settings.MESHTASTIC_TOPIC_PREFIX):
-        topic, payload = _normalize_meshtastic_format(raw_topic, payload)
-    elif _is_hubitat_topic(raw_topic):
-        topic, payload = _normalize_hubitat_format(raw_topic, payload)
-    elif _is_esphome_topic(raw_topic):
-        topic, payload = _normalize_esphome_format(raw_topic, payload)
-    elif not isinstance(payload, dict):
-        topic, payload = _normalize_name_in_topic_msg(raw_topic, payload)
-    else:
-        topic = raw_topic
-
-    # handle device availability (only support non-legacy mode)
-    if settings.ZIGBEE2MQTT_AVAILABILITY:
-        if topic.endswith(ZIGBEE2MQTT_AVAILABILITY_SUFFIX) and "state" in payload:
-            # move availability suffix added by Zigbee2MQTT from topic to payload
-            # the goal is to have this kind of metric:
-            #   mqtt_zigbee_availability{sensor="zigbee2mqtt_garage"} = 1.0
-            topic = topic[: -len(ZIGBEE2MQTT_AVAILABILITY_SUFFIX)]
-            payload = {"zigbee_availability": payload["state"]}
-
-    # parse MQTT topic
-    try:
-        # handle nested topic
-        topic = topic.replace("/", "_")
-    except UnicodeDecodeError:
-        LOG.debug('encountered undecodable topic: "%s"', raw_topic)
-        return None, None
+        topic, payload = (route or self.route)(raw_topic, payload)
 
-    # handle unconverted payload
-    if not isinstance(payload, dict):
-        LOG.debug('failed to parse: topic "%s" payload "%s"', raw_topic, payload)
-        return None, None
+        # handle nested topic, interned as it is used as label value by all the topic series
+        topic = sys.intern(topic.replace("/", "_"))
 
-    return topic, payload
+        # handle unconverted payload
+        if not isinstance(payload, dict):
+            LOG.debug('failed to parse: topic "%s" payload "%s"', raw_topic, payload)
+            if rejected is not None:
+                rejected.append(UNSUPPORTED_FORMAT)
+            return None, None
 
+        return topic, payload
 
-def _parse_properties(properties):
-    """Convert MQTTv5 properties to a dict."""
-    if not hasattr(properties, "UserProperty"):
-        return {}
+    def rename(self, msg):
+        """Remove the metrics of a device renamed in Zigbee2MQTT."""
+        _zigbee2mqtt_rename(msg, self.config.zigbee2mqtt_availability)
+        if self.dedup_cache is not None:
+            self.dedup_cache.clear()
+
+
+# pipelines of the process pool workers, for each configuration
+_worker_pipelines: dict[PipelineConfig, MessagePipeline] = {}
 
+
+def _offloaded_parse(config, raw_topic, raw_payload, subscription_ids):
+    """Parse a message in a worker process, return its topic, its samples and its rejections.
+
+    The rejections are the reason of a rejected message, or the fields which are not numbers.
+    """
+    pipeline = _worker_pipelines.get(config)
+    if pipeline is None:
+        pipeline = _worker_pipelines[config] = MessagePipeline(config)
+
+    route = pipeline.route_for(subscription_ids) if pipeline.routes_by_id else None
+    rejected = [] if config.dead_letters else None
+    topic, payload = pipeline.parse_message(raw_topic, raw_payload, route, rejected)
+    if not topic or not payload:
+        return None, None, rejected
+    if not config.parse_msg_payload:
+        return topic, None, rejected
+    arrays = pipeline.array_mode(raw_topic) if pipeline.array_matcher is not None else None
+    return topic, list(pipeline.flatten(payload, "", rejected, arrays)), rejected
+
+
+def build_pipeline(config=None):
+    """Build the message pipeline from `config` (default from settings) and activate it.
+
+    It can be called at runtime: the new pipeline replaces the previous one atomically.
+    """
+    global message_pipeline  # noqa: PLW0603
+    previous = message_pipeline.rate_limiter if message_pipeline is not None else None
+    pipeline = MessagePipeline(config or PipelineConfig.from_settings(), previous)
+    message_pipeline = pipeline
+    if previous is not None and pipeline.rate_limiter is not previous:
+        # the limits changed: the coalesced messages are processed now instead of being lost
+        for client, userdata, msg in previous.drain():
+            pipeline.process_message(client, userdata, msg)
+    return pipeline
+
+
+# settings read by PipelineConfig.from_settings, compared before parsing them again
+_PIPELINE_SETTINGS = (
+    "ADMIN_API",
+    "ARRAY_METRICS",
+    "COUNTER_LEARNING_SAMPLES",
+    "COUNTER_METRICS",
+    "CONFIG_FILE",
+    "DEAD_LETTER_SIZE",
+    "DEDUP_CACHE_SIZE",
+    "DERIVED_METRICS",
+    "ESPHOME_TOPIC_PREFIXES",
+    "EXPOSE_LAST_SEEN",
+    "EXPOSE_TOPIC_MESSAGE_COUNTER",
+    "HUBITAT_TOPIC_PREFIXES",
+    "IGNORED_TOPICS",
+    "IGNORED_TOPICS_CACHE_SIZE",
+    "INGEST_THREADS",
+    "KEEP_FULL_TOPIC",
+    "LABEL_CARDINALITY_ENABLED",
+    "LOG_MQTT_MESSAGE",
+    "MAX_METRICS",
+    "MEMORY_LIMIT",
+    "MESHTASTIC_TOPIC_PREFIX",
+    "MQTT_EXPOSE_CLIENT_ID",
+    "MQTT_PERSISTENT_SESSION",
+    "MQTT_SUBSCRIPTION_IDENTIFIERS",
+    "MQTT_V5_PROTOCOL",
+    "OFFLOAD_WORKERS",
+    "OUTPUT_SINKS",
+    "PARSE_MSG_PAYLOAD",
+    "PARSE_UNITS",
+    "PREFIX",
+    "RATE_LIMITS",
+    "STATE_VALUES",
+    "TOPIC_LABEL",
+    "TOP_TOPICS_CAPACITY",
+    "VALUE_CACHE_SIZE",
+    "ZIGBEE2MQTT_AVAILABILITY",
+    "ZWAVE_TOPIC_PREFIX",
+)
+_read_pipeline_settings = attrgetter(*_PIPELINE_SETTINGS)
+# pipeline built by _current_pipeline, and the settings values it was built from
+_settings_pipeline = None
+_settings_values: tuple = ()
+
+
+def _current_pipeline():
+    """Return the active pipeline, rebuilt first if the settings have changed since.
+
+    The raw settings values are compared first, they are only parsed again when they changed
+    or when the active pipeline was built from another configuration.
+    """
+    global _settings_pipeline, _settings_values  # noqa: PLW0603
+    values = _read_pipeline_settings(settings)
+    if message_pipeline is not None and message_pipeline is _settings_pipeline:
+        if values == _settings_values:
+            return message_pipeline
+
+    config = PipelineConfig.from_settings()
+    pipeline = message_pipeline
+    if pipeline is None or pipeline.config != config:
+        pipeline = build_pipeline(config)
+    # lists and dicts are copied, so their changes in place are detected too
+    _settings_values = tuple(
+        value.copy() if isinstance(value, (list, dict)) else value for value in values
+    )
+    _settings_pipeline = pipeline
+    return pipeline
+
+
+def _process_message(client, userdata, msg):
+    message_pipeline.on_message(client, userdata, msg)
+
+
+def _dispatch_message(client, userdata, msg):
+    """Process a message, or queue it for the ingestion threads (callback)."""
+    if ingest_workers is not None:
+        ingest_workers.submit(msg.topic, client, userdata, msg)
+        return
+    message_pipeline.on_message(client, userdata, msg)
+
+
+def _subscribed_topics():
+    return set(settings.TOPIC.split(","))
+
+
+def _broker_topics():
+    """Topics subscribed by brokers defining their own topics, not changed by a reload."""
     return {
-        _normalize_prometheus_metric_label_name(key): value
-        for key, value in properties.UserProperty
+        topic
+        for client in mqtt_clients
+        if client.user_data_get()["broker"].topic is not None
+        for topic in client.user_data_get()["broker"].topics
     }
 
 
-def _zigbee2mqtt_rename(msg):
-    # Remove old metrics following renaming
+def _prune_series(pipeline, topics):
+    """Remove the series and message counters of topics now ignored or not subscribed anymore."""
+    matcher = pipeline.ignore_matcher
+    pruned = [
+        original_topic
+        for original_topic in list(metric_refs)
+        if (matcher is not None and matcher.match(original_topic) is not None)
+        or not any(mqtt.topic_matches_sub(sub, original_topic) for sub in topics)
+    ]
+    return delete_series(pruned) if pruned else 0
 
-    payload = json.loads(msg.payload)
-    old_topic = f"zigbee2mqtt/{payload['data']['from']}"
-    if old_topic not in metric_refs:
+
+_reload_lock = threading.Lock()
+
+
+def reload_config():
+    """Reload the settings from CONFIG_FILE without restarting nor dropping existing series.
+
+    The new pipeline is built before replacing the active one, then only the changed
+    subscriptions are updated, and only the series excluded by the new settings are removed.
+    """
+    with _reload_lock:
+        start = time.perf_counter()
+        previous_topics = _subscribed_topics()
+        previous_routes = [prefix for prefix, _ in message_pipeline.routes]
+        previous_settings = settings.load_config_file(settings.CONFIG_FILE)
+        config = message_pipeline.config
+        try:
+            pipeline = build_pipeline(
+                PipelineConfig.from_settings(
+                    expose_broker=config.expose_broker, catch_up=config.catch_up
+                )
+            )
+        except Exception as error:
+            # the settings are only kept once the pipeline is built from them
+            vars(settings).update(previous_settings)
+            raise ValueError(f"invalid configuration: {error}") from error
+
+        topics = _subscribed_topics()
+        unsubscribed = sorted(previous_topics - topics)
+        subscribed = sorted(topics - previous_topics)
+        # subscription identifiers are given by the position of the routes
+        routes_changed = pipeline.routes_by_id is not None and previous_routes != [
+            prefix for prefix, _ in pipeline.routes
+        ]
+        for client in mqtt_clients:
+            broker = client.user_data_get()["broker"]
+            if routes_changed and broker.v5_protocol:
+                _subscribe_topics(client, broker, broker.topics)
+            if broker.topic is not None:
+                continue
+            if unsubscribed:
+                client.unsubscribe(unsubscribed)
+            if subscribed and not (routes_changed and broker.v5_protocol):
+                _subscribe_topics(client, broker, subscribed)
+
+        pruned = _prune_series(pipeline, topics | _broker_topics())
+        duration = time.perf_counter() - start
+        LOG.info("configuration reloaded in %.3fs, %d series removed", duration, pruned)
+
+    return {
+        "subscribed": subscribed,
+        "unsubscribed": unsubscribed,
+        "pruned_series": pruned,
+        "duration_seconds": duration,
+    }
+
+
+def _reload_endpoint(_environ):
+    try:
+        return 200, reload_config()
+    except (OSError, ValueError) as error:
+        LOG.error("failed to reload configuration: %s", error)
+        return 400, {"error": str(error)}
+    except Exception as error:
+        LOG.exception("failed to reload configuration")
+        return 500, {"error": str(error)}
+
+
+def _reload_request(signum, _frame):
+    """Reload handler for SIGHUP, the reload itself runs outside of the MQTT loop."""
+    LOG.info("SIGNAL %s received: reloading configuration", signum)
+    threading.Thread(target=_reload_endpoint, args=(None,), daemon=True).start()
+
+
+class _TopicSeries:
+    """Collector of the series of some topics, read from the series references."""
+
+    def __init__(self, topics):
+        self.topics = topics
+
+    def collect(self):
+        label_values_by_metric = defaultdict(list)
+        for topic in self.topics:
+            # tuple() copies the set atomically, it can be updated by the MQTT loop
+            for prom_metric_id, label_values in tuple(metric_refs.get(topic, ())):
+                label_values_by_metric[prom_metric_id].append(label_values)
+                ts_metric_id = ts_metric_ids.get(prom_metric_id)
+                if ts_metric_id is not None:
+                    label_values_by_metric[ts_metric_id].append(label_values)
+
+        # pylama: ignore=W0212
+        for prom_metric_id, all_label_values in label_values_by_metric.items():
+            gauge = prom_metrics.get(prom_metric_id)
+            if gauge is None:
+                continue
+            family_type = CounterMetricFamily if gauge._type == "counter" else GaugeMetricFamily
+            family = family_type(gauge._name, gauge._documentation, labels=gauge._labelnames)
+            for label_values in all_label_values:
+                child = gauge._metrics.get(label_values)
+                if child is not None:
+                    family.add_metric(label_values, child._value.get())
+            yield family
+
+
+def _render_topics(topics):
+    """Render the series of some topics, without walking nor locking the whole registry."""
+    return generate_latest(_TopicSeries(topics))
+
+
+def _shard_endpoint(environ):
+    """Serve /metrics/<shard name>."""
+    name = environ["PATH_INFO"][len("/metrics/") :]
+    topics = topic_index.named_shard(name)
+    if topics is None:
+        return 404, {"error": f"unknown shard: {name}"}
+    return 200, _render_topics(topics)
+
+
+def _metrics_endpoint(environ):
+    """Serve /metrics?topic_prefix=... and /metrics?hashmod=..., else all the metrics."""
+    params = server.query_params(environ)
+    if "topic_prefix" in params:
+        return 200, _render_topics(topic_index.with_prefix(params["topic_prefix"]))
+    if "hashmod" in params:
+        try:
+            index = int(params["hashmod"])
+        except ValueError:
+            index = -1
+        if not 0 <= index < topic_index.hashmod_shards:
+            return 404, {"error": f"unknown hashmod shard: {params['hashmod']}"}
+        return 200, _render_topics(topic_index.hash_shard(index))
+    return None
+
+
+def _matching_topics(pattern):
+    """Topics having series matching a topic pattern, only the ones sharing its prefix are tested."""
+    literal_prefix = re.split(r"[+#*?\[]", pattern, maxsplit=1)[0]
+    matcher = TopicMatcher([pattern], cache_size=0)
+    return [
+        topic
+        for topic in topic_index.with_prefix(literal_prefix)
+        if matcher.match(topic) is not None
+    ]
+
+
+def _topic_series(topic):
+    """Describe the series of a topic."""
+    # pylama: ignore=W0212
+    series = []
+    for prom_metric_id, label_values in tuple(metric_refs.get(topic, ())):
+        for metric_id in (prom_metric_id, ts_metric_ids.get(prom_metric_id)):
+            gauge = prom_metrics.get(metric_id)
+            if gauge is not None:
+                labels = dict(zip(gauge._labelnames, label_values, strict=True))
+                series.append({"metric": metric_id.name, "labels": labels})
+    return series
+
+
+def _remove_msg_counters(topics):
+    """Remove the message counters of topics, their label values are found in their series."""
+    if prom_msg_counter is None or message_pipeline is None:
         return
 
-    for sample in metric_refs[old_topic]:
+    base_labels_count = len(message_pipeline.base_label_names)
+    counter_label_values = set()
+    for topic in topics:
+        for prom_metric_id, label_values in tuple(metric_refs.get(topic, ())):
+            values = label_values[:base_labels_count]
+            if message_pipeline.config.expose_broker:
+                if "broker" not in prom_metric_id.labels:
+                    # the broker of the series is unknown
+                    continue
+                broker_index = base_labels_count + prom_metric_id.labels.index("broker")
+                values += (label_values[broker_index],)
+            counter_label_values.add(values)
+
+    for values in counter_label_values:
         try:
-            prom_metrics[sample[0]].remove(*sample[1].values())
+            prom_msg_counter.remove(*values)
         except KeyError:
             pass
 
-    del metric_refs[old_topic]
 
-    # Remove old availability metrics following renaming
+def delete_series(topics):
+    """Remove the series and message counters of topics, return the number of removed series."""
+    _remove_msg_counters(topics)
+    removed = sum(_remove_series(topic) for topic in topics)
+    if message_pipeline is not None and message_pipeline.dedup_cache is not None:
+        # the next payload of these topics must create the series again
+        message_pipeline.dedup_cache.clear()
 
-    if not settings.ZIGBEE2MQTT_AVAILABILITY:
-        return
+    return removed
 
-    old_topic_availability = f"{old_topic}{ZIGBEE2MQTT_AVAILABILITY_SUFFIX}"
-    if old_topic_availability not in metric_refs:
-        return
 
-    for sample in metric_refs[old_topic_availability]:
+def _selected_topics(params):
+    if "topic" in params:
+        return [params["topic"]] if params["topic"] in metric_refs else []
+    if "topic_prefix" in params:
+        return topic_index.with_prefix(params["topic_prefix"])
+    if "match" in params:
+        return _matching_topics(params["match"])
+    return None
+
+
+def _series_endpoint(environ):
+    """List (GET) or delete (DELETE) the series of topics selected by topic, prefix or pattern."""
+    params = server.query_params(environ)
+    topics = _selected_topics(params)
+    if topics is None:
+        return 400, {"error": "one of topic, topic_prefix or match parameters is required"}
+
+    if environ["REQUEST_METHOD"] == "DELETE":
+        removed = delete_series(topics)
+        LOG.info("admin API: %d series of %d topics removed", removed, len(topics))
+        return 200, {"topics": len(topics), "series": removed}
+
+    return 200, {topic: _topic_series(topic) for topic in sorted(topics)}
+
+
+def _cardinality_endpoint(environ):
+    """Number of series per metric and topic, largest first."""
+    # pylama: ignore=W0212
+    try:
+        limit = int(server.query_params(environ).get("limit", "20"))
+    except ValueError:
+        return 400, {"error": "limit must be an integer"}
+
+    # metrics are created by the MQTT threads meanwhile
+    metrics = {
+        metric_id.name: len(gauge._metrics) for metric_id, gauge in list(prom_metrics.items())
+    }
+    topics = {
+        topic: sum(1 + (prom_metric_id in ts_metric_ids) for prom_metric_id, _ in tuple(refs))
+        for topic, refs in list(metric_refs.items())
+    }
+
+    def largest(counts):
+        return dict(sorted(counts.items(), key=lambda item: item[1], reverse=True)[:limit])
+
+    return 200, {
+        "series": sum(metrics.values()),
+        "topics_count": len(topics),
+        "metrics": largest(metrics),
+        "topics": largest(topics),
+    }
+
+
+def _top_topics_endpoint(environ):
+    """Top topics by messages, bytes and processing time."""
+    try:
+        n = int(server.query_params(environ).get("n", settings.TOP_TOPICS_EXPOSED))
+    except ValueError:
+        return 400, {"error": "n must be an integer"}
+    return 200, topic_stats.top(n)
+
+
+def _dead_letters_endpoint(environ):
+    """Recently rejected messages, optionally filtered by topic or reason."""
+    params = server.query_params(environ)
+    return 200, {"messages": dead_letters.entries(params.get("topic"), params.get("reason"))}
+
+
+def _flush_coalesced_loop():
+    """Process the coalesced messages of the active pipeline when they are due."""
+    while True:
+        time.sleep(RATE_LIMIT_FLUSH_INTERVAL)
         try:
-            prom_metrics[sample[0]].remove(*sample[1].values())
-        except KeyError:
-            pass
+            message_pipeline.flush_coalesced()
+        except Exception:
+            LOG.exception("failed to process coalesced messages")
 
-    del metric_refs[old_topic_availability]
 
+def _create_prometheus_metric(prom_metric_id, original_topic):
+    """Create Prometheus metric if does not exist."""
+    _current_pipeline().create_metric(prom_metric_id, original_topic)
 
-def expose_metrics(_, userdata, msg):
-    """Expose metrics to prometheus when a message has been published (callback)."""
 
-    if msg.topic.startswith("zigbee2mqtt/") and msg.topic.endswith("/rename"):
-        _zigbee2mqtt_rename(msg)
-        return
+def _add_prometheus_sample(
+    topic, original_topic, prom_metric_id, metric_value, client_id, additional_labels
+):
+    """Set the sample value, and return the last seen timestamp gauge if enabled."""
+    return _current_pipeline().add_sample(
+        topic, original_topic, prom_metric_id, metric_value, client_id, additional_labels
+    )
 
-    for ignore in settings.IGNORED_TOPICS:
-        if fnmatch.fnmatch(msg.topic, ignore):
-            LOG.debug('Topic "%s" was ignored by entry "%s"', msg.topic, ignore)
-            return
 
-    if settings.LOG_MQTT_MESSAGE:
-        LOG.debug("New message from MQTT: %s - %s", msg.topic, msg.payload)
+def _parse_metric(data):
+    """Attempt to parse the value and extract a number out of it.
 
-    topic, payload = _parse_message(msg.topic, msg.payload)
+    Raise ValueError is the data can't be parsed.
+    """
+    return _current_pipeline().parse_value(data)
 
-    if not topic or not payload:
-        return
 
-    if settings.MQTT_V5_PROTOCOL:
-        additional_labels = _parse_properties(msg.properties)
-    else:
-        additional_labels = {}
+def _parse_metrics(data, topic, original_topic, client_id, prefix="", labels=None, last_seen=None):
+    """Attempt to parse a set of metrics using the current settings."""
+    _current_pipeline().parse_metrics(
+        data, topic, original_topic, client_id, prefix, labels, last_seen
+    )
 
-    if settings.PARSE_MSG_PAYLOAD:
-        _parse_metrics(payload, topic, msg.topic, userdata["client_id"], labels=additional_labels)
 
-    # increment received message counter
-    labels = {settings.TOPIC_LABEL: topic}
-    if settings.MQTT_EXPOSE_CLIENT_ID:
-        labels["client_id"] = userdata["client_id"]
+def _parse_message(raw_topic, raw_payload):
+    """Parse topic and payload to have exposable information using the current settings."""
+    return _current_pipeline().parse_message(raw_topic, raw_payload)
 
-    prom_msg_counter.labels(**labels).inc()
+
+def expose_metrics(client, userdata, msg):
+    """Expose metrics to prometheus when a message has been published (callback).
+
+    The pipeline is rebuilt if the settings have changed since the last message, the exporter
+    itself dispatches messages to the pipeline built at startup instead.
+    """
+    _current_pipeline().on_message(client, userdata, msg)
 
 
-def run():
-    """Start the exporter."""
-    if settings.MQTT_V5_PROTOCOL:
+def _create_client(broker):
+    """Create the MQTT client of a broker."""
+    userdata = {"client_id": broker.client_id, "broker": broker}
+    if broker.v5_protocol:
         client = mqtt.Client(
             callback_api_version=mqtt.CallbackAPIVersion.VERSION2,
-            client_id=settings.MQTT_CLIENT_ID,
+            client_id=broker.client_id,
+            userdata=userdata,
             protocol=mqtt.MQTTv5,
         )
     else:
         # if MQTT version 5 is not requested, we let MQTT lib choose the protocol version
         client = mqtt.Client(
-            callback_api_version=mqtt.CallbackAPIVersion.VERSION2, client_id=settings.MQTT_CLIENT_ID
+            callback_api_version=mqtt.CallbackAPIVersion.VERSION2,
+            client_id=broker.client_id,
+            userdata=userdata,
+            clean_session=not broker.persistent_session,
         )
 
     client.enable_logger(LOG)
 
-    if settings.MQTT_ENABLE_TLS:
+    if broker.enable_tls:
         LOG.debug("Enabling TLS on MQTT client")
         ssl_context = ssl.create_default_context()
 
         # custom CA support
-        if settings.MQTT_TLS_CA_CERT:
+        if broker.tls_ca_cert:
             LOG.debug("loading custom CA certificate")
-            ssl_context.load_verify_locations(cafile=settings.MQTT_TLS_CA_CERT)
+            ssl_context.load_verify_locations(cafile=broker.tls_ca_cert)
         else:
             ssl_context.load_default_certs()
 
         # mTLS settings
-        if settings.MQTT_TLS_CLIENT_CERT and settings.MQTT_TLS_CLIENT_KEY:
+        if broker.tls_client_cert and broker.tls_client_key:
             LOG.debug("[mTLS] loading client certificate and key")
             ssl_context.load_cert_chain(
-                certfile=settings.MQTT_TLS_CLIENT_CERT, keyfile=settings.MQTT_TLS_CLIENT_KEY
+                certfile=broker.tls_client_cert, keyfile=broker.tls_client_key
             )
 
-        if settings.MQTT_TLS_NO_VERIFY:
+        if broker.tls_no_verify:
             LOG.debug("Not verifying MQTT certificate authority is trusted")
             ssl_context.check_hostname = False
             ssl_context.verify_mode = ssl.CERT_NONE
 
         client.tls_set_context(ssl_context)
 
+    if broker.username and broker.password:
+        client.username_pw_set(broker.username, broker.password)
+
+    client.on_connect = subscribe
+    client.on_disconnect = _on_disconnect
+    return client
+
+
+def _session_args(broker):
+    """Arguments of `connect()` resuming the MQTTv5 session of a broker, if it is persistent."""
+    if not (broker.persistent_session and broker.v5_protocol):
+        return {}
+
+    properties = Properties(PacketTypes.CONNECT)
+    properties.SessionExpiryInterval = broker.session_expiry
+    return {"clean_start": False, "properties": properties}
+
+
+def _create_catch_up(clients, dispatch):
+    """Create the catch-up of the persistent sessions, and return their message callback."""
+    messages = Gauge(
+        f"{settings.PREFIX}catch_up_messages",
+        "Number of messages received during the last catch-up of the persistent session",
+        ["broker"],
+    )
+    pending = Gauge(
+        f"{settings.PREFIX}catch_up_pending_topics",
+        "Number of topics whose latest message is waiting for the end of the catch-up",
+        ["broker"],
+    )
+    duration = Gauge(
+        f"{settings.PREFIX}catch_up_duration_seconds",
+        "Duration of the last catch-up of the persistent session",
+        ["broker"],
+    )
+
+    for client in clients:
+        userdata = client.user_data_get()
+        broker = userdata["broker"]
+        if not broker.persistent_session:
+            continue
+        catch_up = userdata["catch_up"] = CatchUp(
+            dispatch,
+            partial(_client_backlog, client),
+            settings.CATCH_UP_MAX_DURATION,
+        )
+        messages.labels(broker.name).set_function(lambda c=catch_up: c.messages)
+        pending.labels(broker.name).set_function(lambda c=catch_up: c.pending)
+        duration.labels(broker.name).set_function(lambda c=catch_up: c.duration)
+
+    threading.Thread(target=_catch_up_loop, args=(clients,), daemon=True).start()
+
+    def dispatch_message(client, userdata, msg):
+        catch_up = userdata.get("catch_up")
+        if catch_up is not None and catch_up.add(msg.topic, (client, userdata, msg)):
+            return
+        dispatch(client, userdata, msg)
+
+    return dispatch_message
+
+
+def _client_backlog(client):
+    return socket_backlog(client.socket())
+
+
+def _catch_up_loop(clients):
+    """End the catch-up of the sessions once their backlog is drained."""
+    while True:
+        time.sleep(CATCH_UP_CHECK_INTERVAL)
+        for client in clients:
+            catch_up = client.user_data_get().get("catch_up")
+            if catch_up is None:
+                continue
+            try:
+                catch_up.check(time.monotonic())
+            except Exception:
+                LOG.exception("failed to check the catch-up backlog")
+
+
+def _consume_source(source, dispatch):
+    """Process the messages of a source, then keep exposing the metrics until stopped."""
+    invalid = Counter(
+        f"{settings.PREFIX}source_invalid_lines_total",
+        "Counter of lines read from the source which are not messages",
+        ["source"],
+    )
+    source.on_invalid = lambda name: invalid.labels(name).inc()
+
+    LOG.info('reading the messages from "%s"', source.name)
+    count = source.run(dispatch)
+    LOG.info('read %d messages from "%s", exposing them until stopped', count, source.name)
+    threading.Event().wait()
+
+
+def _broker_dispatcher(broker, dispatch=_dispatch_message):
+    """Create the message callback of a broker, counting the messages it receives."""
+    received = prom_broker_messages.labels(broker.name)
+
+    def dispatch_message(client, userdata, msg):
+        received.inc()
+        dispatch(client, userdata, msg)
+
+    return dispatch_message
+
+
+def run(brokers=None, source=None):
+    """Start the exporter.
+
+    Keyword arguments:
+    brokers -- list of BrokerConfig, each connected with its own client and network loop thread.
+               Defaults to MQTT_BROKERS_FILE, or the single broker defined by the MQTT_* settings.
+    source -- Source of the messages read instead of connecting to brokers (see sources.py).
+    """
+    if source is not None:
+        brokers = []
+    elif brokers is None:
+        if settings.MQTT_BROKERS_FILE:
+            brokers = load_brokers(settings.MQTT_BROKERS_FILE)
+        else:
+            brokers = [BrokerConfig.from_settings()]
+
+    # the broker label is added as soon as brokers are named
+    multi_broker = any(broker.name for broker in brokers)
+    clients = [_create_client(broker) for broker in brokers]
+
     def stop_request(signum, frame):
         """Stop handler for SIGTERM and SIGINT.
 
@@ -566,15 +2426,47 @@ def run():
         """
         LOG.warning("Stopping MQTT exporter")
         LOG.debug("SIGNAL: %s, FRAME: %s", signum, frame)
-        client.disconnect()
+        for client in clients:
+            client.disconnect()
         sys.exit(0)
 
-    _create_msg_counter_metrics()
+    if settings.EXPOSE_TOPIC_MESSAGE_COUNTER:
+        _create_msg_counter_metrics(expose_broker=multi_broker)
+    _create_ignore_metrics()
+    if settings.DEDUP_CACHE_SIZE > 0:
+        _create_dedup_metrics()
     signal.signal(signal.SIGTERM, stop_request)
     signal.signal(signal.SIGINT, stop_request)
+    if settings.CONFIG_FILE:
+        signal.signal(signal.SIGHUP, _reload_request)
+        server.add_route("/-/reload", _reload_endpoint, methods=("POST",))
+
+    global topic_index  # noqa: PLW0603
+    topic_index = TopicIndex(parse_shards(settings.SCRAPE_SHARDS), settings.SCRAPE_HASHMOD_SHARDS)
+    server.add_route("/metrics", _metrics_endpoint)
+    server.add_route("/metrics/", _shard_endpoint, prefix=True)
+    if settings.ADMIN_API:
+        server.add_route("/api/v1/series", _series_endpoint, methods=("GET", "DELETE"))
+        server.add_route("/api/v1/cardinality", _cardinality_endpoint)
+    pipeline_config = PipelineConfig.from_settings(
+        expose_broker=multi_broker,
+        catch_up=any(broker.persistent_session for broker in brokers),
+    )
+    if settings.OFFLOAD_WORKERS > 0:
+        _create_offloader(concurrent=pipeline_config.concurrent)
+    if settings.RATE_LIMITS:
+        _create_rate_limit_metrics()
+    if settings.LABEL_CARDINALITY_ENABLED:
+        _create_label_cardinality_metrics()
+    if settings.TOP_TOPICS_CAPACITY > 0:
+        _create_top_topics_metrics()
+        server.add_route("/debug/top_topics", _top_topics_endpoint)
+    if settings.DEAD_LETTER_SIZE > 0:
+        _create_dead_letters()
+        server.add_route("/debug/dead_letters", _dead_letters_endpoint)
 
     # start prometheus server
-    start_http_server(
+    server.start_server(
         settings.PROMETHEUS_PORT,
         settings.PROMETHEUS_ADDRESS,
         certfile=settings.PROMETHEUS_CERT,
@@ -583,15 +2475,48 @@ def run():
         client_capath=settings.PROMETHEUS_CA_DIR,
     )
 
-    # define mqtt client
-    client.on_connect = subscribe
-    client.on_message = expose_metrics
+    if settings.OUTPUT_SINKS:
+        _create_output_sinks()
+    if any(settings.COUNTER_METRICS) or settings.COUNTER_LEARNING_SAMPLES > 0:
+        _create_counter_detector()
+    if parse_size(settings.MEMORY_LIMIT) > 0:
+        _create_memory_budget()
+    build_pipeline(pipeline_config)
+    mqtt_clients.extend(clients)
+    if settings.INGEST_THREADS > 0:
+        _create_ingest_workers()
+    if settings.RATE_LIMITS:
+        threading.Thread(target=_flush_coalesced_loop, daemon=True).start()
+    dispatch = _dispatch_message
+    if settings.WATCHDOG_LAG_THRESHOLD > 0:
+        _create_watchdog()
+        dispatch = watchdog.measure(_dispatch_message)
+    if any(broker.persistent_session for broker in brokers):
+        dispatch = _create_catch_up(clients, dispatch)
+
+    if source is not None:
+        _consume_source(source, dispatch)
+        return
+
+    if not multi_broker:
+        # start the connection and the loop
+        client = clients[0]
+        client.on_message = dispatch
+        client.connect(
+            brokers[0].address, brokers[0].port, brokers[0].keepalive, **_session_args(brokers[0])
+        )
+        client.loop_forever()
+        return
+
+    # each broker has its own network loop thread, and reconnects on its own
+    _create_broker_metrics()
+    for broker, client in zip(brokers, clients, strict=True):
+        prom_broker_connected.labels(broker.name).set(0)
+        client.on_message = _broker_dispatcher(broker, dispatch)
+        client.connect_async(broker.address, broker.port, broker.keepalive, **_session_args(broker))
+        client.loop_start()
 
-    # start the connection and the loop
-    if settings.MQTT_USERNAME and settings.MQTT_PASSWORD:
-        client.username_pw_set(settings.MQTT_USERNAME, settings.MQTT_PASSWORD)
-    client.connect(settings.MQTT_ADDRESS, settings.MQTT_PORT, settings.MQTT_KEEPALIVE)
-    client.loop_forever()
+    threading.Event().wait()
 
 
 def main_mqtt_exporter():
@@ -602,6 +2527,10 @@ def main_mqtt_exporter():
         epilog="https://github.com/kpetremann/mqtt-exporter",
     )
     parser.add_argument("--test", action="store_true")
+    parser.add_argument(
+        "--source",
+        help="read the messages from stdin, file:PATH, tail:PATH or unix:PATH instead of brokers",
+    )
     args = parser.parse_args()
 
     if args.test:
@@ -623,7 +2552,7 @@ def main_mqtt_exporter():
         print("\n## Result ##\n")
         print(str(generate_latest().decode("utf-8")))
     else:
-        run()
+        run(source=parse_source(args.source) if args.source else None)
 
 
 if __name__ == "__main__":
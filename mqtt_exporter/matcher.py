@@ -0,0 +1,128 @@
+"""Topic patterns matching."""
+
+import fnmatch
+import re
+
+from mqtt_exporter.cache import LockedLRUCache, LRUCache
+
+_GLOB_CHARS = re.compile(r"[*?\[]")
+_NO_MATCH = object()
+
+
+class _TrieNode:
+    __slots__ = ("children", "patterns", "multi_level_patterns")
+
+    def __init__(self):
+        self.children = {}
+        # patterns ending at this level
+        self.patterns = []
+        # patterns ending with `#` after this level
+        self.multi_level_patterns = []
+
+
+def _is_mqtt_pattern(pattern):
+    levels = pattern.split("/")
+    if "#" in levels[:-1]:
+        return False
+    return "+" in levels or levels[-1] == "#"
+
+
+class TopicMatcher:
+    """Match topics against a list of patterns compiled once.
+
+    Patterns using `+` or `#` as a whole topic level follow MQTT wildcards semantics,
+    other patterns are shell-style wildcards (fnmatch, case sensitive). Literal topics
+    are looked up in a dict, MQTT patterns in a topic levels trie, and all shell-style
+    patterns are combined in a single regex.
+
+    `match()` returns the first pattern (in the given order) matching the topic. Results
+    are cached per topic, `thread_safe` when the matcher is used by several threads.
+    """
+
+    def __init__(self, patterns, cache_size=10000, thread_safe=False):
+        self.patterns = tuple(patterns)
+        self._literals = {}
+        self._trie = _TrieNode()
+        self._has_mqtt_patterns = False
+        self._glob_regex = None
+        self._cache = None
+        if cache_size > 0:
+            self._cache = (LockedLRUCache if thread_safe else LRUCache)(cache_size)
+
+        globs = []
+        for index, pattern in enumerate(self.patterns):
+            if _is_mqtt_pattern(pattern):
+                self._add_mqtt_pattern(pattern, index)
+            elif _GLOB_CHARS.search(pattern):
+                # fnmatch names its own groups g0, g1... on Python 3.10
+                globs.append(f"(?P<_p{index}>{fnmatch.translate(pattern)})")
+            else:
+                self._literals.setdefault(pattern, index)
+
+        if globs:
+            self._glob_regex = re.compile("|".join(globs))
+
+    @property
+    def cache(self):
+        """Cache of the results per topic, None if disabled."""
+        return self._cache
+
+    def _add_mqtt_pattern(self, pattern, index):
+        self._has_mqtt_patterns = True
+        node = self._trie
+        for level in pattern.split("/"):
+            if level == "#":
+                node.multi_level_patterns.append(index)
+                return
+            node = node.children.setdefault(level, _TrieNode())
+        node.patterns.append(index)
+
+    def _match_trie(self, topic):
+        levels = topic.split("/")
+        # wildcards on the first level do not match topics starting with $ (i.e. $SYS)
+        system_topic = topic.startswith("$")
+        matches = []
+        stack = [(self._trie, 0)]
+        while stack:
+            node, depth = stack.pop()
+            if node.multi_level_patterns and not (depth == 0 and system_topic):
+                matches.extend(node.multi_level_patterns)
+            if depth == len(levels):
+                matches.extend(node.patterns)
+                continue
+
+            child = node.children.get(levels[depth])
+            if child is not None:
+                stack.append((child, depth + 1))
+            child = node.children.get("+")
+            if child is not None and not (depth == 0 and system_topic):
+                stack.append((child, depth + 1))
+
+        return min(matches, default=None)
+
+    def _match(self, topic):
+        matches = []
+        index = self._literals.get(topic)
+        if index is not None:
+            matches.append(index)
+        if self._has_mqtt_patterns:
+            index = self._match_trie(topic)
+            if index is not None:
+                matches.append(index)
+        if self._glob_regex is not None:
+            glob_match = self._glob_regex.match(topic)
+            if glob_match is not None:
+                matches.append(int(glob_match.lastgroup[2:]))
+
+        return self.patterns[min(matches)] if matches else None
+
+    def match(self, topic):
+        """Return the first pattern matching the topic, None if no pattern matches."""
+        if self._cache is None:
+            return self._match(topic)
+
+        pattern = self._cache.get(topic, _NO_MATCH)
+        if pattern is _NO_MATCH:
+            pattern = self._match(topic)
+            self._cache[topic] = pattern
+        return pattern
@@ -0,0 +1,150 @@
+"""Memory budget of the exporter data, estimated from the number of series, cache entries..."""
+
+import logging
+import re
+import threading
+
+LOG = logging.getLogger("mqtt-exporter")
+
+# estimated bytes of each item, measured with tracemalloc on CPython 3.11
+# series: prometheus_client child, label values tuple and reference of its topic
+SERIES_BYTES = 700
+# label value of the labels added to the topic labels (MQTTv5 user properties, broker...)
+LABEL_BYTES = 60
+# topic: interned string, references set and topic index entry
+TOPIC_BYTES = 430
+# cache entry: key, value and LRU links
+CACHE_ENTRY_BYTES = 225
+# queued message: MQTT message object, topic and a typical payload
+MESSAGE_BYTES = 1024
+# point buffered by an output sink
+POINT_BYTES = 250
+# rejected message kept for debugging, besides its payload
+DEAD_LETTER_BYTES = 600
+# label tracked by the cardinality limiter: HyperLogLog registers (1 KB) and state
+LABEL_STATE_BYTES = 1550
+# topic tracked by a top topics sketch: weight, error and heap entries
+TOP_TOPIC_BYTES = 120
+# value kept per topic by the derived metrics (inputs, derived values and rate states)
+DERIVED_VALUE_BYTES = 130
+
+# degradation stages, applied in order while the estimate stays over the high watermark
+NORMAL = 0
+SHRINK_CACHES = 1
+REFUSE_SERIES = 2
+EVICT_SERIES = 3
+
+_SIZE = re.compile(r"^\s*(\d+(?:\.\d+)?)\s*([KMG]?)I?B?\s*$")
+_UNITS = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+
+
+def parse_size(value):
+    """Parse a number of bytes, with an optional K, M or G suffix (powers of 1024), e.g. "512M"."""
+    match = _SIZE.match(value.upper())
+    if match is None:
+        raise ValueError(f"invalid size: {value}")
+    return int(float(match.group(1)) * _UNITS[match.group(2)])
+
+
+class MemoryBudget:
+    """Keep the estimated memory of the data under `ceiling` bytes, degrading in stages.
+
+    Every `interval` seconds, `usage()` estimates the bytes of each component (series, caches,
+    queues...). While the total is over `high_watermark` (fraction of the ceiling), the next
+    stage is applied:
+    1. the caches are shrunk (`on_shrink()`),
+    2. new series are refused (`refuse_series`),
+    3. the series of topics not updated since the previous check are evicted
+       (`on_evict(bytes, recent topics)`, called at each check until under the low watermark).
+    Once the total is under `low_watermark`, the caches are restored (`on_restore()`) and new
+    series are accepted again. The pipeline calls `note(topic)` for the topics updated, and
+    `on_refused()` for each sample refused. `on_check(usage, stage)` is called for each check.
+    """
+
+    def __init__(
+        self,
+        ceiling,
+        usage,
+        high_watermark=0.9,
+        low_watermark=0.8,
+        interval=5.0,
+        on_shrink=None,
+        on_restore=None,
+        on_evict=None,
+        on_refused=None,
+        on_check=None,
+    ):
+        self.ceiling = ceiling
+        self.usage = usage
+        self.high = ceiling * high_watermark
+        self.low = ceiling * low_watermark
+        self.interval = interval
+        self.on_shrink = on_shrink
+        self.on_restore = on_restore
+        self.on_evict = on_evict
+        self.on_refused = on_refused
+        self.on_check = on_check
+        self.stage = NORMAL
+        self.refuse_series = False
+        # topics updated since the previous check
+        self.recent = set()
+        self._recent_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def note(self, topic):
+        """Record a topic updated since the previous check."""
+        with self._recent_lock:
+            self.recent.add(topic)
+
+    def check(self):
+        """Estimate the memory, apply or leave the degradation stages, return the estimate."""
+        with self._recent_lock:
+            recent, self.recent = self.recent, set()
+        usage = self.usage()
+        total = sum(usage.values())
+
+        if total > self.high:
+            if self.stage < EVICT_SERIES:
+                self.stage += 1
+                LOG.warning(
+                    "estimated memory of %d bytes over %d bytes, degradation stage %d",
+                    total,
+                    self.high,
+                    self.stage,
+                )
+                if self.stage == SHRINK_CACHES and self.on_shrink is not None:
+                    self.on_shrink()
+                if self.stage == REFUSE_SERIES:
+                    self.refuse_series = True
+            if self.stage == EVICT_SERIES and self.on_evict is not None:
+                self.on_evict(total - self.low, recent)
+        elif total < self.low and self.stage != NORMAL:
+            LOG.warning("estimated memory of %d bytes back under %d bytes", total, self.low)
+            self.stage = NORMAL
+            self.refuse_series = False
+            if self.on_restore is not None:
+                self.on_restore()
+
+        if self.on_check is not None:
+            self.on_check(usage, self.stage)
+        return usage
+
+    def start(self):
+        """Start the thread checking the memory."""
+        self._thread = threading.Thread(target=self._check_loop, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop the thread."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _check_loop(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.check()
+            except Exception:
+                LOG.exception("failed to check the memory budget")
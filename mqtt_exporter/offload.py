@@ -0,0 +1,62 @@
+"""Offload of heavy payloads parsing to a process pool."""
+
+import logging
+import threading
+import time
+from collections import deque
+
+from mqtt_exporter.matcher import TopicMatcher
+
+LOG = logging.getLogger("mqtt-exporter")
+
+
+class Offloader:
+    """Run the parsing of heavy payloads in `executor`, and apply the results in order per topic.
+
+    A payload is offloaded when it is larger than `min_size` bytes, or when its topic matches one
+    of `topics` patterns. Once a topic has a payload being parsed, its next payloads are offloaded
+    too, so the results of a topic are always applied in the order of the messages.
+    `on_applied(size, latency)` is called for each offloaded payload, `thread_safe` when the
+    messages are checked by several threads.
+    """
+
+    def __init__(self, executor, min_size=0, topics=(), on_applied=None, thread_safe=False):
+        self.executor = executor
+        self.min_size = min_size
+        self.matcher = TopicMatcher(topics, thread_safe=thread_safe) if topics else None
+        self.on_applied = on_applied
+        # payloads being parsed for each topic: deque of [future, apply, submit time, size]
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def should_offload(self, topic, size):
+        """Return True if the payload must be parsed in the pool."""
+        if self.min_size and size >= self.min_size:
+            return True
+        if topic in self._inflight:
+            return True
+        return self.matcher is not None and self.matcher.match(topic) is not None
+
+    def submit(self, topic, size, parse, args, apply):
+        """Run `parse(*args)` in the pool, then `apply(result)` once the previous ones are applied."""
+        with self._lock:
+            future = self.executor.submit(parse, *args)
+            self._inflight.setdefault(topic, deque()).append(
+                [future, apply, time.perf_counter(), size]
+            )
+        future.add_done_callback(lambda _future: self._apply_done(topic))
+
+    def _apply_done(self, topic):
+        # the results are applied under the lock to keep the order of each topic
+        with self._lock:
+            pending = self._inflight.get(topic)
+            while pending and pending[0][0].done():
+                future, apply, submitted, size = pending.popleft()
+                try:
+                    apply(future.result())
+                except Exception:
+                    LOG.exception('failed to parse offloaded payload of topic "%s"', topic)
+                if self.on_applied is not None:
+                    self.on_applied(size, time.perf_counter() - submitted)
+            if not pending:
+                self._inflight.pop(topic, None)
@@ -0,0 +1,157 @@
+"""Rate limiting of the messages of chatty topics."""
+
+import threading
+from dataclasses import dataclass
+
+from mqtt_exporter.cache import LRUCache
+from mqtt_exporter.matcher import TopicMatcher
+
+TOKENS = "tokens"
+SAMPLE = "sample"
+COALESCE = "coalesce"
+
+# number of topics for which the rate limiting state is kept
+STATE_CACHE_SIZE = 10000
+
+
+@dataclass(frozen=True)
+class RatePolicy:
+    """Rate limiting policy of the topics matching a pattern.
+
+    - tokens: token bucket of `value` messages per second, up to `burst` messages at once
+    - sample: one message out of `value`
+    - coalesce: latest message applied at most every `value` seconds
+    """
+
+    kind: str
+    value: float
+    burst: float = 0
+
+
+def parse_rate_limits(value):
+    """Parse rate limits: "pattern1=tokens:RATE[:BURST];pattern2=sample:N;pattern3=coalesce:MS"."""
+    limits = []
+    for definition in value.split(";"):
+        if not definition.strip():
+            continue
+        pattern, sep, policy = definition.rpartition("=")
+        kind, _, args = policy.strip().partition(":")
+        args = args.split(":")
+        try:
+            if not sep or not pattern.strip():
+                raise ValueError("missing topic pattern")
+            if kind == TOKENS:
+                rate = float(args[0])
+                rate_policy = RatePolicy(TOKENS, rate, float(args[1]) if len(args) > 1 else rate)
+            elif kind == SAMPLE:
+                rate_policy = RatePolicy(SAMPLE, int(args[0]))
+            elif kind == COALESCE:
+                rate_policy = RatePolicy(COALESCE, float(args[0]) / 1000)
+            else:
+                raise ValueError(f"unknown policy {kind}")
+        except (ValueError, IndexError) as error:
+            raise ValueError(f"invalid rate limit definition '{definition}': {error}")
+        if rate_policy.value <= 0:
+            raise ValueError(f"invalid rate limit definition '{definition}': must be positive")
+
+        limits.append((pattern.strip(), rate_policy))
+
+    return tuple(limits)
+
+
+class RateLimiter:
+    """Decide which messages are processed, according to the policy of their topic.
+
+    Each topic has its own state. `check()` returns False for the messages which must not be
+    processed now: they are either suppressed (`on_suppressed(pattern)` is called), or kept
+    by a coalesce policy until `flush()` returns them, unless a newer message replaces them.
+    `thread_safe` when messages are checked by several threads.
+    """
+
+    def __init__(self, limits, on_suppressed=None, thread_safe=False):
+        self.limits = tuple(limits)
+        self.policies = dict(limits)
+        self.thread_safe = thread_safe
+        self.matcher = TopicMatcher([pattern for pattern, _ in limits], thread_safe=thread_safe)
+        self.on_suppressed = on_suppressed or (lambda _pattern: None)
+        self._states = LRUCache(STATE_CACHE_SIZE)
+        # coalesced messages: {topic: (pattern, message)}
+        self._pending = {}
+        # messages of several brokers are processed concurrently
+        self._lock = threading.Lock()
+
+    @property
+    def pending(self):
+        """Number of coalesced messages waiting to be processed."""
+        return len(self._pending)
+
+    @property
+    def states(self):
+        """Number of topics having a state."""
+        return len(self._states)
+
+    def check(self, topic, message, now):
+        """Return True if the message must be processed now."""
+        pattern = self.matcher.match(topic)
+        if pattern is None:
+            return True
+
+        policy = self.policies[pattern]
+        with self._lock:
+            state = self._states.get(topic)
+            if policy.kind == TOKENS:
+                allowed = self._take_token(topic, state, policy, now)
+            elif policy.kind == SAMPLE:
+                allowed = self._sample(topic, state, policy)
+            else:
+                return self._coalesce(topic, state, policy, pattern, message, now)
+
+        if not allowed:
+            self.on_suppressed(pattern)
+        return allowed
+
+    def _take_token(self, topic, state, policy, now):
+        if state is None:
+            state = self._states[topic] = [policy.burst, now]
+        tokens = min(policy.burst, state[0] + (now - state[1]) * policy.value)
+        state[1] = now
+        if tokens < 1:
+            state[0] = tokens
+            return False
+        state[0] = tokens - 1
+        return True
+
+    def _sample(self, topic, state, policy):
+        if state is None:
+            state = self._states[topic] = [0]
+        state[0] = (state[0] + 1) % policy.value
+        return state[0] == 1 or policy.value == 1
+
+    def _coalesce(self, topic, state, policy, pattern, message, now):
+        if topic not in self._pending and (state is None or now - state[0] >= policy.value):
+            self._states[topic] = [now]
+            return True
+
+        if topic in self._pending:
+            self.on_suppressed(pattern)
+        self._pending[topic] = (pattern, message)
+        return False
+
+    def drain(self):
+        """Remove and return all the coalesced messages, whether they are due or not."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        return [message for _, message in pending.values()]
+
+    def flush(self, now):
+        """Return the coalesced messages which are due, the latest of each topic."""
+        due = []
+        with self._lock:
+            for topic, (pattern, message) in list(self._pending.items()):
+                state = self._states.get(topic)
+                if state is None or now - state[0] >= self.policies[pattern].value:
+                    del self._pending[topic]
+                    self._states[topic] = [now]
+                    due.append(message)
+
+        return due
@@ -0,0 +1,119 @@
+"""HTTP server exposing the Prometheus metrics and the exporter endpoints."""
+
+import gzip
+import json
+import ssl
+import threading
+from http import HTTPStatus
+from urllib.parse import parse_qs
+from wsgiref.simple_server import make_server
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, make_wsgi_app
+from prometheus_client.exposition import (
+    ThreadingWSGIServer,
+    _get_best_family,
+    _get_ssl_ctx,
+    _SilentHandler,
+)
+
+# path: (handler, allowed methods)
+_routes = {}
+# path prefix: (handler, allowed methods)
+_prefix_routes = {}
+
+
+def add_route(path, handler, methods=("GET",), prefix=False):
+    """Serve `path` (or all paths starting with it) with `handler(environ)`.
+
+    The handler returns an HTTP status code and a body, which is either JSON serializable or
+    bytes in the Prometheus text format. When it returns None, the request is served by the
+    Prometheus metrics application instead.
+    """
+    if prefix:
+        _prefix_routes[path] = (handler, methods)
+    else:
+        _routes[path] = (handler, methods)
+
+
+def _find_route(path):
+    route = _routes.get(path)
+    if route is not None:
+        return route
+
+    for prefix, prefix_route in _prefix_routes.items():
+        if path.startswith(prefix):
+            return prefix_route
+
+    return None
+
+
+def make_app(registry=REGISTRY):
+    """Create the WSGI application, falling back to the metrics for unknown paths."""
+    metrics_app = make_wsgi_app(registry)
+
+    def app(environ, start_response):
+        route = _find_route(environ["PATH_INFO"])
+        if route is None:
+            return metrics_app(environ, start_response)
+
+        handler, methods = route
+        if environ["REQUEST_METHOD"] not in methods:
+            response = 405, {"error": "method not allowed"}
+        else:
+            try:
+                response = handler(environ)
+            except Exception as error:
+                response = 500, {"error": str(error)}
+
+        if response is None:
+            return metrics_app(environ, start_response)
+
+        status, body = response
+        headers = []
+        if isinstance(body, bytes):
+            headers.append(("Content-Type", CONTENT_TYPE_LATEST))
+            if "gzip" in environ.get("HTTP_ACCEPT_ENCODING", ""):
+                body = gzip.compress(body)
+                headers.append(("Content-Encoding", "gzip"))
+        else:
+            body = json.dumps(body).encode("utf-8")
+            headers.append(("Content-Type", "application/json"))
+
+        headers.append(("Content-Length", str(len(body))))
+        start_response(f"{status} {HTTPStatus(status).phrase}", headers)
+        return [body]
+
+    return app
+
+
+def query_params(environ):
+    """Parse the query string of a request, keeping the last value of each parameter."""
+    return {key: values[-1] for key, values in parse_qs(environ.get("QUERY_STRING", "")).items()}
+
+
+def start_server(
+    port,
+    addr="0.0.0.0",
+    registry=REGISTRY,
+    certfile=None,
+    keyfile=None,
+    client_cafile=None,
+    client_capath=None,
+):
+    """Start the HTTP server in a daemon thread (same behavior as prometheus_client)."""
+
+    class Server(ThreadingWSGIServer):
+        """Copy of ThreadingWSGIServer to update address_family locally."""
+
+    Server.address_family, addr = _get_best_family(addr, port)
+    httpd = make_server(addr, port, make_app(registry), Server, handler_class=_SilentHandler)
+    if certfile and keyfile:
+        context = _get_ssl_ctx(
+            certfile, keyfile, ssl.PROTOCOL_TLS_SERVER, client_cafile, client_capath
+        )
+        httpd.socket = context.wrap_socket(httpd.socket, server_side=True)
+
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+
+    return httpd, thread
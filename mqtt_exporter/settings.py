@@ -9,6 +9,7 @@ PREFIX = os.getenv("PROMETHEUS_PREFIX", "mqtt_")
 TOPIC_LABEL = os.getenv("TOPIC_LABEL", "topic")
 TOPIC = os.getenv("MQTT_TOPIC", "#")
 IGNORED_TOPICS = os.getenv("MQTT_IGNORED_TOPICS", "").split(",")
+IGNORED_TOPICS_CACHE_SIZE = int(os.getenv("MQTT_IGNORED_TOPICS_CACHE_SIZE", "10000"))
 ZWAVE_TOPIC_PREFIX = os.getenv("ZWAVE_TOPIC_PREFIX", "zwave/")
 MESHTASTIC_TOPIC_PREFIX = os.getenv("MESHTASTIC_TOPIC_PREFIX", "msh/")
 ESPHOME_TOPIC_PREFIXES = os.getenv("ESPHOME_TOPIC_PREFIXES", "").split(",")
@@ -17,6 +18,8 @@ EXPOSE_LAST_SEEN = os.getenv("EXPOSE_LAST_SEEN", "False").lower() == "true"
 PARSE_MSG_PAYLOAD = os.getenv("PARSE_MSG_PAYLOAD", "True").lower() == "true"
 # 2000 is a very large number of metrics already, but should be high enough to avoid breaking users' setup
 MAX_METRICS = int(os.getenv("MAX_METRICS", "2000"))
+# number of topics for which the last payload fingerprint is kept, 0 disables the cache
+DEDUP_CACHE_SIZE = int(os.getenv("DEDUP_CACHE_SIZE", "0"))
 
 
 ZIGBEE2MQTT_AVAILABILITY = os.getenv("ZIGBEE2MQTT_AVAILABILITY", "False").lower() == "true"
@@ -35,7 +38,12 @@ if MQTT_PASSWORD_FILE:
     with open(MQTT_PASSWORD_FILE, "r") as f:
         MQTT_PASSWORD = f.read()
 
+# JSON file defining several brokers, see README
+MQTT_BROKERS_FILE = os.getenv("MQTT_BROKERS_FILE")
 MQTT_V5_PROTOCOL = os.getenv("MQTT_V5_PROTOCOL", "False").lower() == "true"
+MQTT_SUBSCRIPTION_IDENTIFIERS = (
+    os.getenv("MQTT_SUBSCRIPTION_IDENTIFIERS", "False").lower() == "true"
+)
 MQTT_CLIENT_ID = os.getenv("MQTT_CLIENT_ID", "")
 MQTT_EXPOSE_CLIENT_ID = os.getenv("MQTT_EXPOSE_CLIENT_ID", "False").lower() == "true"
 MQTT_ENABLE_TLS = os.getenv("MQTT_ENABLE_TLS", "False").lower() == "true"
@@ -43,12 +51,69 @@ MQTT_TLS_NO_VERIFY = os.getenv("MQTT_TLS_NO_VERIFY", "False").lower() == "true"
 MQTT_TLS_CA_CERT = os.getenv("MQTT_TLS_CA_CERT")
 MQTT_TLS_CLIENT_CERT = os.getenv("MQTT_TLS_CLIENT_CERT")
 MQTT_TLS_CLIENT_KEY = os.getenv("MQTT_TLS_CLIENT_KEY")
+# session kept by the broker while disconnected, with QoS 1 subscriptions (requires a client id)
+MQTT_PERSISTENT_SESSION = os.getenv("MQTT_PERSISTENT_SESSION", "False").lower() == "true"
+MQTT_SESSION_EXPIRY = int(os.getenv("MQTT_SESSION_EXPIRY", "3600"))
+# maximum duration of the catch-up of the messages queued by the broker (seconds)
+CATCH_UP_MAX_DURATION = float(os.getenv("CATCH_UP_MAX_DURATION", "60"))
 PROMETHEUS_ADDRESS = os.getenv("PROMETHEUS_ADDRESS", "0.0.0.0")
 PROMETHEUS_PORT = int(os.getenv("PROMETHEUS_PORT", "9000"))
 PROMETHEUS_CERT = os.getenv("PROMETHEUS_CERT", None)
 PROMETHEUS_CERT_KEY = os.getenv("PROMETHEUS_CERT_KEY", None)
 PROMETHEUS_CA = os.getenv("PROMETHEUS_CA", None)
 PROMETHEUS_CA_DIR = os.getenv("PROMETHEUS_CA_DIR", None)
+# named scrape shards, e.g. "zigbee=zigbee2mqtt/#;zwave=zwave/#"
+SCRAPE_SHARDS = os.getenv("SCRAPE_SHARDS", "")
+SCRAPE_HASHMOD_SHARDS = int(os.getenv("SCRAPE_HASHMOD_SHARDS", "0"))
+# series inspection and deletion endpoints
+ADMIN_API = os.getenv("ADMIN_API", "False").lower() == "true"
+# number of topics tracked by the heavy hitters sketch, 0 disables it
+TOP_TOPICS_CAPACITY = int(os.getenv("TOP_TOPICS_CAPACITY", "0"))
+TOP_TOPICS_EXPOSED = int(os.getenv("TOP_TOPICS_EXPOSED", "10"))
+EXPOSE_TOPIC_MESSAGE_COUNTER = os.getenv("EXPOSE_TOPIC_MESSAGE_COUNTER", "True").lower() == "true"
+# distinct values of the labels added by MQTTv5 user properties (or broker), per metric
+LABEL_CARDINALITY_ENABLED = os.getenv("LABEL_CARDINALITY_ENABLED", "False").lower() == "true"
+LABEL_CARDINALITY_LIMIT = int(os.getenv("LABEL_CARDINALITY_LIMIT", "0"))
+LABEL_CARDINALITY_LIMITS = os.getenv("LABEL_CARDINALITY_LIMITS", "")
+LABEL_CARDINALITY_ACTION = os.getenv("LABEL_CARDINALITY_ACTION", "drop")
+# rate limiting policies per topic pattern, see README
+RATE_LIMITS = os.getenv("RATE_LIMITS", "")
+# number of distinct strings for which the parsed value is cached, 0 disables the cache
+VALUE_CACHE_SIZE = int(os.getenv("VALUE_CACHE_SIZE", "10000"))
+PARSE_UNITS = os.getenv("PARSE_UNITS", "False").lower() == "true"
+# process pool parsing large payloads, or payloads of some topics, 0 disables it
+OFFLOAD_WORKERS = int(os.getenv("OFFLOAD_WORKERS", "0"))
+OFFLOAD_MIN_SIZE = int(os.getenv("OFFLOAD_MIN_SIZE", "65536"))
+OFFLOAD_TOPICS = os.getenv("OFFLOAD_TOPICS", "").split(",")
+# threads processing the messages, 0 processes them in the MQTT network loop thread
+INGEST_THREADS = int(os.getenv("INGEST_THREADS", "0"))
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "10000"))
+# samples also sent to InfluxDB or StatsD: "influx+http://...;statsd://host:port"
+OUTPUT_SINKS = os.getenv("OUTPUT_SINKS", "")
+OUTPUT_SINK_BUFFER_SIZE = int(os.getenv("OUTPUT_SINK_BUFFER_SIZE", "10000"))
+OUTPUT_SINK_FLUSH_INTERVAL = float(os.getenv("OUTPUT_SINK_FLUSH_INTERVAL", "1"))
+# metrics exposed as counters: name patterns, or learned from their first samples (0 disables)
+COUNTER_METRICS = os.getenv("COUNTER_METRICS", "").split(",")
+COUNTER_LEARNING_SAMPLES = int(os.getenv("COUNTER_LEARNING_SAMPLES", "0"))
+# metrics computed from the other metrics of a topic: "name1=expression1;name2=expression2"
+DERIVED_METRICS = os.getenv("DERIVED_METRICS", "")
+# ring buffer of the last rejected messages, 0 disables it
+DEAD_LETTER_SIZE = int(os.getenv("DEAD_LETTER_SIZE", "0"))
+DEAD_LETTER_PAYLOAD_SIZE = int(os.getenv("DEAD_LETTER_PAYLOAD_SIZE", "256"))
+DEAD_LETTER_TOPIC_INTERVAL = float(os.getenv("DEAD_LETTER_TOPIC_INTERVAL", "60"))
+# network loop lag (seconds) over which the slowest topics are logged, 0 disables the watchdog
+WATCHDOG_LAG_THRESHOLD = float(os.getenv("WATCHDOG_LAG_THRESHOLD", "0"))
+WATCHDOG_INTERVAL = float(os.getenv("WATCHDOG_INTERVAL", "1"))
+WATCHDOG_SLOW_TOPICS = int(os.getenv("WATCHDOG_SLOW_TOPICS", "10"))
+WATCHDOG_LOAD_SHEDDING = os.getenv("WATCHDOG_LOAD_SHEDDING", "False").lower() == "true"
+# ceiling of the estimated memory of the data, in bytes ("512M"), 0 disables the budget
+MEMORY_LIMIT = os.getenv("MEMORY_LIMIT", "0")
+MEMORY_HIGH_WATERMARK = float(os.getenv("MEMORY_HIGH_WATERMARK", "0.9"))
+MEMORY_LOW_WATERMARK = float(os.getenv("MEMORY_LOW_WATERMARK", "0.8"))
+MEMORY_CHECK_INTERVAL = float(os.getenv("MEMORY_CHECK_INTERVAL", "5"))
+
+# numeric arrays exposed with an index label or as statistics: "pattern1=index;pattern2=stats"
+ARRAY_METRICS = os.getenv("ARRAY_METRICS", "")
 
 KEEP_FULL_TOPIC = os.getenv("KEEP_FULL_TOPIC", "False").lower() == "true"
 
@@ -63,15 +128,78 @@ DEFAULT_STATE_VALUES = {
     "OFFLINE": 0,
 }
 
+
+def parse_state_values(custom_states):
+    """Merge custom state values ("KEY1=VALUE1,KEY2=VALUE2") with the default ones."""
+    state_values = DEFAULT_STATE_VALUES.copy()
+    if custom_states:
+        try:
+            for pair in custom_states.split(","):
+                if "=" in pair:
+                    key, value = pair.split("=", 1)
+                    state_values[key.strip().upper()] = float(value.strip())
+        except (ValueError, AttributeError) as e:
+            # Log warning but continue with defaults
+            LOG.warning("Failed to parse STATE_VALUES environment variable: %s", e)
+
+    return state_values
+
+
 # Parse custom state values from environment variable
-STATE_VALUES = DEFAULT_STATE_VALUES.copy()
-custom_states = os.getenv("STATE_VALUES", "")
-if custom_states:
-    try:
-        for pair in custom_states.split(","):
-            if "=" in pair:
-                key, value = pair.split("=", 1)
-                STATE_VALUES[key.strip().upper()] = float(value.strip())
-    except (ValueError, AttributeError) as e:
-        # Log warning but continue with defaults
-        LOG.warning("Failed to parse STATE_VALUES environment variable: %s", e)
+STATE_VALUES = parse_state_values(os.getenv("STATE_VALUES", ""))
+
+# Settings which can be changed at runtime from CONFIG_FILE
+# environment variable name: (setting name, parser)
+RELOADABLE_SETTINGS = {
+    "MQTT_TOPIC": ("TOPIC", str),
+    "MQTT_IGNORED_TOPICS": ("IGNORED_TOPICS", lambda value: value.split(",")),
+    "ZWAVE_TOPIC_PREFIX": ("ZWAVE_TOPIC_PREFIX", str),
+    "MESHTASTIC_TOPIC_PREFIX": ("MESHTASTIC_TOPIC_PREFIX", str),
+    "ESPHOME_TOPIC_PREFIXES": ("ESPHOME_TOPIC_PREFIXES", lambda value: value.split(",")),
+    "HUBITAT_TOPIC_PREFIXES": ("HUBITAT_TOPIC_PREFIXES", lambda value: value.split(",")),
+    "STATE_VALUES": ("STATE_VALUES", parse_state_values),
+    "MAX_METRICS": ("MAX_METRICS", int),
+}
+# values from the environment, restored when a setting is removed from CONFIG_FILE
+_ENV_SETTINGS = {name: globals()[name] for name, _ in RELOADABLE_SETTINGS.values()}
+
+
+def read_config_file(path):
+    """Read a config file made of KEY=VALUE lines (same keys as the environment variables)."""
+    values = {}
+    with open(path, "r") as f:
+        for raw_line in f:
+            line = raw_line.strip()
+            if not line or line.startswith("#"):
+                continue
+            key, sep, value = line.partition("=")
+            if not sep:
+                raise ValueError(f"invalid line in {path}: {line}")
+            values[key.strip()] = value.strip()
+
+    return values
+
+
+def load_config_file(path):
+    """Apply the reloadable settings defined in a config file, return the values replaced.
+
+    Settings are all parsed before being applied, so an invalid file does not change anything.
+    Unknown keys are ignored with a warning.
+    """
+    values = read_config_file(path)
+    for key in values.keys() - RELOADABLE_SETTINGS.keys():
+        LOG.warning("setting %s cannot be changed from %s", key, path)
+
+    new_settings = dict(_ENV_SETTINGS)
+    for key, (name, parse) in RELOADABLE_SETTINGS.items():
+        if key in values:
+            new_settings[name] = parse(values[key])
+
+    previous = {name: globals()[name] for name in new_settings}
+    globals().update(new_settings)
+    return previous
+
+
+CONFIG_FILE = os.getenv("CONFIG_FILE")
+if CONFIG_FILE:
+    load_config_file(CONFIG_FILE)
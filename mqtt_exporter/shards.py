@@ -0,0 +1,98 @@
+"""Partitioning of the topics for sharded scrapes."""
+
+import threading
+import zlib
+from collections import defaultdict
+
+from mqtt_exporter.matcher import TopicMatcher
+
+
+def parse_shards(value):
+    """Parse shards definition: "name1=pattern1,pattern2;name2=pattern3"."""
+    shards = {}
+    for definition in value.split(";"):
+        if not definition.strip():
+            continue
+        name, sep, patterns = definition.partition("=")
+        if not sep or not name.strip():
+            raise ValueError(f"invalid shard definition: {definition}")
+        shards[name.strip()] = [pattern.strip() for pattern in patterns.split(",") if pattern]
+
+    return shards
+
+
+def hashmod(topic, modulus):
+    """Stable hash of a topic modulo `modulus`."""
+    return zlib.crc32(topic.encode("utf-8")) % modulus
+
+
+class TopicIndex:
+    """Index of the topics having series, pre-partitioned when they first appear.
+
+    Topics are indexed by named shard (topic patterns), by first topic level (to serve
+    prefixes), and by hash when hashmod sharding is enabled.
+    """
+
+    def __init__(self, shards=None, hashmod_shards=0):
+        self._matchers = {
+            name: TopicMatcher(patterns, cache_size=0) for name, patterns in (shards or {}).items()
+        }
+        self._by_name = {name: set() for name in self._matchers}
+        self._by_root = defaultdict(set)
+        self.hashmod_shards = hashmod_shards
+        self._by_hash = [set() for _ in range(hashmod_shards)]
+        self._lock = threading.Lock()
+
+    @property
+    def shard_names(self):
+        """Names of the named shards."""
+        return list(self._matchers)
+
+    def add(self, topic):
+        """Index a new topic."""
+        with self._lock:
+            for name, matcher in self._matchers.items():
+                if matcher.match(topic) is not None:
+                    self._by_name[name].add(topic)
+            self._by_root[topic.split("/", 1)[0]].add(topic)
+            if self.hashmod_shards:
+                self._by_hash[hashmod(topic, self.hashmod_shards)].add(topic)
+
+    def remove(self, topic):
+        """Remove a topic from the index."""
+        with self._lock:
+            for topics in self._by_name.values():
+                topics.discard(topic)
+            root = topic.split("/", 1)[0]
+            self._by_root[root].discard(topic)
+            if not self._by_root[root]:
+                del self._by_root[root]
+            if self.hashmod_shards:
+                self._by_hash[hashmod(topic, self.hashmod_shards)].discard(topic)
+
+    def named_shard(self, name):
+        """Topics of a named shard, None if the shard does not exist."""
+        with self._lock:
+            topics = self._by_name.get(name)
+            return None if topics is None else list(topics)
+
+    def with_prefix(self, prefix):
+        """Topics starting with `prefix`."""
+        root, sep, _ = prefix.partition("/")
+        with self._lock:
+            if sep:
+                candidates = self._by_root.get(root, ())
+            else:
+                # the prefix is part of the first level
+                candidates = [
+                    topic
+                    for topic_root, topics in self._by_root.items()
+                    if topic_root.startswith(root)
+                    for topic in topics
+                ]
+            return [topic for topic in candidates if topic.startswith(prefix)]
+
+    def hash_shard(self, index):
+        """Topics of a hashmod shard."""
+        with self._lock:
+            return list(self._by_hash[index])
@@ -0,0 +1,267 @@
+"""Output sinks sending the samples to other systems than Prometheus, in batches."""
+
+import logging
+import math
+import re
+import socket
+import threading
+import urllib.request
+from urllib.parse import urlsplit, urlunsplit
+
+LOG = logging.getLogger("mqtt-exporter")
+
+# reasons of the dropped points
+BUFFER_FULL = "buffer_full"
+SEND_ERROR = "send_error"
+
+# payload size of the UDP datagrams, below the usual MTU
+MAX_DATAGRAM_SIZE = 1400
+HTTP_TIMEOUT = 10
+
+_INFLUX_TAG_ESCAPE = re.compile(r"([,= ])")
+_INFLUX_MEASUREMENT_ESCAPE = re.compile(r"([, ])")
+_STATSD_INVALID_CHARS = re.compile(r"[:|@#,\s]")
+
+
+class Sink:
+    """Buffer of points (name, labels, value, timestamp in ns), sent in batches.
+
+    A thread sends the buffered points every `flush_interval` seconds. When the buffer holds
+    `buffer_size` points, new points are dropped, so a slow or unreachable destination does not
+    slow down the processing of the messages. `on_sent(sink name, count)` and
+    `on_dropped(sink name, count, reason)` are called for each batch sent, and for the points
+    dropped.
+    """
+
+    def __init__(self, name, buffer_size=10000, flush_interval=1.0, on_sent=None, on_dropped=None):
+        self.name = name
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.on_sent = on_sent
+        self.on_dropped = on_dropped
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @property
+    def pending(self):
+        """Number of points waiting to be sent."""
+        return len(self._buffer)
+
+    def add(self, name, labels, value, timestamp):
+        """Buffer a point, `labels` being a tuple of (name, value)."""
+        with self._lock:
+            if len(self._buffer) < self.buffer_size:
+                self._buffer.append((name, labels, value, timestamp))
+                return
+        if self.on_dropped is not None:
+            self.on_dropped(self.name, 1, BUFFER_FULL)
+
+    def flush(self):
+        """Send the buffered points."""
+        with self._lock:
+            points, self._buffer = self._buffer, []
+        if not points:
+            return
+
+        try:
+            self.send(points)
+        except OSError as error:
+            LOG.warning('failed to send %d points to sink "%s": %s', len(points), self.name, error)
+            if self.on_dropped is not None:
+                self.on_dropped(self.name, len(points), SEND_ERROR)
+            return
+        if self.on_sent is not None:
+            self.on_sent(self.name, len(points))
+
+    def send(self, points):
+        """Send a batch of points, raise OSError on failure."""
+        raise NotImplementedError
+
+    def start(self):
+        """Start the thread sending the points."""
+        self._thread = threading.Thread(target=self._flush_loop, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop the thread, after sending the buffered points."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+    def _flush_loop(self):
+        while not self._stopped.wait(self.flush_interval):
+            self.flush()
+
+
+def _datagrams(lines):
+    """Pack lines in datagrams of at most MAX_DATAGRAM_SIZE bytes (unless a line is larger)."""
+    datagram = []
+    size = 0
+    for line in lines:
+        encoded = line.encode("utf-8")
+        if datagram and size + len(encoded) + 1 > MAX_DATAGRAM_SIZE:
+            yield b"\n".join(datagram)
+            datagram = []
+            size = 0
+        datagram.append(encoded)
+        size += len(encoded) + 1
+    if datagram:
+        yield b"\n".join(datagram)
+
+
+class _UdpSender:
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+
+    def sendall(self, datagrams):
+        addresses = socket.getaddrinfo(self.host, self.port, type=socket.SOCK_DGRAM)
+        family, _, _, _, address = addresses[0]
+        with socket.socket(family, socket.SOCK_DGRAM) as sock:
+            for datagram in datagrams:
+                sock.sendto(datagram, address)
+
+
+def _escape_tag(value):
+    return _INFLUX_TAG_ESCAPE.sub(r"\\\1", value)
+
+
+def influx_line(name, labels, value, timestamp):
+    """Format a point in the InfluxDB line protocol, labels being tags (empty ones omitted).
+
+    Return None for NaN and infinite values, which InfluxDB rejects with the whole batch.
+    """
+    if not math.isfinite(value):
+        return None
+    tags = "".join(
+        f",{_escape_tag(key)}={_escape_tag(str(tag))}" for key, tag in sorted(labels) if tag != ""
+    )
+    measurement = _INFLUX_MEASUREMENT_ESCAPE.sub(r"\\\1", name)
+    return f"{measurement}{tags} value={float(value)!r} {timestamp}"
+
+
+def _influx_line(point):
+    return influx_line(*point)
+
+
+class InfluxHttpSink(Sink):
+    """Send the points in the InfluxDB line protocol to a write URL (v1 /write or v2 /api/v2/write).
+
+    The API token (InfluxDB 2) or "username:password" (InfluxDB 1.8+) is given as credentials of
+    the URL, and sent as a token.
+    """
+
+    def __init__(self, url, **kwargs):
+        parts = urlsplit(url)
+        self.token = parts.password
+        if parts.username and parts.password:
+            self.token = f"{parts.username}:{parts.password}"
+        netloc = parts.hostname if parts.port is None else f"{parts.hostname}:{parts.port}"
+        self.url = urlunsplit(parts._replace(netloc=netloc))
+        super().__init__(urlunsplit(parts._replace(netloc=netloc, query="")), **kwargs)
+
+    def send(self, points):
+        lines = [line for line in map(_influx_line, points) if line is not None]
+        if not lines:
+            return
+        body = "\n".join(lines).encode("utf-8")
+        # the URL scheme is http or https, checked by parse_sinks
+        request = urllib.request.Request(self.url, data=body, method="POST")  # noqa: S310
+        request.add_header("Content-Type", "text/plain; charset=utf-8")
+        if self.token:
+            request.add_header("Authorization", f"Token {self.token}")
+        with urllib.request.urlopen(request, timeout=HTTP_TIMEOUT) as response:  # noqa: S310
+            response.read()
+
+
+class InfluxUdpSink(Sink):
+    """Send the points in the InfluxDB line protocol over UDP (InfluxDB 1 UDP listener, Telegraf)."""
+
+    def __init__(self, host, port, **kwargs):
+        self._sender = _UdpSender(host, port)
+        super().__init__(f"influx+udp://{host}:{port}", **kwargs)
+
+    def send(self, points):
+        lines = (line for line in map(_influx_line, points) if line is not None)
+        self._sender.sendall(_datagrams(lines))
+
+
+def statsd_lines(name, labels, value, dogstatsd=False):
+    """Format a gauge point for StatsD (label values appended to the name) or DogStatsD (tags).
+
+    NaN and infinite values have no line.
+    """
+    if not math.isfinite(value):
+        return []
+    if dogstatsd:
+        tags = ",".join(
+            f"{key}:{_STATSD_INVALID_CHARS.sub('_', str(tag))}" for key, tag in labels if tag != ""
+        )
+        return [f"{name}:{value}|g|#{tags}" if tags else f"{name}:{value}|g"]
+
+    path = ".".join(
+        [name, *(_STATSD_INVALID_CHARS.sub("_", str(tag)).replace(".", "_") for _, tag in labels)]
+    )
+    if value < 0:
+        # a signed StatsD gauge value is relative to the previous value
+        return [f"{path}:0|g", f"{path}:{value}|g"]
+    return [f"{path}:{value}|g"]
+
+
+class StatsdSink(Sink):
+    """Send the points as StatsD, or DogStatsD with the labels as tags, gauges over UDP."""
+
+    def __init__(self, host, port, dogstatsd=False, **kwargs):
+        self.dogstatsd = dogstatsd
+        self._sender = _UdpSender(host, port)
+        super().__init__(f"{'dogstatsd' if dogstatsd else 'statsd'}://{host}:{port}", **kwargs)
+
+    def send(self, points):
+        self._sender.sendall(
+            _datagrams(
+                line
+                for name, labels, value, _ in points
+                for line in statsd_lines(name, labels, value, self.dogstatsd)
+            )
+        )
+
+
+def parse_sinks(value, **kwargs):
+    """Parse sinks definition, separated by ";".
+
+    - influx+http://[:token@]host:port/write?db=... or /api/v2/write?org=...&bucket=...
+    - influx+udp://host:port
+    - statsd://host:port, dogstatsd://host:port
+
+    `kwargs` are the options of each sink (buffer size, flush interval, callbacks).
+    """
+    sinks = []
+    for definition in (definition.strip() for definition in value.split(";")):
+        if not definition:
+            continue
+        parts = urlsplit(definition)
+        try:
+            if parts.scheme in ("influx+http", "influx+https"):
+                url = urlunsplit(parts._replace(scheme=parts.scheme.removeprefix("influx+")))
+                sinks.append(InfluxHttpSink(url, **kwargs))
+                continue
+            if not parts.hostname or not parts.port:
+                raise ValueError("host and port are required")
+            if parts.scheme == "influx+udp":
+                sinks.append(InfluxUdpSink(parts.hostname, parts.port, **kwargs))
+            elif parts.scheme in ("statsd", "dogstatsd"):
+                sinks.append(
+                    StatsdSink(
+                        parts.hostname, parts.port, dogstatsd=parts.scheme == "dogstatsd", **kwargs
+                    )
+                )
+            else:
+                raise ValueError(f"unknown sink type {parts.scheme}")
+        except ValueError as error:
+            raise ValueError(f"invalid sink definition '{definition}': {error}")
+
+    return sinks
@@ -0,0 +1,122 @@
+"""Heavy hitters tracking in a fixed memory footprint."""
+
+import heapq
+import threading
+from operator import itemgetter
+
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+
+class SpaceSaving:
+    """Space-Saving sketch of the `capacity` keys having the largest weights.
+
+    When the sketch is full, a new key replaces the key having the smallest weight, and
+    inherits its weight as overestimation error. The weight of a tracked key is at most
+    overestimated by `error`, and any key heavier than total / capacity is tracked.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.total = 0
+        self._weights = {}
+        self._errors = {}
+        # min-heap of (weight, key), with stale entries skipped when popped
+        self._heap = []
+
+    def __len__(self):
+        return len(self._weights)
+
+    def add(self, key, weight=1):
+        """Account for `weight` more for `key`."""
+        self.total += weight
+        weights = self._weights
+        if key in weights:
+            if not weight:
+                return
+            weights[key] += weight
+        elif len(weights) < self.capacity:
+            weights[key] = weight
+            self._errors[key] = 0
+        else:
+            evicted, minimum = self._pop_min()
+            del weights[evicted]
+            del self._errors[evicted]
+            weights[key] = minimum + weight
+            self._errors[key] = minimum
+
+        heapq.heappush(self._heap, (weights[key], key))
+        if len(self._heap) > 4 * self.capacity:
+            self._heap = [(value, key) for key, value in weights.items()]
+            heapq.heapify(self._heap)
+
+    def _pop_min(self):
+        while True:
+            weight, key = heapq.heappop(self._heap)
+            if self._weights.get(key) == weight:
+                return key, weight
+
+    def top(self, n):
+        """Return the `n` heaviest keys as (key, weight, error), heaviest first."""
+        return [
+            (key, weight, self._errors[key])
+            for key, weight in heapq.nlargest(n, self._weights.items(), key=itemgetter(1))
+        ]
+
+
+class TopicStats:
+    """Top topics by number of messages, bytes and processing time (collector)."""
+
+    DIMENSIONS = {
+        "messages": "Estimated number of messages of the busiest topics",
+        "bytes": "Estimated payload bytes of the topics receiving the most data",
+        "processing_seconds": "Estimated processing time of the most expensive topics",
+    }
+
+    def __init__(self, capacity, exposed=10, prefix="mqtt_"):
+        self.exposed = exposed
+        self.prefix = prefix
+        self.sketches = {dimension: SpaceSaving(capacity) for dimension in self.DIMENSIONS}
+        # messages of several brokers are processed concurrently
+        self._lock = threading.Lock()
+
+    @property
+    def entries(self):
+        """Number of topics tracked, summed over the dimensions."""
+        return sum(len(sketch) for sketch in self.sketches.values())
+
+    def record(self, topic, size, duration):
+        """Account for one message of `size` bytes processed in `duration` seconds."""
+        sketches = self.sketches
+        with self._lock:
+            sketches["messages"].add(topic)
+            sketches["bytes"].add(topic, size)
+            sketches["processing_seconds"].add(topic, duration)
+
+    def top(self, n=None):
+        """Top topics of each dimension, with the total of all the topics."""
+        n = self.exposed if n is None else n
+        with self._lock:
+            return {
+                dimension: {
+                    "total": sketch.total,
+                    "top": [
+                        {"topic": topic, "value": value, "max_error": error}
+                        for topic, value, error in sketch.top(n)
+                    ],
+                }
+                for dimension, sketch in self.sketches.items()
+            }
+
+    def collect(self):
+        for dimension, stats in self.top().items():
+            top = GaugeMetricFamily(
+                f"{self.prefix}top_topic_{dimension}", self.DIMENSIONS[dimension], labels=["topic"]
+            )
+            for entry in stats["top"]:
+                top.add_metric([entry["topic"]], entry["value"])
+            yield top
+            yield CounterMetricFamily(
+                f"{self.prefix}observed_{dimension}",
+                f"Total observed by the top topics tracking ({dimension})",
+                value=stats["total"],
+            )
@@ -0,0 +1,245 @@
+"""Sources of messages other than a broker: NDJSON or `topic payload` lines."""
+
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+
+LOG = logging.getLogger("mqtt-exporter")
+
+# bytes read at once, and lines processed in a batch
+READ_BUFFER_SIZE = 1 << 20
+# seconds between two checks of a followed file at its end
+FOLLOW_INTERVAL = 0.2
+
+
+class Message:
+    """Message read from a source, with the attributes of the MQTT messages used to process it."""
+
+    __slots__ = ("topic", "payload", "properties")
+
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+        self.properties = None
+
+
+def parse_line(line):
+    """Parse a line, return its message or None if it is invalid.
+
+    Lines are either JSON objects with `topic` and `payload` (as written by `mosquitto_sub -F %j`),
+    or `topic payload` (as written by `mosquitto_sub -v`).
+    """
+    line = line.strip()
+    if not line:
+        return None
+
+    if line[:1] == b"{":
+        try:
+            record = json.loads(line)
+        except ValueError:
+            return None
+        topic = record.get("topic")
+        payload = record.get("payload")
+        if not isinstance(topic, str) or payload is None:
+            return None
+        if not isinstance(payload, str):
+            # payloads which are valid JSON are embedded as JSON values
+            payload = json.dumps(payload)
+        return Message(topic, payload)
+
+    topic, sep, payload = line.partition(b" ")
+    if not sep:
+        return None
+    return Message(topic.decode("utf-8", "replace"), payload)
+
+
+class Source:
+    """Lines of messages read in bulk, and processed in batches with `process(None, userdata, msg)`.
+
+    The batches of the connections of a source are processed one at a time, with the same
+    callback as the messages of a broker. `on_invalid(name)` is called for each invalid line.
+    """
+
+    def __init__(self, name, on_invalid=None):
+        self.name = name
+        self.on_invalid = on_invalid
+        self.userdata = {"client_id": "", "broker": None}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def run(self, process):
+        """Read and process the messages until the end of the source, return their number."""
+        raise NotImplementedError
+
+    def stop(self):
+        """Stop reading the source."""
+        self._stopped.set()
+
+    def _read(self, stream, process, partial=b""):
+        """Process the complete lines of a stream, return their number and the partial last line."""
+        count = 0
+        userdata = self.userdata
+        while not self._stopped.is_set():
+            lines = stream.readlines(READ_BUFFER_SIZE)
+            if not lines:
+                break
+            if partial:
+                lines[0] = partial + lines[0]
+                partial = b""
+            if not lines[-1].endswith(b"\n"):
+                # the end of the line is not written yet
+                partial = lines.pop()
+
+            with self._lock:
+                for line in lines:
+                    msg = parse_line(line)
+                    if msg is None:
+                        if line.strip():
+                            LOG.debug("invalid line from %s: %s", self.name, line)
+                            if self.on_invalid is not None:
+                                self.on_invalid(self.name)
+                        continue
+                    process(None, userdata, msg)
+                    count += 1
+
+        return count, partial
+
+    def _read_last_line(self, line, process):
+        """Process the last line of a stream, not ended by a new line."""
+        msg = parse_line(line)
+        if msg is None:
+            return 0
+        with self._lock:
+            process(None, self.userdata, msg)
+        return 1
+
+
+class StdinSource(Source):
+    """Messages read from the standard input, until its end."""
+
+    def __init__(self, **kwargs):
+        super().__init__("stdin", **kwargs)
+
+    def run(self, process):
+        stream = os.fdopen(sys.stdin.fileno(), "rb", buffering=READ_BUFFER_SIZE, closefd=False)
+        count, partial = self._read(stream, process)
+        if partial:
+            count += self._read_last_line(partial, process)
+        return count
+
+
+class FileSource(Source):
+    """Messages read from a file, then from the lines appended to it with `follow`.
+
+    A followed file is read again from its start when it is truncated or replaced (rotation).
+    """
+
+    def __init__(self, path, follow=False, **kwargs):
+        super().__init__(path, **kwargs)
+        self.path = path
+        self.follow = follow
+
+    def run(self, process):
+        count = 0
+        partial = b""
+        stream = open(self.path, "rb", buffering=READ_BUFFER_SIZE)
+        try:
+            while True:
+                read, partial = self._read(stream, process, partial)
+                count += read
+                if not self.follow or self._stopped.wait(FOLLOW_INTERVAL):
+                    break
+                if self._rotated(stream):
+                    LOG.info("%s was truncated or replaced, reading it from the start", self.path)
+                    # lines written before the rotation
+                    count += self._read(stream, process, partial)[0]
+                    stream.close()
+                    stream = open(self.path, "rb", buffering=READ_BUFFER_SIZE)
+                    partial = b""
+        finally:
+            stream.close()
+
+        if partial and not self.follow:
+            count += self._read_last_line(partial, process)
+        return count
+
+    def _rotated(self, stream):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            # being replaced
+            return False
+        return stat.st_ino != os.fstat(stream.fileno()).st_ino or stat.st_size < stream.tell()
+
+
+class UnixSocketSource(Source):
+    """Messages written by other processes to a Unix stream socket, one thread per connection."""
+
+    def __init__(self, path, **kwargs):
+        super().__init__(path, **kwargs)
+        self.path = path
+        self._server = None
+
+    def run(self, process):
+        if os.path.exists(self.path):
+            # left by a previous run
+            os.unlink(self.path)
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(self.path)
+        self._server.listen()
+        counts = []
+        try:
+            while not self._stopped.is_set():
+                try:
+                    connection, _ = self._server.accept()
+                except OSError:
+                    # closed by stop()
+                    break
+                threading.Thread(
+                    target=self._read_connection, args=(connection, process, counts), daemon=True
+                ).start()
+        finally:
+            self._server.close()
+        # messages of the connections closed
+        return sum(counts)
+
+    def _read_connection(self, connection, process, counts):
+        with connection, connection.makefile("rb", buffering=READ_BUFFER_SIZE) as stream:
+            try:
+                count, partial = self._read(stream, process)
+            except OSError as error:
+                LOG.warning("failed to read from %s: %s", self.path, error)
+                return
+        if partial:
+            count += self._read_last_line(partial, process)
+        counts.append(count)
+
+    def stop(self):
+        super().stop()
+        if self._server is not None:
+            try:
+                # unblock accept()
+                self._server.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self._server.close()
+
+
+def parse_source(value, **kwargs):
+    """Parse a source: "stdin" (or "-"), "file:PATH", "tail:PATH" (followed) or "unix:PATH"."""
+    if value in ("stdin", "-"):
+        return StdinSource(**kwargs)
+
+    kind, sep, path = value.partition(":")
+    if not sep or not path:
+        raise ValueError(f"invalid source: {value}")
+    if kind == "file":
+        return FileSource(path, **kwargs)
+    if kind == "tail":
+        return FileSource(path, follow=True, **kwargs)
+    if kind == "unix":
+        return UnixSocketSource(path, **kwargs)
+    raise ValueError(f"unknown source type {kind}")
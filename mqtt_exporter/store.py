@@ -0,0 +1,109 @@
+"""Series references of the topics, safe to update from several threads."""
+
+import sys
+import threading
+
+DEFAULT_SHARDS = 64
+
+
+class _Shard:
+    __slots__ = ("refs", "lock")
+
+    def __init__(self):
+        # topic: set of series references
+        self.refs = {}
+        self.lock = threading.Lock()
+
+
+class SeriesStore:
+    """Series references of each topic, sharded by topic hash with one lock per shard.
+
+    Threads updating topics of different shards do not contend, which matters on free-threaded
+    Python builds. Readers get snapshots (tuples), never the sets being updated.
+    `on_new_topic(topic)` and `on_removed_topic(topic)` are called under the lock of the topic
+    shard, so they are called in the same order as the topic updates.
+    """
+
+    def __init__(self, shards=DEFAULT_SHARDS, on_new_topic=None, on_removed_topic=None):
+        # power of two, to select the shard with a mask
+        size = 1 << max(shards - 1, 0).bit_length()
+        self._shards = tuple(_Shard() for _ in range(size))
+        self._mask = size - 1
+        self.on_new_topic = on_new_topic
+        self.on_removed_topic = on_removed_topic
+
+    def _shard(self, topic):
+        return self._shards[hash(topic) & self._mask]
+
+    def add(self, topic, ref):
+        """Add a series reference to a topic, return True if the topic is new."""
+        shard = self._shard(topic)
+        # most samples update known series: checked without taking the lock
+        refs = shard.refs.get(topic)
+        if refs is not None and ref in refs:
+            return False
+
+        with shard.lock:
+            refs = shard.refs.get(topic)
+            if refs is not None:
+                refs.add(ref)
+                return False
+
+            # the topic is kept as long as its series, shared with the topic index
+            topic = sys.intern(topic)
+            shard.refs[topic] = {ref}
+            if self.on_new_topic is not None:
+                self.on_new_topic(topic)
+            return True
+
+    def pop(self, topic, default=()):
+        """Remove a topic, return its series references."""
+        shard = self._shard(topic)
+        with shard.lock:
+            refs = shard.refs.pop(topic, None)
+            if refs is None:
+                return default
+            if self.on_removed_topic is not None:
+                self.on_removed_topic(topic)
+            return tuple(refs)
+
+    def get(self, topic, default=None):
+        """Series references of a topic."""
+        shard = self._shard(topic)
+        with shard.lock:
+            refs = shard.refs.get(topic)
+            return default if refs is None else tuple(refs)
+
+    def __getitem__(self, topic):
+        refs = self.get(topic)
+        if refs is None:
+            raise KeyError(topic)
+        return refs
+
+    def __contains__(self, topic):
+        return topic in self._shard(topic).refs
+
+    def __len__(self):
+        return sum(len(shard.refs) for shard in self._shards)
+
+    def __iter__(self):
+        """Iterate over a snapshot of the topics."""
+        topics = []
+        for shard in self._shards:
+            with shard.lock:
+                topics.extend(shard.refs)
+        return iter(topics)
+
+    def items(self):
+        """Snapshot of the topics and their series references."""
+        items = []
+        for shard in self._shards:
+            with shard.lock:
+                items.extend((topic, tuple(refs)) for topic, refs in shard.refs.items())
+        return items
+
+    def clear(self):
+        """Remove all the topics, without calling `on_removed_topic`."""
+        for shard in self._shards:
+            with shard.lock:
+                shard.refs.clear()
@@ -0,0 +1,184 @@
+"""Watchdog of the MQTT network loop, delayed by the processing of the messages."""
+
+import logging
+import struct
+import threading
+import time
+
+try:
+    import fcntl
+    import termios
+except ImportError:  # not available on Windows
+    fcntl = None
+
+LOG = logging.getLogger("mqtt-exporter")
+
+# consecutive checks with a lag below half the threshold before the load shedding stops
+RECOVERY_CHECKS = 5
+
+
+def socket_backlog(sock):
+    """Number of bytes received by a socket and not read yet, 0 if unknown."""
+    if sock is None or fcntl is None:
+        return 0
+    try:
+        pending = fcntl.ioctl(sock.fileno(), termios.FIONREAD, b"\0\0\0\0")
+    except (OSError, ValueError):
+        return 0
+    return struct.unpack("i", pending)[0]
+
+
+class Watchdog:
+    """Measure the lag of the MQTT network loop, and shed load when it exceeds `threshold` seconds.
+
+    The message callbacks run on the network loop thread: while a message is processed, the loop
+    neither reads the socket nor sends the keepalive pings, and the broker disconnects a client
+    whose pings are late. Every `interval` seconds, the lag is estimated as the longest of:
+    - the time spent in the callbacks currently running,
+    - the time to process the bytes waiting in the sockets (`backlog()`), at the throughput of
+      the callbacks since the previous check.
+
+    When the lag exceeds the threshold, the `slow_topics` slowest topics since the previous check
+    are logged. With `shed_load`, the messages are then only counted by `on_shed()`, without
+    being processed, until the lag stays below half the threshold for RECOVERY_CHECKS checks.
+    `on_duration(seconds)` is called for each callback, `on_check(lag, shedding)` for each check.
+    """
+
+    def __init__(
+        self,
+        threshold,
+        interval=1.0,
+        slow_topics=10,
+        shed_load=False,
+        backlog=None,
+        on_duration=None,
+        on_shed=None,
+        on_check=None,
+    ):
+        self.threshold = threshold
+        self.interval = interval
+        self.slow_topics = slow_topics
+        self.shed_load = shed_load
+        self.backlog = backlog
+        self.on_duration = on_duration
+        self.on_shed = on_shed
+        self.on_check = on_check
+        self.shedding = False
+        self._overloaded = False
+        self._recovering = 0
+        # thread: start time of the callback it is running, None between callbacks
+        self._running = {}
+        # processing time and bytes since the previous check
+        self._busy = 0.0
+        self._bytes = 0
+        # topic: longest callback since the previous check, the `slow_topics` slowest only
+        self._slowest = {}
+        self._slowest_min = 0.0
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def measure(self, callback):
+        """Wrap a message callback to measure its duration, or skip it while shedding load."""
+        running = self._running
+
+        def watched(client, userdata, msg):
+            if self.shedding:
+                if self.on_shed is not None:
+                    self.on_shed()
+                return
+
+            thread = threading.get_ident()
+            start = running[thread] = time.perf_counter()
+            try:
+                callback(client, userdata, msg)
+            finally:
+                duration = time.perf_counter() - start
+                running[thread] = None
+                self.record(msg.topic, len(msg.topic) + len(msg.payload), duration)
+
+        return watched
+
+    def record(self, topic, size, duration):
+        """Account for a message of `size` bytes processed in `duration` seconds."""
+        if self.on_duration is not None:
+            self.on_duration(duration)
+
+        with self._lock:
+            self._busy += duration
+            self._bytes += size
+            if duration <= self._slowest_min or duration <= self._slowest.get(topic, 0):
+                return
+            slowest = self._slowest
+            slowest[topic] = duration
+            if len(slowest) > self.slow_topics:
+                del slowest[min(slowest, key=slowest.__getitem__)]
+            if len(slowest) == self.slow_topics:
+                self._slowest_min = min(slowest.values())
+
+    def check(self):
+        """Estimate the lag, update the load shedding state, and return the lag."""
+        now = time.perf_counter()
+        with self._lock:
+            busy, size, slowest = self._busy, self._bytes, self._slowest
+            self._busy = 0.0
+            self._bytes = 0
+            self._slowest = {}
+            self._slowest_min = 0.0
+
+        lag = max((now - start for start in list(self._running.values()) if start), default=0.0)
+        backlog = self.backlog() if self.backlog is not None else 0
+        if backlog and size:
+            lag = max(lag, backlog * busy / size)
+
+        self._update(lag, slowest)
+        if self.on_check is not None:
+            self.on_check(lag, self.shedding)
+        return lag
+
+    def _update(self, lag, slowest):
+        if lag > self.threshold:
+            self._recovering = 0
+            if self._overloaded:
+                return
+            self._overloaded = True
+            topics = sorted(slowest.items(), key=lambda item: item[1], reverse=True)
+            LOG.warning(
+                "network loop lag of %.3fs over %.3fs, slowest topics: %s",
+                lag,
+                self.threshold,
+                ", ".join(f"{topic} ({duration:.3f}s)" for topic, duration in topics) or "none",
+            )
+            if self.shed_load:
+                LOG.warning("shedding load: messages are counted but not processed")
+                self.shedding = True
+            return
+
+        if not self._overloaded or lag >= self.threshold / 2:
+            self._recovering = 0
+            return
+        self._recovering += 1
+        if self._recovering >= RECOVERY_CHECKS:
+            LOG.warning("network loop lag recovered (%.3fs)", lag)
+            self._overloaded = False
+            self._recovering = 0
+            self.shedding = False
+
+    def start(self):
+        """Start the thread checking the lag."""
+        self._thread = threading.Thread(target=self._check_loop, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop the thread."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _check_loop(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.check()
+            except Exception:
+                LOG.exception("failed to check the network loop lag")
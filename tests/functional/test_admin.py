@@ -0,0 +1,105 @@
+"""Functional tests of the admin API."""
+
+import json
+
+import prometheus_client
+import pytest
+
+from mqtt_exporter import main, server, settings
+from mqtt_exporter.brokers import BrokerConfig
+from mqtt_exporter.cache import LockedLRUCache
+from mqtt_exporter.main import PipelineConfig
+from mqtt_exporter.shards import TopicIndex
+
+
+@pytest.fixture(name="admin_api")
+def fixture_admin_api(mocker):
+    """Process a few messages, and serve the admin API."""
+    # pylama: ignore=W0212
+    collectors = list(prometheus_client.REGISTRY._collector_to_names.keys())
+    for collector in collectors:
+        prometheus_client.REGISTRY.unregister(collector)
+    main.prom_metrics = {}
+    main.metric_refs.clear()
+    settings.MQTT_EXPOSE_CLIENT_ID = False
+    main._create_msg_counter_metrics()
+    main._create_dedup_metrics()
+    mocker.patch.object(main, "topic_index", TopicIndex())
+    mocker.patch.dict(server._routes)
+    server.add_route("/api/v1/series", main._series_endpoint, methods=("GET", "DELETE"))
+    server.add_route("/api/v1/cardinality", main._cardinality_endpoint)
+
+    pipeline = main.build_pipeline(
+        PipelineConfig(expose_last_seen=True, dedup_cache_size=10, admin_api=True)
+    )
+    # the series are deleted by the HTTP server thread, clearing the dedup cache
+    assert isinstance(pipeline.dedup_cache, LockedLRUCache)
+    userdata = {"client_id": "", "broker": BrokerConfig()}
+    for topic, payload in (
+        ("zigbee2mqtt/old_sensor_1", '{"temperature": 21, "humidity": 40}'),
+        ("zigbee2mqtt/old_sensor_2", '{"temperature": 22}'),
+        ("zigbee2mqtt/kitchen", '{"temperature": 23}'),
+    ):
+        msg = mocker.Mock()
+        msg.topic = topic
+        msg.payload = payload
+        msg.properties = None
+        pipeline.on_message(None, userdata, msg)
+
+
+def _request(method, path, query=""):
+    responses = []
+    body = server.make_app()(
+        {"PATH_INFO": path, "QUERY_STRING": query, "REQUEST_METHOD": method},
+        lambda status, headers: responses.append(status),
+    )
+    return responses[0], json.loads(b"".join(body))
+
+
+@pytest.mark.usefixtures("admin_api")
+def test_admin__list_series():
+    """List the series of a topic, or of the topics starting with a prefix."""
+    status, body = _request("GET", "/api/v1/series", "topic=zigbee2mqtt/old_sensor_2")
+
+    assert status == "200 OK"
+    assert sorted(body["zigbee2mqtt/old_sensor_2"], key=lambda series: series["metric"]) == [
+        {"metric": "mqtt_temperature", "labels": {"topic": "zigbee2mqtt_old_sensor_2"}},
+        {"metric": "mqtt_temperature_ts", "labels": {"topic": "zigbee2mqtt_old_sensor_2"}},
+    ]
+
+    _, body = _request("GET", "/api/v1/series", "topic_prefix=zigbee2mqtt/old")
+    assert sorted(body) == ["zigbee2mqtt/old_sensor_1", "zigbee2mqtt/old_sensor_2"]
+
+    assert _request("GET", "/api/v1/series")[0] == "400 Bad Request"
+
+
+@pytest.mark.usefixtures("admin_api")
+def test_admin__cardinality():
+    """Count the series per metric and topic."""
+    status, body = _request("GET", "/api/v1/cardinality", "limit=1")
+
+    assert status == "200 OK"
+    assert body["series"] == 8
+    assert body["topics_count"] == 3
+    assert body["metrics"] == {"mqtt_temperature": 3}
+    assert body["topics"] == {"zigbee2mqtt/old_sensor_1": 4}
+
+
+@pytest.mark.usefixtures("admin_api")
+def test_admin__delete_series():
+    """Delete the series and message counters of the topics matching a pattern."""
+    status, body = _request("DELETE", "/api/v1/series", "match=zigbee2mqtt/old_sensor_*")
+
+    assert status == "200 OK"
+    assert body == {"topics": 2, "series": 6}
+    assert sorted(main.metric_refs) == ["zigbee2mqtt/kitchen"]
+    registry = prometheus_client.REGISTRY
+    assert (
+        registry.get_sample_value("mqtt_temperature", {"topic": "zigbee2mqtt_old_sensor_1"}) is None
+    )
+    assert (
+        registry.get_sample_value("mqtt_message_total", {"topic": "zigbee2mqtt_old_sensor_1"})
+        is None
+    )
+    assert registry.get_sample_value("mqtt_temperature", {"topic": "zigbee2mqtt_kitchen"}) == 23
+    assert registry.get_sample_value("mqtt_message_total", {"topic": "zigbee2mqtt_kitchen"}) == 1
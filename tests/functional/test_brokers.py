@@ -0,0 +1,131 @@
+"""Functional tests of multiple brokers support."""
+
+import prometheus_client
+
+from mqtt_exporter import main, settings
+from mqtt_exporter.brokers import BrokerConfig
+from mqtt_exporter.main import MessagePipeline, PipelineConfig
+
+
+def _reset():
+    # pylama: ignore=W0212
+    collectors = list(prometheus_client.REGISTRY._collector_to_names.keys())
+    for collector in collectors:
+        prometheus_client.REGISTRY.unregister(collector)
+    main.prom_metrics = {}
+    settings.MQTT_EXPOSE_CLIENT_ID = False
+
+
+def _msg(mocker, topic, payload):
+    msg = mocker.Mock()
+    msg.topic = topic
+    msg.payload = payload
+    msg.properties = None
+    return msg
+
+
+def test_brokers__broker_label(mocker):
+    """The same topic from two brokers is exposed as two series."""
+    _reset()
+    main._create_msg_counter_metrics(expose_broker=True)
+    pipeline = MessagePipeline(PipelineConfig(expose_broker=True, dedup_cache_size=10))
+    main._create_dedup_metrics()
+
+    for name, value in (("site1", 1), ("site2", 2)):
+        userdata = {"client_id": "", "broker": BrokerConfig(name=name)}
+        pipeline.on_message(None, userdata, _msg(mocker, "room/sensor", f'{{"power": {value}}}'))
+
+    registry = prometheus_client.REGISTRY
+    assert registry.get_sample_value("mqtt_power", {"topic": "room_sensor", "broker": "site1"}) == 1
+    assert registry.get_sample_value("mqtt_power", {"topic": "room_sensor", "broker": "site2"}) == 2
+    assert (
+        registry.get_sample_value("mqtt_message_total", {"topic": "room_sensor", "broker": "site2"})
+        == 1
+    )
+
+
+def test_brokers__derived_metrics(mocker):
+    """Derived metrics of the same topic are computed per broker, and can be deleted."""
+    _reset()
+    main._create_msg_counter_metrics(expose_broker=True)
+    main.metric_refs.clear()
+    main.build_pipeline(
+        PipelineConfig(
+            expose_broker=True, derived_metrics=(("mqtt_power", "mqtt_voltage * mqtt_current"),)
+        )
+    )
+
+    for name, voltage in (("site1", 230), ("site2", 120)):
+        userdata = {"client_id": "", "broker": BrokerConfig(name=name)}
+        payload = f'{{"voltage": {voltage}, "current": 2}}'
+        main._dispatch_message(None, userdata, _msg(mocker, "dev/plug", payload))
+
+    registry = prometheus_client.REGISTRY
+    assert registry.get_sample_value("mqtt_power", {"topic": "dev_plug", "broker": "site1"}) == 460
+    assert registry.get_sample_value("mqtt_power", {"topic": "dev_plug", "broker": "site2"}) == 240
+
+    assert main.delete_series(["dev/plug"]) == 6
+    assert registry.get_sample_value("mqtt_power", {"topic": "dev_plug", "broker": "site1"}) is None
+    assert (
+        registry.get_sample_value("mqtt_message_total", {"topic": "dev_plug", "broker": "site1"})
+        is None
+    )
+
+
+def test_brokers__connection_state(mocker):
+    """Connection and ingestion metrics are exposed per broker."""
+    _reset()
+    main._create_broker_metrics()
+    main.build_pipeline(PipelineConfig(parse_msg_payload=False))
+    main._create_msg_counter_metrics()
+    broker = BrokerConfig(name="site1", topic="a/#,b/#")
+    client = mocker.Mock()
+    userdata = {"client_id": "", "broker": broker}
+
+    main.subscribe(client, userdata, None, 0, None)
+    assert client.subscribe.call_count == 2
+    registry = prometheus_client.REGISTRY
+    assert registry.get_sample_value("mqtt_broker_connected", {"broker": "site1"}) == 1
+
+    main._broker_dispatcher(broker)(client, userdata, _msg(mocker, "a/sensor", '{"power": 1}'))
+    assert registry.get_sample_value("mqtt_broker_messages_total", {"broker": "site1"}) == 1
+
+    main._on_disconnect(client, userdata, None, 7, None)
+    assert registry.get_sample_value("mqtt_broker_connected", {"broker": "site1"}) == 0
+    main.prom_broker_connected = None
+    main.prom_broker_messages = None
+
+
+def test_brokers__persistent_session_catch_up(mocker):
+    """On a resumed session, the latest message of each topic is processed after the backlog."""
+    _reset()
+    mocker.patch.object(main, "_catch_up_loop")
+    mocker.patch.object(main, "_client_backlog", return_value=0)
+    main._create_msg_counter_metrics()
+    main.build_pipeline(PipelineConfig(catch_up=True))
+    # the backlog is processed by the catch-up thread, sharing the caches
+    assert main.message_pipeline.config.concurrent
+    broker = BrokerConfig(
+        name="site1", topic="room/#", client_id="exporter", persistent_session=True
+    )
+    client = mocker.Mock()
+    userdata = {"client_id": "exporter", "broker": broker}
+    client.user_data_get.return_value = userdata
+    dispatch = main._create_catch_up([client], main._dispatch_message)
+
+    main.subscribe(client, userdata, mocker.Mock(session_present=True), 0, None)
+    client.subscribe.assert_called_once_with("room/#", qos=1)
+    for value in range(3):
+        dispatch(client, userdata, _msg(mocker, "room/sensor", f'{{"power": {value}}}'))
+
+    registry = prometheus_client.REGISTRY
+    assert registry.get_sample_value("mqtt_power", {"topic": "room_sensor"}) is None
+    assert registry.get_sample_value("mqtt_catch_up_pending_topics", {"broker": "site1"}) == 1
+
+    for _ in range(3):
+        userdata["catch_up"].check(0)
+    assert registry.get_sample_value("mqtt_power", {"topic": "room_sensor"}) == 2
+    assert registry.get_sample_value("mqtt_catch_up_messages", {"broker": "site1"}) == 3
+
+    dispatch(client, userdata, _msg(mocker, "room/sensor", '{"power": 5}'))
+    assert registry.get_sample_value("mqtt_power", {"topic": "room_sensor"}) == 5
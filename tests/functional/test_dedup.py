@@ -0,0 +1,95 @@
+"""Functional tests of repeated payload deduplication."""
+
+import prometheus_client
+
+from mqtt_exporter import main, settings
+
+
+def _reset():
+    # pylama: ignore=W0212
+    collectors = list(prometheus_client.REGISTRY._collector_to_names.keys())
+    for collector in collectors:
+        prometheus_client.REGISTRY.unregister(collector)
+    main.prom_metrics = {}
+    main.dedup_stats.update(hit=0, miss=0)
+
+
+def _msg(mocker, topic, payload):
+    msg = mocker.Mock()
+    msg.topic = topic
+    msg.payload = payload
+    msg.properties = None
+    return msg
+
+
+def _sample_value(name, labels):
+    return prometheus_client.REGISTRY.get_sample_value(name, labels)
+
+
+def test_dedup__identical_payload_is_not_parsed_again(mocker):
+    """A repeated payload only increments the message counter."""
+    _reset()
+    settings.MQTT_EXPOSE_CLIENT_ID = False
+    settings.EXPOSE_LAST_SEEN = True
+    settings.DEDUP_CACHE_SIZE = 10
+    try:
+        main._create_msg_counter_metrics()
+        main._create_dedup_metrics()
+        main.build_pipeline()
+        userdata = {"client_id": "test"}
+
+        clock = mocker.patch("mqtt_exporter.main.time.time", return_value=100)
+        main.expose_metrics(None, userdata, _msg(mocker, "dedup/sensor", '{"temperature": 20}'))
+        json_loads = mocker.spy(main.json, "loads")
+        clock.return_value = 200
+        main.expose_metrics(None, userdata, _msg(mocker, "dedup/sensor", '{"temperature": 20}'))
+
+        assert json_loads.call_count == 0
+        assert _sample_value("mqtt_temperature_ts", {"topic": "dedup_sensor"}) == 200
+        assert _sample_value("mqtt_message_total", {"topic": "dedup_sensor"}) == 2
+        assert _sample_value("mqtt_dedup_lookups_total", {"result": "hit"}) == 1
+        assert _sample_value("mqtt_dedup_lookups_total", {"result": "miss"}) == 1
+        assert _sample_value("mqtt_dedup_hit_ratio", {}) == 0.5
+    finally:
+        settings.EXPOSE_LAST_SEEN = False
+        settings.DEDUP_CACHE_SIZE = 0
+
+
+def test_dedup__changed_payload_is_parsed(mocker):
+    """A different payload for the same topic updates the metric."""
+    _reset()
+    settings.MQTT_EXPOSE_CLIENT_ID = False
+    settings.DEDUP_CACHE_SIZE = 10
+    try:
+        main._create_msg_counter_metrics()
+        main._create_dedup_metrics()
+        main.build_pipeline()
+        userdata = {"client_id": "test"}
+
+        main.expose_metrics(None, userdata, _msg(mocker, "dedup/sensor", '{"temperature": 20}'))
+        main.expose_metrics(None, userdata, _msg(mocker, "dedup/sensor", '{"temperature": 21}'))
+
+        assert _sample_value("mqtt_temperature", {"topic": "dedup_sensor"}) == 21
+        assert _sample_value("mqtt_dedup_lookups_total", {"result": "miss"}) == 2
+    finally:
+        settings.DEDUP_CACHE_SIZE = 0
+
+
+def test_dedup__rejected_payload_is_not_counted(mocker):
+    """A repeated invalid payload is skipped without being counted."""
+    _reset()
+    settings.MQTT_EXPOSE_CLIENT_ID = False
+    settings.DEDUP_CACHE_SIZE = 10
+    try:
+        main._create_msg_counter_metrics()
+        main._create_dedup_metrics()
+        main.build_pipeline()
+        userdata = {"client_id": "test"}
+
+        for _ in range(2):
+            main.expose_metrics(None, userdata, _msg(mocker, "dedup/sensor", "not json"))
+
+        assert _sample_value("mqtt_message_total", {"topic": "dedup_sensor"}) is None
+        assert _sample_value("mqtt_dedup_lookups_total", {"result": "hit"}) == 1
+    finally:
+        settings.DEDUP_CACHE_SIZE = 0
@@ -0,0 +1,641 @@
+"""Functional tests of the message pipeline."""
+
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import prometheus_client
+import pytest
+
+from mqtt_exporter import main, settings
+from mqtt_exporter.cache import LockedLRUCache
+from mqtt_exporter.cardinality import LabelCardinality
+from mqtt_exporter.counters import CounterDetector
+from mqtt_exporter.deadletter import DeadLetters
+from mqtt_exporter.ingest import IngestWorkers
+from mqtt_exporter.main import MessagePipeline, PipelineConfig, PromMetricId
+from mqtt_exporter.memory import MemoryBudget
+from mqtt_exporter.offload import Offloader
+from mqtt_exporter.ratelimit import parse_rate_limits
+from mqtt_exporter.sinks import Sink
+from mqtt_exporter.sketch import TopicStats
+from mqtt_exporter.sources import FileSource
+from mqtt_exporter.store import SeriesStore
+
+
+def _reset():
+    # pylama: ignore=W0212
+    collectors = list(prometheus_client.REGISTRY._collector_to_names.keys())
+    for collector in collectors:
+        prometheus_client.REGISTRY.unregister(collector)
+    main.prom_metrics = {}
+    settings.MQTT_EXPOSE_CLIENT_ID = False
+    main._create_msg_counter_metrics()
+
+
+def _msg(mocker, topic, payload):
+    msg = mocker.Mock()
+    msg.topic = topic
+    msg.payload = payload
+    msg.properties = None
+    return msg
+
+
+def test_pipeline__built_from_config_only(mocker):
+    """The pipeline does not read the settings once built."""
+    _reset()
+    pipeline = MessagePipeline(PipelineConfig(prefix="custom_", keep_full_topic=True))
+    mocker.patch.object(settings, "PREFIX", "ignored_")
+    mocker.patch.object(settings, "KEEP_FULL_TOPIC", False)
+
+    pipeline.on_message(
+        None, {"client_id": ""}, _msg(mocker, "shellies/room/emeter/0/power", b"12")
+    )
+
+    assert PromMetricId("custom_power") in main.prom_metrics
+    value = prometheus_client.REGISTRY.get_sample_value(
+        "custom_power", {"topic": "shellies_room_emeter_0"}
+    )
+    assert value == 12
+
+
+def test_pipeline__ignored_topics(mocker):
+    """Ignored topics are dropped before being parsed."""
+    _reset()
+    pipeline = MessagePipeline(PipelineConfig(ignored_topics=("ignored/*",)))
+    json_loads = mocker.spy(main.json, "loads")
+
+    pipeline.on_message(None, {"client_id": ""}, _msg(mocker, "ignored/sensor", '{"a": 1}'))
+
+    assert json_loads.call_count == 0
+    assert not main.prom_metrics
+
+
+def test_pipeline__payload_parsing_disabled(mocker):
+    """Only the message counter is updated when payload parsing is disabled."""
+    _reset()
+    pipeline = MessagePipeline(PipelineConfig(parse_msg_payload=False))
+
+    pipeline.on_message(None, {"client_id": ""}, _msg(mocker, "test/sensor", '{"a": 1}'))
+
+    assert not main.prom_metrics
+    value = prometheus_client.REGISTRY.get_sample_value(
+        "mqtt_message_total", {"topic": "test_sensor"}
+    )
+    assert value == 1
+
+
+def test_pipeline__rebuild_on_settings_change(mocker):
+    """The compatibility entry points rebuild the pipeline when settings have changed."""
+    mocker.patch.object(settings, "KEEP_FULL_TOPIC", False)
+    assert main._parse_message("shellies/room/emeter/0/power", b"1")[0] == "shellies_room"
+    first = main.message_pipeline
+
+    mocker.patch.object(settings, "KEEP_FULL_TOPIC", True)
+    assert main._parse_message("shellies/room/emeter/0/power", b"1")[0] == "shellies_room_emeter_0"
+    assert main.message_pipeline is not first
+    assert main.message_pipeline.config.keep_full_topic
+
+
+def test_pipeline__settings_parsed_on_change_only(mocker):
+    """The compatibility entry points only parse the settings again when they change."""
+    main._parse_message("sensor/a", b"1")
+    from_settings = mocker.spy(PipelineConfig, "from_settings")
+    pipeline = main.message_pipeline
+
+    main._parse_message("sensor/a", b"2")
+    assert from_settings.call_count == 0
+    assert main.message_pipeline is pipeline
+
+    mocker.patch.object(settings, "IGNORED_TOPICS", [*settings.IGNORED_TOPICS, "other/#"])
+    main._parse_message("sensor/a", b"3")
+    assert from_settings.call_count == 1
+    assert main.message_pipeline.config.ignored_topics[-1] == "other/#"
+
+
+def test_pipeline__dispatch_uses_active_pipeline(mocker):
+    """The MQTT callback dispatches messages to the last built pipeline."""
+    _reset()
+    main.build_pipeline(PipelineConfig(prefix="first_"))
+    main._dispatch_message(None, {"client_id": ""}, _msg(mocker, "test/sensor", '{"a": 1}'))
+    main.build_pipeline(PipelineConfig(prefix="second_"))
+    main._dispatch_message(None, {"client_id": ""}, _msg(mocker, "test/sensor", '{"a": 1}'))
+
+    assert PromMetricId("first_a") in main.prom_metrics
+    assert PromMetricId("second_a") in main.prom_metrics
+
+
+def test_pipeline__ignored_messages_counted_per_pattern(mocker):
+    """Ignored messages are counted by the pattern which ignored them."""
+    _reset()
+    main._create_ignore_metrics()
+    pipeline = MessagePipeline(PipelineConfig(ignored_topics=("zigbee2mqtt/bridge/#", "*/set")))
+
+    for topic in ("zigbee2mqtt/bridge/state", "zigbee2mqtt/bridge/logging", "light/set", "a/b"):
+        pipeline.on_message(None, {"client_id": ""}, _msg(mocker, topic, '{"a": 1}'))
+
+    registry = prometheus_client.REGISTRY
+    assert (
+        registry.get_sample_value(
+            "mqtt_ignored_messages_total", {"pattern": "zigbee2mqtt/bridge/#"}
+        )
+        == 2
+    )
+    assert registry.get_sample_value("mqtt_ignored_messages_total", {"pattern": "*/set"}) == 1
+    assert list(main.prom_metrics) == [PromMetricId("mqtt_a")]
+    main.prom_ignored_counter = None
+
+
+def test_pipeline__shared_series_records(mocker):
+    """Series of several topics share their metric ids, and reference the gauge label values."""
+    _reset()
+    main.metric_refs.clear()
+    pipeline = MessagePipeline(PipelineConfig(expose_last_seen=True))
+
+    for topic in ("zigbee2mqtt/kitchen", "zigbee2mqtt/garage", "zigbee2mqtt/kitchen"):
+        pipeline.on_message(None, {"client_id": ""}, _msg(mocker, topic, '{"temperature": 21}'))
+
+    ((kitchen_id, kitchen_labels),) = main.metric_refs["zigbee2mqtt/kitchen"]
+    ((garage_id, _),) = main.metric_refs["zigbee2mqtt/garage"]
+    gauge = main.prom_metrics[kitchen_id]
+    assert kitchen_id is garage_id
+    assert kitchen_labels is gauge.labels("zigbee2mqtt_kitchen")._labelvalues
+
+    assert main._remove_series("zigbee2mqtt/kitchen") == 2
+    assert (
+        prometheus_client.REGISTRY.get_sample_value(
+            "mqtt_temperature_ts", {"topic": "zigbee2mqtt_kitchen"}
+        )
+        is None
+    )
+
+
+def test_pipeline__top_topics_without_topic_counters(mocker):
+    """Messages are tracked by the sketch, without per topic message counters."""
+    _reset()
+    mocker.patch.object(main, "topic_stats", TopicStats(capacity=10))
+    pipeline = MessagePipeline(
+        PipelineConfig(topic_message_counter=False, track_top_topics=True, dedup_cache_size=10)
+    )
+    mocker.patch.object(main, "prom_dedup_counter")
+
+    for _ in range(2):
+        pipeline.on_message(
+            None, {"client_id": ""}, _msg(mocker, "zigbee2mqtt/kitchen", b'{"temperature": 21}')
+        )
+
+    top = main.topic_stats.top()
+    assert top["messages"]["top"][0] == {"topic": "zigbee2mqtt/kitchen", "value": 2, "max_error": 0}
+    assert top["bytes"]["total"] == 38
+    assert (
+        prometheus_client.REGISTRY.get_sample_value(
+            "mqtt_message_total", {"topic": "zigbee2mqtt_kitchen"}
+        )
+        is None
+    )
+    assert (
+        prometheus_client.REGISTRY.get_sample_value(
+            "mqtt_temperature", {"topic": "zigbee2mqtt_kitchen"}
+        )
+        == 21
+    )
+
+
+def test_pipeline__label_cardinality_limit(mocker):
+    """User properties values over the limit are dropped."""
+    _reset()
+    mocker.patch.object(main, "label_cardinality", LabelCardinality(limits={"seq": 1}))
+    pipeline = MessagePipeline(PipelineConfig(mqtt_v5_protocol=True, limit_label_cardinality=True))
+
+    for seq in ("1", "2", "3"):
+        msg = _msg(mocker, "zigbee2mqtt/kitchen", b'{"temperature": 21}')
+        msg.properties = mocker.Mock(UserProperty=[("seq", seq)])
+        pipeline.on_message(None, {"client_id": ""}, msg)
+
+    gauge = main.prom_metrics[PromMetricId("mqtt_temperature", ("seq",))]
+    assert sorted(gauge._metrics) == [("zigbee2mqtt_kitchen", ""), ("zigbee2mqtt_kitchen", "1")]
+    assert main.label_cardinality.estimates()[("mqtt_temperature", "seq")][1] == 2
+
+
+def test_pipeline__coalesced_messages(mocker):
+    """Coalesced messages are not parsed until flushed, the latest value is kept."""
+    _reset()
+    pipeline = MessagePipeline(
+        PipelineConfig(rate_limits=parse_rate_limits("noisy/#=coalesce:60000"))
+    )
+    json_loads = mocker.spy(main.json, "loads")
+
+    for value in (1, 2, 3):
+        pipeline.on_message(
+            None, {"client_id": ""}, _msg(mocker, "noisy/sensor", f'{{"power": {value}}}')
+        )
+
+    assert json_loads.call_count == 1
+    registry = prometheus_client.REGISTRY
+    assert registry.get_sample_value("mqtt_power", {"topic": "noisy_sensor"}) == 1
+
+    mocker.patch.object(main.time, "monotonic", return_value=main.time.monotonic() + 60)
+    pipeline.flush_coalesced()
+
+    assert json_loads.call_count == 2
+    assert registry.get_sample_value("mqtt_power", {"topic": "noisy_sensor"}) == 3
+
+
+def test_pipeline__concurrent_rate_limiter():
+    """The topic matcher of the rate limiter is locked when messages are processed concurrently."""
+    limits = parse_rate_limits("noisy/#=coalesce:1000")
+    pipeline = MessagePipeline(PipelineConfig(rate_limits=limits, ingest_threads=2))
+
+    assert isinstance(pipeline.rate_limiter.matcher.cache, LockedLRUCache)
+    sampled = parse_rate_limits("noisy/#=sample:10")
+    assert not isinstance(
+        MessagePipeline(PipelineConfig(rate_limits=sampled)).rate_limiter.matcher.cache,
+        LockedLRUCache,
+    )
+
+
+def test_pipeline__coalesce_is_concurrent():
+    """The coalesced messages are processed by another thread, sharing the caches."""
+    pipeline = MessagePipeline(
+        PipelineConfig(rate_limits=parse_rate_limits("noisy/#=coalesce:1000"), dedup_cache_size=10)
+    )
+
+    assert pipeline.config.concurrent
+    assert isinstance(pipeline.dedup_cache, LockedLRUCache)
+
+
+def test_pipeline__coalesced_messages_kept_on_rebuild(mocker):
+    """A rebuilt pipeline keeps the coalesced messages, or processes them if limits changed."""
+    _reset()
+    limits = parse_rate_limits("noisy/#=coalesce:60000")
+    main.build_pipeline(PipelineConfig(rate_limits=limits))
+    for value in (1, 2):
+        main._dispatch_message(
+            None, {"client_id": ""}, _msg(mocker, "noisy/rebuilt", f'{{"power": {value}}}')
+        )
+
+    pipeline = main.build_pipeline(PipelineConfig(rate_limits=limits, keep_full_topic=True))
+    assert pipeline.rate_limiter.pending == 1
+
+    main.build_pipeline(PipelineConfig())
+    registry = prometheus_client.REGISTRY
+    assert registry.get_sample_value("mqtt_power", {"topic": "noisy_rebuilt"}) == 2
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        ("23.5 °C", 23.5),
+        ("12 %", 12),
+        ("-3.2kWh", -3.2),
+        ("1e3 lx", 1000),
+        ("45 µs", 45),
+        ("ON", 1),
+        ("12.5", 12.5),
+        ("idle", None),
+        ("1.2.3 V", None),
+        ("10 minutes ago", None),
+        ("1013.2 hPa", 1013.2),
+        ("3.5 m³/h", 3.5),
+        ("12 µg/m³", 12),
+        ("0x00158d0001a2b3c4", None),
+        ("0xff", None),
+        ("2nd", None),
+        ("7 days", None),
+        ("1234abcd", None),
+    ],
+)
+def test_pipeline__parse_units(value, expected):
+    """Numbers are extracted from strings with a unit suffix."""
+    pipeline = MessagePipeline(PipelineConfig.from_settings(parse_units=True))
+
+    for _ in range(2):
+        if expected is None:
+            with pytest.raises(ValueError):
+                pipeline.parse_value(value)
+        else:
+            assert pipeline.parse_value(value) == expected
+
+
+def test_pipeline__value_cache():
+    """Recurring strings are parsed once, including the ones which are not numbers."""
+    pipeline = MessagePipeline(PipelineConfig())
+
+    for _ in range(3):
+        with pytest.raises(ValueError):
+            pipeline.parse_value("idle")
+        assert pipeline.parse_value("21.5") == 21.5
+
+    assert pipeline.value_cache.get("idle") is main._REJECTED
+    assert pipeline.value_cache.get("21.5") == 21.5
+    assert MessagePipeline(PipelineConfig(value_cache_size=0)).value_cache is None
+    with pytest.raises(ValueError):
+        MessagePipeline(PipelineConfig()).parse_value("12 %")
+
+
+def test_pipeline__offloaded_parsing(mocker):
+    """Large payloads are parsed in a process pool, and exposed in order."""
+    _reset()
+    executor = ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn"))
+    mocker.patch.object(main, "offloader", Offloader(executor, min_size=50))
+    pipeline = MessagePipeline(PipelineConfig(offload=True, dedup_cache_size=10))
+    mocker.patch.object(main, "prom_dedup_counter")
+    json_loads = mocker.spy(main.json, "loads")
+
+    large_payload = json.dumps({"power": 1, "cells": list(range(20))})
+    pipeline.on_message(None, {"client_id": ""}, _msg(mocker, "inverter/dump", large_payload))
+    pipeline.on_message(None, {"client_id": ""}, _msg(mocker, "inverter/dump", '{"power": 2}'))
+    executor.shutdown(wait=True)
+
+    assert json_loads.call_count == 0
+    registry = prometheus_client.REGISTRY
+    assert registry.get_sample_value("mqtt_power", {"topic": "inverter_dump"}) == 2
+    assert registry.get_sample_value("mqtt_cells_19", {"topic": "inverter_dump"}) == 19
+    assert registry.get_sample_value("mqtt_message_total", {"topic": "inverter_dump"}) == 2
+    assert pipeline.dedup_cache.get("inverter/dump").msg_counter is not None
+
+
+def test_pipeline__ingest_threads(mocker):
+    """Messages processed by several threads expose the last value of each topic."""
+    _reset()
+    main.metric_refs.clear()
+    pipeline = main.build_pipeline(PipelineConfig(ingest_threads=4, expose_last_seen=True))
+    assert pipeline.config.concurrent
+    workers = IngestWorkers(4, main._process_message).start()
+    mocker.patch.object(main, "ingest_workers", workers)
+
+    for value in range(50):
+        for device in range(40):
+            msg = _msg(mocker, f"zigbee2mqtt/device_{device}", json.dumps({"power": value}))
+            main._dispatch_message(None, {"client_id": ""}, msg)
+    workers.stop()
+
+    registry = prometheus_client.REGISTRY
+    for device in range(40):
+        labels = {"topic": f"zigbee2mqtt_device_{device}"}
+        assert registry.get_sample_value("mqtt_power", labels) == 49
+        assert registry.get_sample_value("mqtt_message_total", labels) == 50
+    assert len(main.metric_refs) == 40
+    assert set(main.prom_metrics) == {PromMetricId("mqtt_power"), PromMetricId("mqtt_power_ts")}
+
+
+def test_pipeline__output_sinks(mocker):
+    """Samples are sent to the output sinks, with the labels of their series."""
+    _reset()
+    points = []
+
+    class RecordingSink(Sink):
+        def send(self, batch):
+            points.extend(batch)
+
+    mocker.patch.object(main, "output_sinks", [RecordingSink("recording")])
+    pipeline = MessagePipeline(PipelineConfig(output_sinks=True, expose_last_seen=True))
+
+    msg = _msg(mocker, "zigbee2mqtt/kitchen", '{"temperature": 21.5, "humidity": 40}')
+    pipeline.on_message(None, {"client_id": ""}, msg)
+    main.output_sinks[0].flush()
+
+    assert [point[:3] for point in points] == [
+        ("mqtt_temperature", (("topic", "zigbee2mqtt_kitchen"),), 21.5),
+        ("mqtt_humidity", (("topic", "zigbee2mqtt_kitchen"),), 40),
+    ]
+    registry = prometheus_client.REGISTRY
+    assert registry.get_sample_value("mqtt_temperature", {"topic": "zigbee2mqtt_kitchen"}) == 21.5
+
+
+def test_pipeline__counters(mocker):
+    """Cumulative fields are exposed as counters, monotonic across device resets."""
+    _reset()
+    detector = CounterDetector(
+        ["mqtt_energy"], learning_samples=2, on_learned=main._replace_by_counter
+    )
+    mocker.patch.object(main, "counter_detector", detector)
+    pipeline = MessagePipeline(PipelineConfig(detect_counters=True))
+
+    for energy, uptime in ((100, 10), (120, 20), (5, 30)):
+        payload = json.dumps({"energy": energy, "uptime": uptime})
+        pipeline.on_message(None, {"client_id": ""}, _msg(mocker, "shellies/plug", payload))
+
+    registry = prometheus_client.REGISTRY
+    labels = {"topic": "shellies_plug"}
+    assert registry.get_sample_value("mqtt_energy_total", labels) == 125
+    assert registry.get_sample_value("mqtt_energy", labels) is None
+    # learned from its first samples
+    assert registry.get_sample_value("mqtt_uptime_total", labels) == 30
+    assert registry.get_sample_value("mqtt_uptime", labels) is None
+    assert b"# TYPE mqtt_uptime_total counter" in main._render_topics(["shellies/plug"])
+    # same series on /metrics and on the sharded endpoints
+    assert registry.get_sample_value("mqtt_energy_created", labels) is None
+    assert registry.get_sample_value("mqtt_uptime_created", labels) is None
+
+
+def test_pipeline__derived_metrics(mocker):
+    """Derived metrics are exposed as series of the topic of their inputs."""
+    _reset()
+    pipeline = MessagePipeline(
+        PipelineConfig(derived_metrics=(("mqtt_power", "mqtt_voltage * mqtt_current"),))
+    )
+
+    pipeline.on_message(None, {"client_id": ""}, _msg(mocker, "plug", '{"voltage": 230}'))
+    registry = prometheus_client.REGISTRY
+    assert registry.get_sample_value("mqtt_power", {"topic": "plug"}) is None
+
+    pipeline.on_message(None, {"client_id": ""}, _msg(mocker, "plug", '{"current": 0.5}'))
+    assert registry.get_sample_value("mqtt_power", {"topic": "plug"}) == 115
+    assert (PromMetricId("mqtt_power"), ("plug",)) in main.metric_refs["plug"]
+
+
+def test_pipeline__derived_rate_with_dedup(mocker):
+    """Identical payloads of a topic feeding a rate are parsed, so the rate drops to zero."""
+    _reset()
+    main._create_dedup_metrics()
+    pipeline = MessagePipeline(
+        PipelineConfig(
+            dedup_cache_size=10, derived_metrics=(("mqtt_energy_rate", "rate(mqtt_energy)"),)
+        )
+    )
+    monotonic = mocker.patch.object(main.time, "monotonic")
+
+    for now, energy in ((0, 10), (10, 20), (20, 20), (30, 20)):
+        monotonic.return_value = now
+        pipeline.on_message(
+            None, {"client_id": ""}, _msg(mocker, "plug", f'{{"energy": {energy}}}')
+        )
+
+    registry = prometheus_client.REGISTRY
+    assert registry.get_sample_value("mqtt_energy_rate", {"topic": "plug"}) == 0
+    # the other topics are still deduplicated
+    for _ in range(2):
+        pipeline.on_message(None, {"client_id": ""}, _msg(mocker, "sensor", '{"t": 1}'))
+    assert registry.get_sample_value("mqtt_dedup_lookups_total", {"result": "hit"}) == 1
+
+
+def test_pipeline__dead_letters(mocker):
+    """Rejected messages are recorded with their reason."""
+    _reset()
+    mocker.patch.object(main, "dead_letters", DeadLetters(topic_interval=0))
+    pipeline = MessagePipeline(PipelineConfig(dead_letters=True))
+
+    for topic, payload in (
+        ("sensor/a", b"not json"),
+        ("sensor/c", b'{"temperature": 21.5, "mode": "heat"}'),
+    ):
+        pipeline.on_message(None, {"client_id": ""}, _msg(mocker, topic, payload))
+
+    entries = {entry["topic"]: entry for entry in main.dead_letters.entries()}
+    assert entries["sensor/a"]["reason"] == "invalid_payload"
+    assert entries["sensor/a"]["detail"].startswith("Expecting value")
+    assert entries["sensor/c"]["reason"] == "not_a_number"
+    assert entries["sensor/c"]["detail"] == "mode"
+    registry = prometheus_client.REGISTRY
+    assert registry.get_sample_value("mqtt_temperature", {"topic": "sensor_c"}) == 21.5
+
+
+def test_pipeline__offloaded_dead_letters(mocker):
+    """The messages rejected while parsed out of the pipeline are counted and recorded."""
+    _reset()
+    reasons = []
+    executor = ThreadPoolExecutor(1)
+    mocker.patch.object(main, "offloader", Offloader(executor, min_size=1))
+    mocker.patch.object(
+        main, "dead_letters", DeadLetters(topic_interval=0, on_rejected=reasons.append)
+    )
+    pipeline = MessagePipeline(PipelineConfig(offload=True, dead_letters=True))
+
+    for topic, payload in (
+        ("sensor/a", b"not json"),
+        ("sensor/c", b'{"temperature": 21.5, "mode": "heat"}'),
+    ):
+        pipeline.on_message(None, {"client_id": ""}, _msg(mocker, topic, payload))
+    executor.shutdown(wait=True)
+
+    entries = {entry["topic"]: entry for entry in main.dead_letters.entries()}
+    assert entries["sensor/a"]["detail"].startswith("Expecting value")
+    assert entries["sensor/c"]["detail"] == "mode"
+    assert reasons == ["invalid_payload", "not_a_number"]
+
+
+def test_pipeline__arrays():
+    """Numeric arrays of the matching topics are exposed with an index label or statistics."""
+    _reset()
+    pipeline = MessagePipeline(
+        PipelineConfig(array_modes=(("bms/#", "index"), ("spectrum/+", "stats")))
+    )
+
+    payload = {"cells": [3.3, 3.25], "tags": ["a", "b"]}
+    for topic in ("bms/pack1", "spectrum/mic", "other/sensor"):
+        samples = list(pipeline.flatten(payload, "", None, pipeline.array_mode(topic)))
+        pipeline.apply_samples(samples, topic.replace("/", "_"), topic, "")
+
+    registry = prometheus_client.REGISTRY
+    assert registry.get_sample_value("mqtt_cells", {"topic": "bms_pack1", "index": "1"}) == 3.25
+    assert registry.get_sample_value("mqtt_cells_max", {"topic": "spectrum_mic"}) == 3.3
+    assert registry.get_sample_value("mqtt_cells_sum", {"topic": "spectrum_mic"}) == 6.55
+    assert registry.get_sample_value("mqtt_cells_0", {"topic": "other_sensor"}) == 3.3
+    assert registry.get_sample_value("mqtt_cells_0", {"topic": "bms_pack1"}) is None
+
+
+def test_pipeline__file_source(tmp_path):
+    """Messages read from a file are processed like MQTT messages."""
+    _reset()
+    path = tmp_path / "messages.log"
+    path.write_text(
+        'zigbee2mqtt/kitchen {"temperature": 21.5}\n'
+        '{"topic": "zigbee2mqtt/kitchen", "payload": {"temperature": 22}}\n'
+    )
+    pipeline = MessagePipeline(PipelineConfig())
+
+    assert FileSource(str(path)).run(pipeline.on_message) == 2
+
+    registry = prometheus_client.REGISTRY
+    assert registry.get_sample_value("mqtt_temperature", {"topic": "zigbee2mqtt_kitchen"}) == 22
+
+
+def test_pipeline__memory_budget(mocker):
+    """Over budget, caches are shrunk, new series refused, then stale series evicted."""
+    _reset()
+    mocker.patch.object(main, "metric_refs", SeriesStore())
+    budget = MemoryBudget(
+        1,
+        main._memory_usage,
+        on_shrink=main._shrink_caches,
+        on_evict=main._evict_stale_series,
+    )
+    mocker.patch.object(main, "memory_budget", budget)
+    main.build_pipeline(PipelineConfig(memory_limit=1))
+    pipeline = main.message_pipeline
+    registry = prometheus_client.REGISTRY
+
+    for topic in ("sensor/a", "sensor/b"):
+        pipeline.on_message(None, {"client_id": ""}, _msg(mocker, topic, b'{"temperature": 20}'))
+    assert main._memory_usage()["series"] > 0
+
+    budget.check()
+    assert pipeline.metric_ids.maxsize == main.METRIC_ID_CACHE_SIZE // 2
+
+    budget.check()
+    assert budget.refuse_series
+    for topic in ("sensor/a", "sensor/c"):
+        pipeline.on_message(None, {"client_id": ""}, _msg(mocker, topic, b'{"temperature": 21}'))
+    assert registry.get_sample_value("mqtt_temperature", {"topic": "sensor_a"}) == 21
+    assert registry.get_sample_value("mqtt_temperature", {"topic": "sensor_c"}) is None
+
+    # sensor/b was not updated since the previous check
+    budget.check()
+    assert registry.get_sample_value("mqtt_temperature", {"topic": "sensor_b"}) is None
+    assert registry.get_sample_value("mqtt_message_total", {"topic": "sensor_b"}) is None
+    assert registry.get_sample_value("mqtt_temperature", {"topic": "sensor_a"}) == 21
+
+
+def test_pipeline__memory_budget_with_dedup(mocker):
+    """Identical payloads keep their topic recent, and evicted topics are exposed again."""
+    _reset()
+    mocker.patch.object(main, "metric_refs", SeriesStore())
+    budget = MemoryBudget(1, main._memory_usage, on_evict=main._evict_stale_series)
+    mocker.patch.object(main, "memory_budget", budget)
+    mocker.patch.object(main, "prom_dedup_counter")
+    main.build_pipeline(PipelineConfig(memory_limit=1, dedup_cache_size=10))
+    pipeline = main.message_pipeline
+    registry = prometheus_client.REGISTRY
+    # the caches are shrunk and cleared by the thread of the budget
+    assert isinstance(pipeline.dedup_cache, LockedLRUCache)
+
+    for topic in ("sensor/a", "sensor/b", "sensor/a"):
+        pipeline.on_message(None, {"client_id": ""}, _msg(mocker, topic, b'{"temperature": 20}'))
+    assert budget.recent == {"sensor/a", "sensor/b"}
+
+    budget.check()
+    budget.check()
+    pipeline.on_message(None, {"client_id": ""}, _msg(mocker, "sensor/a", b'{"temperature": 20}'))
+    budget.check()
+    assert registry.get_sample_value("mqtt_temperature", {"topic": "sensor_b"}) is None
+    assert registry.get_sample_value("mqtt_temperature", {"topic": "sensor_a"}) == 20
+
+    # back under the limit, the same payload creates the evicted series again
+    budget.high = budget.low = 1 << 40
+    budget.check()
+    pipeline.on_message(None, {"client_id": ""}, _msg(mocker, "sensor/b", b'{"temperature": 20}'))
+    assert registry.get_sample_value("mqtt_temperature", {"topic": "sensor_b"}) == 20
+
+
+def test_pipeline__memory_usage(mocker):
+    """The estimate includes the message counters, sketches and derived values."""
+    _reset()
+    mocker.patch.object(main, "metric_refs", SeriesStore())
+    mocker.patch.object(main, "topic_stats", TopicStats(10))
+    main.build_pipeline(
+        PipelineConfig(
+            derived_metrics=(("mqtt_power", "mqtt_voltage * mqtt_current"),),
+            track_top_topics=True,
+        )
+    )
+    usage = main._memory_usage()
+
+    payload = b'{"voltage": 230, "current": 2}'
+    main.message_pipeline.on_message(None, {"client_id": ""}, _msg(mocker, "dev/plug", payload))
+    increase = {name: size - usage[name] for name, size in main._memory_usage().items()}
+
+    # 3 gauges and the message counter
+    assert increase["series"] == 4 * main.SERIES_BYTES
+    assert increase["derived"] == 3 * main.DERIVED_VALUE_BYTES
+    assert increase["sketches"] == 3 * main.TOP_TOPIC_BYTES
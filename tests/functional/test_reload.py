@@ -0,0 +1,154 @@
+"""Functional tests of the configuration hot reload."""
+
+import io
+import re
+
+import prometheus_client
+import pytest
+
+from mqtt_exporter import main, server, settings
+from mqtt_exporter.brokers import BrokerConfig
+from mqtt_exporter.main import PromMetricId
+
+
+@pytest.fixture(name="config_file")
+def fixture_config_file(tmp_path, mocker):
+    """Provide a config file, and restore the settings changed by the reload."""
+    reloadable = {
+        name: getattr(settings, name) for name, _ in settings.RELOADABLE_SETTINGS.values()
+    }
+    path = tmp_path / "mqtt-exporter.env"
+    mocker.patch.object(settings, "CONFIG_FILE", str(path))
+    yield path
+    for name, value in reloadable.items():
+        setattr(settings, name, value)
+
+
+def _reset():
+    # pylama: ignore=W0212
+    collectors = list(prometheus_client.REGISTRY._collector_to_names.keys())
+    for collector in collectors:
+        prometheus_client.REGISTRY.unregister(collector)
+    main.prom_metrics = {}
+    main.metric_refs.clear()
+    settings.MQTT_EXPOSE_CLIENT_ID = False
+    main._create_msg_counter_metrics()
+
+
+def _msg(mocker, topic, payload):
+    msg = mocker.Mock()
+    msg.topic = topic
+    msg.payload = payload
+    msg.properties = None
+    return msg
+
+
+def test_reload__prune_ignored_series(config_file, mocker):
+    """Only the series and message counters of topics ignored by the new configuration are removed."""
+    _reset()
+    main.build_pipeline()
+    for topic in ("kept/sensor", "dropped/sensor"):
+        main._dispatch_message(None, {"client_id": ""}, _msg(mocker, topic, '{"power": 1}'))
+
+    config_file.write_text("# ignore a device\nMQTT_IGNORED_TOPICS=dropped/*\n")
+    result = main.reload_config()
+
+    assert result["pruned_series"] == 1
+    gauge = main.prom_metrics[PromMetricId("mqtt_power")]
+    assert prometheus_client.REGISTRY.get_sample_value("mqtt_power", {"topic": "kept_sensor"}) == 1
+    assert [s.labels for s in gauge.collect()[0].samples] == [{"topic": "kept_sensor"}]
+    assert (
+        prometheus_client.REGISTRY.get_sample_value(
+            "mqtt_message_total", {"topic": "dropped_sensor"}
+        )
+        is None
+    )
+    # the series are pruned by the reload thread
+    assert main.message_pipeline.config.concurrent
+
+    main._dispatch_message(None, {"client_id": ""}, _msg(mocker, "dropped/sensor", '{"power": 2}'))
+    assert "dropped/sensor" not in main.metric_refs
+
+
+def test_reload__resubscribe_changed_topics(config_file, mocker):
+    """Only the added and removed topics are (un)subscribed."""
+    _reset()
+    client = mocker.Mock()
+    client.user_data_get.return_value = {"broker": BrokerConfig()}
+    own_topic_client = mocker.Mock()
+    own_topic_client.user_data_get.return_value = {"broker": BrokerConfig(topic="shellies/#")}
+    mocker.patch.object(main, "mqtt_clients", [client, own_topic_client])
+    settings.TOPIC = "zigbee2mqtt/#,shellies/#"
+
+    config_file.write_text("MQTT_TOPIC=zigbee2mqtt/#,zwave/#\nMAX_METRICS=10\n")
+    result = main.reload_config()
+
+    assert result["subscribed"] == ["zwave/#"]
+    assert result["unsubscribed"] == ["shellies/#"]
+    client.unsubscribe.assert_called_once_with(["shellies/#"])
+    client.subscribe.assert_called_once_with("zwave/#", qos=0)
+    own_topic_client.subscribe.assert_not_called()
+    own_topic_client.unsubscribe.assert_not_called()
+    assert main.message_pipeline.config.max_metrics == 10
+
+
+def test_reload__removed_setting_falls_back_to_environment(config_file):
+    """A setting removed from the config file gets back its startup value."""
+    config_file.write_text("STATE_VALUES=OPEN=1\n")
+    settings.load_config_file(str(config_file))
+    assert settings.STATE_VALUES["OPEN"] == 1
+
+    config_file.write_text("")
+    settings.load_config_file(str(config_file))
+    assert "OPEN" not in settings.STATE_VALUES
+
+
+def test_reload__invalid_file_is_not_applied(config_file):
+    """Nothing is changed when the config file is invalid."""
+    max_metrics = settings.MAX_METRICS
+    config_file.write_text("MQTT_IGNORED_TOPICS=test/*\nMAX_METRICS=many\n")
+
+    app = server.make_app()
+    server.add_route("/-/reload", main._reload_endpoint, methods=("POST",))
+    start_response = []
+    environ = {"PATH_INFO": "/-/reload", "REQUEST_METHOD": "POST", "wsgi.input": io.BytesIO()}
+    body = app(environ, lambda status, headers: start_response.append(status))
+
+    assert start_response == ["400 Bad Request"]
+    assert b"many" in body[0]
+    assert settings.MAX_METRICS == max_metrics
+    assert settings.IGNORED_TOPICS != ["test/*"]
+
+
+def test_reload__pipeline_error_is_not_applied(config_file, mocker):
+    """Nothing is changed when the pipeline cannot be built from the new settings."""
+    _reset()
+    pipeline = main.build_pipeline()
+    max_metrics = settings.MAX_METRICS
+    config_file.write_text("MAX_METRICS=10\n")
+    mocker.patch.object(main, "MessagePipeline", side_effect=re.error("invalid pattern"))
+
+    status, body = main._reload_endpoint(None)
+
+    assert status == 400
+    assert "invalid pattern" in body["error"]
+    assert settings.MAX_METRICS == max_metrics
+    assert main.message_pipeline is pipeline
+
+
+def test_zigbee2mqtt_rename__removes_series(mocker):
+    """The series of a renamed Zigbee2MQTT device are removed."""
+    _reset()
+    main.build_pipeline()
+    main._dispatch_message(None, {"client_id": ""}, _msg(mocker, "zigbee2mqtt/old", '{"power": 1}'))
+
+    rename = '{"data": {"from": "old", "to": "new"}}'
+    main._dispatch_message(
+        None, {"client_id": ""}, _msg(mocker, "zigbee2mqtt/bridge/request/device/rename", rename)
+    )
+
+    assert "zigbee2mqtt/old" not in main.metric_refs
+    assert (
+        prometheus_client.REGISTRY.get_sample_value("mqtt_power", {"topic": "zigbee2mqtt_old"})
+        is None
+    )
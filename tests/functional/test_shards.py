@@ -0,0 +1,91 @@
+"""Functional tests of the sharded scrape endpoints."""
+
+import prometheus_client
+
+from mqtt_exporter import main, server, settings
+from mqtt_exporter.main import MessagePipeline, PipelineConfig
+from mqtt_exporter.shards import TopicIndex
+
+
+def _reset(mocker):
+    # pylama: ignore=W0212
+    collectors = list(prometheus_client.REGISTRY._collector_to_names.keys())
+    for collector in collectors:
+        prometheus_client.REGISTRY.unregister(collector)
+    main.prom_metrics = {}
+    main.metric_refs.clear()
+    settings.MQTT_EXPOSE_CLIENT_ID = False
+    main._create_msg_counter_metrics()
+    mocker.patch.object(
+        main, "topic_index", TopicIndex({"zigbee": ["zigbee2mqtt/#"]}, hashmod_shards=2)
+    )
+
+
+def _msg(mocker, topic, payload):
+    msg = mocker.Mock()
+    msg.topic = topic
+    msg.payload = payload
+    msg.properties = None
+    return msg
+
+
+def _get(path, query=""):
+    responses = []
+    app = server.make_app()
+    body = app(
+        {"PATH_INFO": path, "QUERY_STRING": query, "REQUEST_METHOD": "GET"},
+        lambda status, headers: responses.append(status),
+    )
+    return responses[0], b"".join(body).decode("utf-8")
+
+
+def _publish(mocker):
+    pipeline = MessagePipeline(PipelineConfig(expose_last_seen=True))
+    for topic, payload in (
+        ("zigbee2mqtt/kitchen", '{"temperature": 21}'),
+        ("home/garage", '{"temperature": 12}'),
+    ):
+        pipeline.on_message(None, {"client_id": ""}, _msg(mocker, topic, payload))
+
+
+def test_shards__endpoints(mocker):
+    """Each endpoint only renders the series of its topics."""
+    _reset(mocker)
+    mocker.patch.dict(server._routes)
+    mocker.patch.dict(server._prefix_routes)
+    server.add_route("/metrics", main._metrics_endpoint)
+    server.add_route("/metrics/", main._shard_endpoint, prefix=True)
+    _publish(mocker)
+
+    status, body = _get("/metrics/zigbee")
+    assert status == "200 OK"
+    assert 'mqtt_temperature{topic="zigbee2mqtt_kitchen"} 21.0' in body
+    assert "mqtt_temperature_ts{" in body
+    assert "garage" not in body
+    assert "mqtt_message_total" not in body
+
+    status, body = _get("/metrics", "topic_prefix=home/")
+    assert 'mqtt_temperature{topic="home_garage"} 12.0' in body
+    assert "zigbee" not in body
+
+    hashmod_bodies = [_get("/metrics", f"hashmod={index}")[1] for index in range(2)]
+    assert sum("zigbee2mqtt_kitchen" in body for body in hashmod_bodies) == 1
+
+    status, body = _get("/metrics")
+    assert "zigbee2mqtt_kitchen" in body
+    assert "home_garage" in body
+    assert "mqtt_message_total" in body
+
+    assert _get("/metrics/unknown")[0] == "404 Not Found"
+    assert _get("/metrics", "hashmod=2")[0] == "404 Not Found"
+
+
+def test_shards__removed_series(mocker):
+    """Removed topics are not rendered anymore."""
+    _reset(mocker)
+    _publish(mocker)
+
+    main._remove_series("zigbee2mqtt/kitchen")
+
+    assert main.topic_index.named_shard("zigbee") == []
+    assert main._render_topics(["zigbee2mqtt/kitchen"]) == b""
@@ -0,0 +1,77 @@
+"""Functional tests of routing with MQTTv5 subscription identifiers."""
+
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+
+from mqtt_exporter import main
+from mqtt_exporter.brokers import BrokerConfig
+from mqtt_exporter.main import MessagePipeline, PipelineConfig
+
+HUBITAT_SUBSCRIPTION_ID = 4
+
+
+def test_subscriptions__grouped_by_integration():
+    """Topics only get the identifier of an integration when it routes all their messages."""
+    pipeline = MessagePipeline(PipelineConfig(subscription_identifiers=True))
+
+    subscriptions = pipeline.subscriptions(
+        ["#", "zwave/#", "msh/EU_868/#", "hubitat/+/value", "zigbee2mqtt/#", "zw+/#"]
+    )
+
+    assert subscriptions == {
+        main.GENERIC_SUBSCRIPTION_ID: ["#", "zigbee2mqtt/#", "zw+/#"],
+        2: ["zwave/#"],
+        3: ["msh/EU_868/#"],
+        HUBITAT_SUBSCRIPTION_ID: ["hubitat/+/value"],
+    }
+
+
+def test_subscribe__one_subscribe_per_identifier(mocker):
+    """Each integration is subscribed with its own identifier."""
+    mocker.patch.object(
+        main, "message_pipeline", MessagePipeline(PipelineConfig(subscription_identifiers=True))
+    )
+    client = mocker.Mock()
+
+    main._subscribe_topics(client, BrokerConfig(v5_protocol=True), ["zwave/#", "#", "a/#"])
+
+    calls = {
+        kwargs["properties"].SubscriptionIdentifier[0]: args[0]
+        for args, kwargs in client.subscribe.call_args_list
+    }
+    assert calls == {1: [("#", 0), ("a/#", 0)], 2: [("zwave/#", 0)]}
+
+
+def test_subscribe__without_identifiers_on_mqtt_v3(mocker):
+    """Topics are subscribed one by one on MQTT v3.1.1."""
+    mocker.patch.object(
+        main, "message_pipeline", MessagePipeline(PipelineConfig(subscription_identifiers=True))
+    )
+    client = mocker.Mock()
+
+    main._subscribe_topics(client, BrokerConfig(), ["zwave/#", "#"])
+
+    assert [call.args for call in client.subscribe.call_args_list] == [("zwave/#",), ("#",)]
+
+
+def test_parse_message__routed_by_identifier(mocker):
+    """The route given by the subscription identifier is used instead of prefix matching."""
+    pipeline = MessagePipeline(PipelineConfig(subscription_identifiers=True))
+    parse_message = mocker.spy(pipeline, "parse_message")
+    mocker.patch.object(pipeline, "parse_message", parse_message)
+    pipeline.on_message = pipeline._build_on_message()
+
+    msg = mocker.Mock()
+    msg.topic = "home/hub1/kitchen/temperature/value"
+    msg.payload = "21.5"
+    msg.properties = Properties(PacketTypes.PUBLISH)
+    msg.properties.SubscriptionIdentifier = [HUBITAT_SUBSCRIPTION_ID]
+    mocker.patch.object(main, "prom_msg_counter")
+    pipeline.on_message(None, {"client_id": ""}, msg)
+
+    assert parse_message.spy_return == ("home_hub1_kitchen", {"temperature": 21.5})
+
+    msg.properties = None
+    pipeline.on_message(None, {"client_id": ""}, msg)
+
+    assert parse_message.spy_return == ("home_hub1", {"value": 21.5})
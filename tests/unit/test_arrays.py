@@ -0,0 +1,44 @@
+"""Unit tests of the numeric arrays conversion."""
+
+import pytest
+
+from mqtt_exporter.arrays import (
+    ArrayValues,
+    array_samples,
+    parse_array_modes,
+    to_numbers,
+)
+
+
+def test_parse_array_modes():
+    """Modes are defined per topic pattern."""
+    assert parse_array_modes("bms/#=index; spectrum/+ = stats;") == (
+        ("bms/#", "index"),
+        ("spectrum/+", "stats"),
+    )
+    with pytest.raises(ValueError):
+        parse_array_modes("bms/#=sum")
+    with pytest.raises(ValueError):
+        parse_array_modes("=index")
+
+
+@pytest.mark.parametrize("values", [["1", 2], [1, None], [[1, 2], [3, 4]], [{"a": 1}]])
+def test_to_numbers__not_numbers(values):
+    """Arrays which are not flat lists of numbers are not converted."""
+    assert to_numbers(values) is None
+
+
+def test_array_samples():
+    """Numeric arrays are exposed with an index, or as statistics."""
+    numbers = to_numbers([3, 1.5, True])
+
+    assert list(array_samples("pack_", "cells", numbers, "index")) == [
+        ("pack_", "cells", ArrayValues((3.0, 1.5, 1.0)))
+    ]
+    assert list(array_samples("pack_", "cells", numbers, "stats")) == [
+        ("pack_cells_", "min", 1.0),
+        ("pack_cells_", "max", 3.0),
+        ("pack_cells_", "mean", 5.5 / 3),
+        ("pack_cells_", "sum", 5.5),
+    ]
+    assert not list(array_samples("", "cells", to_numbers([]), "stats"))
@@ -0,0 +1,71 @@
+"""Unit tests of brokers definition."""
+
+import json
+
+import pytest
+
+from mqtt_exporter import settings
+from mqtt_exporter.brokers import BrokerConfig, load_brokers
+
+
+def test_load_brokers(tmp_path, mocker):
+    """Missing fields are taken from the settings."""
+    mocker.patch.object(settings, "MQTT_KEEPALIVE", 30)
+    password_file = tmp_path / "password"
+    password_file.write_text("secret")
+    path = tmp_path / "brokers.json"
+    path.write_text(
+        json.dumps(
+            [
+                {"name": "site1", "address": "10.0.0.1", "topic": "zigbee2mqtt/#"},
+                {
+                    "name": "site2",
+                    "port": 8883,
+                    "enable_tls": True,
+                    "password_file": str(password_file),
+                },
+            ]
+        )
+    )
+
+    site1, site2 = load_brokers(str(path))
+
+    assert site1 == BrokerConfig.from_settings(
+        name="site1", address="10.0.0.1", topic="zigbee2mqtt/#"
+    )
+    assert site1.keepalive == 30
+    assert site1.topics == ["zigbee2mqtt/#"]
+    assert site2.port == 8883
+    assert site2.enable_tls
+    assert site2.password == "secret"
+
+
+def test_broker_topics__default_to_settings(mocker):
+    """A broker without its own topic uses MQTT_TOPIC."""
+    mocker.patch.object(settings, "TOPIC", "a/#,b/#")
+    assert BrokerConfig().topics == ["a/#", "b/#"]
+
+
+@pytest.mark.parametrize(
+    "definitions",
+    [
+        [{"address": "10.0.0.1"}],
+        [{"name": "site1"}, {"name": "site1"}],
+        [{"name": "site1", "unknown": True}],
+    ],
+)
+def test_load_brokers__invalid(tmp_path, definitions):
+    """Brokers must have a known set of settings and a unique name."""
+    path = tmp_path / "brokers.json"
+    path.write_text(json.dumps(definitions))
+
+    with pytest.raises(ValueError):
+        load_brokers(str(path))
+
+
+def test_broker__persistent_session():
+    """A persistent session subscribes with QoS 1, and needs a client id."""
+    assert BrokerConfig().qos == 0
+    assert BrokerConfig(client_id="exporter", persistent_session=True).qos == 1
+    with pytest.raises(ValueError):
+        BrokerConfig(persistent_session=True)
@@ -0,0 +1,61 @@
+"""Unit tests of bounded caches."""
+
+import threading
+
+from mqtt_exporter.cache import LockedLRUCache, LRUCache
+
+
+def test_lru_cache__evicts_least_recently_used():
+    """The least recently used entry is evicted first."""
+    cache = LRUCache(2)
+    cache["a"] = 1
+    cache["b"] = 2
+    assert cache.get("a") == 1
+
+    cache["c"] = 3
+
+    assert "a" in cache
+    assert "b" not in cache
+    assert "c" in cache
+    assert len(cache) == 2
+
+
+def test_lru_cache__get_default():
+    """A missing key returns the default value."""
+    cache = LRUCache(1)
+    assert cache.get("missing") is None
+    assert cache.get("missing", 42) == 42
+
+
+def test_lru_cache__resize():
+    """Shrinking evicts the least recently used entries, the configured size is kept."""
+    cache = LRUCache(4)
+    for key in "abcd":
+        cache[key] = key
+    cache.get("a")
+
+    cache.resize(2)
+
+    assert len(cache) == 2
+    assert "a" in cache and "d" in cache
+    cache.resize(cache.capacity)
+    assert cache.maxsize == 4
+
+
+def test_locked_lru_cache__concurrent_updates():
+    """The cache stays bounded and consistent when updated by several threads."""
+    cache = LockedLRUCache(50)
+
+    def update(offset):
+        for i in range(2000):
+            cache[offset + i % 100] = i
+            cache.get(offset + (i + 1) % 100)
+            cache.pop(offset + (i + 2) % 100)
+
+    threads = [threading.Thread(target=update, args=(offset,)) for offset in (0, 100, 200, 300)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(cache) <= 50
@@ -0,0 +1,53 @@
+"""Unit tests of the label cardinality estimation and limits."""
+
+import pytest
+
+from mqtt_exporter.cardinality import HyperLogLog, LabelCardinality, parse_limits
+
+
+@pytest.mark.parametrize("count", [0, 10, 1000, 50000])
+def test_hyperloglog(count):
+    """Estimate distinct values within a few percent, ignoring duplicates."""
+    estimator = HyperLogLog()
+    for i in range(count):
+        estimator.add(f"value_{i}")
+        estimator.add(f"value_{i}")
+
+    assert estimator.estimate() == pytest.approx(count, rel=0.1)
+
+
+def test_parse_limits():
+    """Parse limits per label."""
+    assert parse_limits("seq=10, sensor=100") == {"seq": 10, "sensor": 100}
+    assert not parse_limits("")
+    with pytest.raises(ValueError):
+        parse_limits("seq")
+
+
+@pytest.mark.parametrize("action, replacement", [("drop", ""), ("bucket", "other")])
+def test_label_cardinality__limit(action, replacement):
+    """Values over the limit are replaced, known values are kept."""
+    cardinality = LabelCardinality(default_limit=0, limits={"seq": 2}, action=action)
+
+    for seq in ("1", "2", "3", "1"):
+        labels = cardinality.check("mqtt_temperature", {"seq": seq, "room": seq})
+        expected_seq = replacement if seq == "3" else seq
+        assert labels == {"seq": expected_seq, "room": seq}
+
+    estimates = cardinality.estimates()
+    assert estimates[("mqtt_temperature", "seq")] == (pytest.approx(3, abs=0.1), 1)
+    assert estimates[("mqtt_temperature", "room")][1] == 0
+    assert cardinality.states == 2
+
+
+def test_label_cardinality__metrics():
+    """Estimates and limited samples are exposed per metric and label."""
+    cardinality = LabelCardinality(default_limit=1, prefix="test_")
+    cardinality.check("mqtt_power", {"seq": "1"})
+    cardinality.check("mqtt_power", {"seq": "2"})
+
+    estimate, limited = cardinality.collect()
+    assert estimate.samples[0].labels == {"metric": "mqtt_power", "label": "seq"}
+    assert estimate.samples[0].value == 2
+    assert limited.name == "test_label_values_limited"
+    assert limited.samples[0].value == 1
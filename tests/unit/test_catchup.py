@@ -0,0 +1,60 @@
+"""Unit tests of the catch-up of the persistent sessions."""
+
+from mqtt_exporter.catchup import QUIET_CHECKS, CatchUp
+
+
+def test_catch_up__coalesced_until_drained():
+    """The latest message of each topic is processed once no bytes are waiting."""
+    processed = []
+    backlog = [1000]
+    catch_up = CatchUp(lambda topic, value: processed.append((topic, value)), lambda: backlog[0])
+
+    assert not catch_up.add("a", ("a", 0))
+    catch_up.start(10)
+    for value in range(3):
+        for topic in ("a", "b"):
+            assert catch_up.add(topic, (topic, value))
+    assert catch_up.pending == 2
+
+    catch_up.check(11)
+    backlog[0] = 0
+    for _ in range(QUIET_CHECKS - 1):
+        catch_up.check(12)
+    assert catch_up.add("a", ("a", 3))
+    catch_up.check(13)
+
+    assert processed == [("a", 3), ("b", 2)]
+    assert not catch_up.add("a", ("a", 4))
+    assert (catch_up.messages, catch_up.pending, catch_up.duration) == (7, 0, 3)
+
+
+def test_catch_up__max_duration():
+    """The catch-up ends after its maximum duration, even if bytes are still waiting."""
+    processed = []
+    catch_up = CatchUp(processed.append, lambda: 1000, max_duration=5)
+    catch_up.start(0)
+    catch_up.add("a", ("message",))
+
+    catch_up.check(4)
+    assert not processed
+    catch_up.check(5)
+    assert processed == ["message"]
+
+
+def test_catch_up__messages_received_while_draining():
+    """A message received while the backlog is processed is processed after it."""
+    processed = []
+
+    def process(topic, value):
+        processed.append((topic, value))
+        if value == "old":
+            # received from the network thread while the backlog is processed
+            assert catch_up.add(topic, (topic, "new"))
+
+    catch_up = CatchUp(process, lambda: 0, max_duration=0)
+    catch_up.start(0)
+    catch_up.add("t", ("t", "old"))
+    catch_up.check(0)
+
+    assert processed == [("t", "old"), ("t", "new")]
+    assert not catch_up.active
@@ -0,0 +1,61 @@
+"""Unit tests of the counters detection."""
+
+from prometheus_client import CollectorRegistry, Counter, Gauge
+
+from mqtt_exporter.counters import CounterDetector, ValueCounter
+
+
+def test_counter_detector__reset_offset():
+    """A counter stays monotonic when the device counter is reset."""
+    detector = CounterDetector(["mqtt_*energy"])
+    counter = Counter("mqtt_energy", "", ["topic"], registry=CollectorRegistry())
+    series = counter.labels("plug")
+    detector.counters.add("mqtt_energy")
+
+    assert detector.is_counter("mqtt_total_energy")
+    assert not detector.is_counter("mqtt_power")
+    exposed = []
+    # pylama: ignore=W0212
+    for value in (10, 12, 3, 5, -1, 1, 4):
+        assert detector.update("mqtt_energy", series, value)
+        exposed.append(series._value.get())
+
+    assert exposed == [10, 12, 15, 17, 17, 18, 21]
+    detector.forget("mqtt_energy", ("plug",))
+    assert not detector._offsets
+
+
+def test_counter_detector__learning():
+    """A metric which only increased during the learning window becomes a counter."""
+    registry = CollectorRegistry()
+    counter_registry = CollectorRegistry()
+    counter = Counter("mqtt_packets", "", ["topic"], registry=counter_registry)
+    detector = CounterDetector(learning_samples=3, on_learned=lambda _: counter)
+    gauges = {
+        name: Gauge(name, "", ["topic"], registry=registry)
+        for name in ("mqtt_packets", "mqtt_temperature", "mqtt_battery")
+    }
+
+    def update(name, value):
+        series = gauges[name].labels("device")
+        if not detector.update(name, series, value):
+            series.set(value)
+
+    for packets, temperature in ((10, 21.5), (12, 21), (20, 22)):
+        update("mqtt_packets", packets)
+        update("mqtt_temperature", temperature)
+        update("mqtt_battery", 100)
+
+    assert detector.counters == {"mqtt_packets"}
+    assert counter_registry.get_sample_value("mqtt_packets_total", {"topic": "device"}) == 20
+    assert detector._learning == {"mqtt_temperature": None, "mqtt_battery": None}
+
+
+def test_value_counter__no_created_series():
+    """Only the _total series are exposed, for each child."""
+    registry = CollectorRegistry()
+    counter = ValueCounter("mqtt_energy", "", ["topic"], registry=registry)
+    counter.labels("plug").inc(3)
+
+    samples = [sample.name for metric in registry.collect() for sample in metric.samples]
+    assert samples == ["mqtt_energy_total"]
@@ -0,0 +1,46 @@
+"""Unit tests of the rejected messages buffer."""
+
+from mqtt_exporter.deadletter import INVALID_PAYLOAD, NOT_A_NUMBER, DeadLetters
+
+
+def test_dead_letters__ring_buffer():
+    """The last messages are kept, most recent first, with a truncated payload."""
+    reasons = []
+    dead_letters = DeadLetters(size=2, payload_size=4, topic_interval=0, on_rejected=reasons.append)
+
+    dead_letters.add("a", b"not json", INVALID_PAYLOAD, "Expecting value")
+    dead_letters.add("b", "{}", NOT_A_NUMBER, "state")
+    dead_letters.add("c", b"\xff\xfe", INVALID_PAYLOAD)
+
+    entries = dead_letters.entries()
+    assert [entry["topic"] for entry in entries] == ["c", "b"]
+    assert entries[1]["payload"] == "{}"
+    assert entries[0]["payload_size"] == 2
+    assert dead_letters.entries(reason=NOT_A_NUMBER) == [entries[1]]
+    assert reasons == [INVALID_PAYLOAD, NOT_A_NUMBER, INVALID_PAYLOAD]
+
+
+def test_dead_letters__sampled_per_topic():
+    """A topic is recorded once per interval, but all its messages are counted."""
+    reasons = []
+    dead_letters = DeadLetters(size=10, topic_interval=60, on_rejected=reasons.append)
+
+    for _ in range(5):
+        dead_letters.add("chatty", b"oops", INVALID_PAYLOAD)
+    dead_letters.add("other", b"oops", INVALID_PAYLOAD)
+
+    assert [entry["topic"] for entry in dead_letters.entries()] == ["other", "chatty"]
+    assert dead_letters.entries(topic="chatty")[0]["payload"] == "oops"
+    assert len(reasons) == 6
+
+
+def test_dead_letters__detail_of_recorded_only():
+    """A detail function is only called for the messages recorded."""
+    dead_letters = DeadLetters(size=10, topic_interval=60)
+    details = []
+
+    for _ in range(3):
+        dead_letters.add("chatty", b"oops", INVALID_PAYLOAD, lambda: details.append(1) or "error")
+
+    assert dead_letters.entries()[0]["detail"] == "error"
+    assert len(details) == 1
@@ -0,0 +1,87 @@
+"""Unit tests of the derived metrics."""
+
+import pytest
+
+from mqtt_exporter.derived import DerivedMetrics, Expression, parse_derived_metrics
+
+
+def test_expression():
+    """Expressions are evaluated with the latest values."""
+    expression = Expression("max(mqtt_a, 2) * -mqtt_b + 10 % 4 ** 2")
+
+    assert expression.variables == {"mqtt_a", "mqtt_b"}
+    assert expression.evaluate({"mqtt_a": 3, "mqtt_b": 2}) == -6 + 10
+    assert (
+        round(Expression("dewpoint(mqtt_t, mqtt_h)").evaluate({"mqtt_t": 20, "mqtt_h": 50}), 1)
+        == 9.3
+    )
+
+
+@pytest.mark.parametrize(
+    "source",
+    ['__import__("os").system("id")', "mqtt_a.real", "mqtt_a if mqtt_b else 0", "[1]", "rate(1)"],
+)
+def test_expression__unsafe(source):
+    """Only arithmetic on metrics and known functions is allowed."""
+    with pytest.raises(ValueError, match="invalid expression"):
+        Expression(source)
+
+
+def test_parse_derived_metrics():
+    """Derived metrics are named expressions."""
+    assert parse_derived_metrics("mqtt_p=mqtt_u * mqtt_i; mqtt_kw=mqtt_p / 1000") == (
+        ("mqtt_p", "mqtt_u * mqtt_i"),
+        ("mqtt_kw", "mqtt_p / 1000"),
+    )
+    with pytest.raises(ValueError, match="invalid derived metric"):
+        parse_derived_metrics("mqtt-p=1")
+    with pytest.raises(ValueError, match="depends on itself"):
+        DerivedMetrics((("mqtt_a", "mqtt_b + 1"), ("mqtt_b", "mqtt_a")))
+
+
+def test_derived_metrics__incremental():
+    """Only the derivations depending on the updated inputs are evaluated, in order."""
+    derived = DerivedMetrics(
+        # defined before its input: evaluated after it anyway
+        (("mqtt_kw", "mqtt_power / 1000"), ("mqtt_power", "mqtt_u * mqtt_i"), ("mqtt_x", "mqtt_t"))
+    )
+    assert derived.inputs == {"mqtt_power", "mqtt_u", "mqtt_i", "mqtt_t"}
+
+    assert derived.update("plug", {"mqtt_u": 230}, 0) == []
+    assert derived.update("plug", {"mqtt_i": 2}, 0) == [("mqtt_power", 460), ("mqtt_kw", 0.46)]
+    assert derived.update("plug", {"mqtt_t": 21}, 0) == [("mqtt_x", 21)]
+    # the inputs are kept per topic
+    assert derived.update("other", {"mqtt_i": 1}, 0) == []
+    # and per source
+    assert derived.update("plug", {"mqtt_i": 2}, 0, "site2") == []
+
+    derived.forget("plug")
+    assert derived.update("plug", {"mqtt_i": 2}, 0) == []
+
+
+def test_derived_metrics__rate():
+    """The rate is computed between the last two samples, and not across resets."""
+    derived = DerivedMetrics((("mqtt_energy_rate", "rate(mqtt_energy) * 3600"),))
+
+    assert derived.update("plug", {"mqtt_energy": 10}, 0) == []
+    assert derived.update("plug", {"mqtt_energy": 12}, 10) == [("mqtt_energy_rate", 720)]
+    assert derived.update("plug", {"mqtt_energy": 1}, 20) == []
+    assert derived.update("plug", {"mqtt_energy": 2}, 30) == [("mqtt_energy_rate", 360)]
+
+
+def test_derived_metrics__rate_topics():
+    """Topics are tracked when their inputs feed a rate, directly or through derived metrics."""
+    derived = DerivedMetrics(
+        (
+            ("mqtt_power", "mqtt_u * mqtt_i"),
+            ("mqtt_power_rate", "rate(mqtt_power)"),
+            ("mqtt_x", "mqtt_t"),
+        )
+    )
+    assert derived.rate_sources == {"mqtt_u", "mqtt_i", "mqtt_power"}
+
+    derived.update("plug", {"mqtt_u": 230}, 0)
+    derived.update("other", {"mqtt_t": 21}, 0)
+    assert derived.rate_topics == {"plug"}
+    derived.forget("plug")
+    assert derived.rate_topics == set()
@@ -0,0 +1,34 @@
+"""Unit tests of the ingestion threads."""
+
+from collections import defaultdict
+
+from mqtt_exporter.ingest import IngestWorkers
+
+
+def test_ingest_workers__ordered_per_topic():
+    """The messages of a topic are processed in order, by the same thread."""
+    processed = defaultdict(list)
+    workers = IngestWorkers(4, lambda topic, seq: processed[topic].append(seq), queue_size=10)
+    workers.start()
+    for seq in range(100):
+        for topic in ("a", "b", "c"):
+            workers.submit(topic, topic, seq)
+    workers.stop()
+
+    assert processed == {topic: list(range(100)) for topic in ("a", "b", "c")}
+
+
+def test_ingest_workers__errors_logged(caplog):
+    """A message failing to be processed does not stop its thread."""
+    processed = []
+
+    def process(value):
+        processed.append(1 / value)
+
+    workers = IngestWorkers(1, process).start()
+    workers.submit("topic", 0)
+    workers.submit("topic", 2)
+    workers.stop()
+
+    assert processed == [0.5]
+    assert "failed to process message" in caplog.text
@@ -0,0 +1,78 @@
+"""Unit tests of topic patterns matching."""
+
+import fnmatch
+
+import pytest
+
+from mqtt_exporter.matcher import TopicMatcher
+
+
+@pytest.mark.parametrize(
+    "pattern, topic, expected",
+    [
+        ("zigbee2mqtt/bridge", "zigbee2mqtt/bridge", True),
+        ("zigbee2mqtt/bridge", "zigbee2mqtt/bridge/state", False),
+        ("zigbee2mqtt/*", "zigbee2mqtt/bridge/state", True),
+        ("zigbee2mqtt/?ridge", "zigbee2mqtt/bridge", True),
+        ("zigbee2mqtt/[ab]ridge", "zigbee2mqtt/cridge", False),
+        ("zigbee2mqtt/#", "zigbee2mqtt", True),
+        ("zigbee2mqtt/#", "zigbee2mqtt/bridge/state", True),
+        ("zigbee2mqtt/#", "zigbee2mqtt2/bridge", False),
+        ("zigbee2mqtt/+/state", "zigbee2mqtt/bridge/state", True),
+        ("zigbee2mqtt/+/state", "zigbee2mqtt/bridge/config/state", False),
+        ("+/+", "zigbee2mqtt/", True),
+        ("#", "$SYS/broker/uptime", False),
+        ("+/broker/uptime", "$SYS/broker/uptime", False),
+        ("$SYS/#", "$SYS/broker/uptime", True),
+    ],
+)
+def test_topic_matcher(pattern, topic, expected):
+    """Match single patterns, with and without cache."""
+    assert (TopicMatcher([pattern]).match(topic) == pattern) is expected
+    assert (TopicMatcher([pattern], cache_size=0).match(topic) == pattern) is expected
+
+
+def test_topic_matcher__first_pattern_wins():
+    """The first matching pattern in the given order is returned."""
+    patterns = ["other", "tele/*", "tele/+/SENSOR", "tele/room/SENSOR", "tele/#"]
+    matcher = TopicMatcher(patterns)
+
+    assert matcher.match("tele/room/SENSOR") == "tele/*"
+    assert TopicMatcher(patterns[2:]).match("tele/room/SENSOR") == "tele/+/SENSOR"
+    assert TopicMatcher(patterns[3:]).match("tele/room/SENSOR") == "tele/room/SENSOR"
+    assert matcher.match("shellies/room") is None
+
+
+@pytest.mark.parametrize(
+    "translated",
+    [
+        None,
+        # fnmatch.translate("a*b*c") on Python 3.10, naming its groups like the matcher did
+        r"(?s:a(?=(?P<g0>.*?b))(?P=g0).*c)\Z",
+    ],
+)
+def test_topic_matcher__several_wildcards(mocker, translated):
+    """Patterns with several `*` are combined with the other shell-style patterns."""
+    if translated is not None:
+        translate = fnmatch.translate
+        mocker.patch.object(
+            fnmatch,
+            "translate",
+            side_effect=lambda pattern: translated if pattern == "a*b*c" else translate(pattern),
+        )
+    matcher = TopicMatcher(["x/*", "a*b*c", "zigbee2mqtt/*/set*"], cache_size=0)
+
+    assert matcher.match("a/b/c") == "a*b*c"
+    assert matcher.match("x/abc") == "x/*"
+    assert matcher.match("zigbee2mqtt/lamp/set/brightness") == "zigbee2mqtt/*/set*"
+    assert matcher.match("a/c") is None
+
+
+def test_topic_matcher__cached_result():
+    """Results are cached per topic."""
+    matcher = TopicMatcher(["tele/*"], cache_size=1)
+    assert matcher.match("tele/room") == "tele/*"
+    assert matcher.match("shellies/room") is None
+
+    matcher._match = None
+    assert matcher.match("shellies/room") is None
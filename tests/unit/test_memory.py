@@ -0,0 +1,97 @@
+"""Unit tests of the memory budget."""
+
+import pytest
+
+from mqtt_exporter.memory import (
+    EVICT_SERIES,
+    NORMAL,
+    REFUSE_SERIES,
+    SHRINK_CACHES,
+    MemoryBudget,
+    parse_size,
+)
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [("0", 0), ("1000", 1000), ("64k", 65536), ("512M", 512 << 20), ("1.5GB", 3 << 29)],
+)
+def test_parse_size(value, expected):
+    assert parse_size(value) == expected
+
+
+def test_parse_size__invalid():
+    with pytest.raises(ValueError):
+        parse_size("512 apples")
+
+
+def _budget(usage, calls):
+    return MemoryBudget(
+        1000,
+        lambda: {"series": usage[0]},
+        on_shrink=lambda: calls.append("shrink"),
+        on_restore=lambda: calls.append("restore"),
+        on_evict=lambda size, recent: calls.append(("evict", size, set(recent))),
+    )
+
+
+def test_memory_budget__stages():
+    """The stages are applied one per check while over the high watermark."""
+    usage = [500]
+    calls = []
+    budget = _budget(usage, calls)
+
+    budget.check()
+    assert budget.stage == NORMAL
+
+    usage[0] = 950
+    budget.check()
+    assert budget.stage == SHRINK_CACHES
+    assert calls == ["shrink"]
+    assert not budget.refuse_series
+
+    budget.check()
+    assert budget.stage == REFUSE_SERIES
+    assert budget.refuse_series
+
+    budget.note("sensor/a")
+    budget.check()
+    assert budget.stage == EVICT_SERIES
+    assert calls[-1] == ("evict", 150, {"sensor/a"})
+
+    # evicted again at each check, with the topics updated since the previous one
+    budget.check()
+    assert calls[-1] == ("evict", 150, set())
+
+
+def test_memory_budget__recovery():
+    """Below the low watermark, the caches are restored and new series accepted."""
+    usage = [950]
+    calls = []
+    budget = _budget(usage, calls)
+    budget.check()
+    budget.check()
+
+    # between the watermarks, the stage is kept
+    usage[0] = 850
+    budget.check()
+    assert budget.stage == REFUSE_SERIES
+
+    usage[0] = 700
+    budget.check()
+    assert budget.stage == NORMAL
+    assert not budget.refuse_series
+    assert calls == ["shrink", "restore"]
+
+
+def test_memory_budget__on_check():
+    """The estimate and the stage are reported at each check."""
+    checks = []
+    budget = MemoryBudget(
+        1000,
+        lambda: {"series": 600, "caches": 400},
+        on_check=lambda usage, stage: checks.append((sum(usage.values()), stage)),
+    )
+
+    assert budget.check() == {"series": 600, "caches": 400}
+    assert checks == [(1000, SHRINK_CACHES)]
@@ -0,0 +1,49 @@
+"""Unit tests of the offload of heavy payloads."""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from mqtt_exporter.cache import LockedLRUCache
+from mqtt_exporter.offload import Offloader
+
+
+def _parse(payload, event=None):
+    if event is not None:
+        event.wait(5)
+    return payload
+
+
+def test_offloader__should_offload():
+    """Offload large payloads, and payloads of some topics."""
+    offloader = Offloader(None, min_size=100, topics=["inverter/#"])
+
+    assert offloader.should_offload("zigbee2mqtt/kitchen", 100)
+    assert not offloader.should_offload("zigbee2mqtt/kitchen", 99)
+    assert offloader.should_offload("inverter/dump", 10)
+    assert not isinstance(offloader.matcher.cache, LockedLRUCache)
+    offloader = Offloader(None, topics=["inverter/#"], thread_safe=True)
+    assert isinstance(offloader.matcher.cache, LockedLRUCache)
+
+
+def test_offloader__ordered_per_topic():
+    """Results of a topic are applied in order, even when parsed out of order."""
+    applied = []
+    sizes = []
+    slow = threading.Event()
+    with ThreadPoolExecutor(2) as executor:
+        offloader = Offloader(
+            executor, min_size=10, on_applied=lambda size, _latency: sizes.append(size)
+        )
+        offloader.submit("topic", 10, _parse, ("first", slow), applied.append)
+        # same topic: offloaded behind the first payload, whatever its size
+        assert offloader.should_offload("topic", 1)
+        offloader.submit("topic", 1, _parse, ("second",), applied.append)
+        offloader.submit("other", 20, _parse, ("other",), applied.append)
+
+        executor.submit(_parse, None).result()
+        assert "second" not in applied
+        slow.set()
+
+    assert applied.index("first") < applied.index("second")
+    assert sorted(sizes) == [1, 10, 20]
+    assert not offloader.should_offload("topic", 1)
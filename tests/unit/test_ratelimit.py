@@ -0,0 +1,87 @@
+"""Unit tests of the rate limiting of topics."""
+
+import pytest
+
+from mqtt_exporter.ratelimit import RateLimiter, RatePolicy, parse_rate_limits
+
+
+def test_parse_rate_limits():
+    """Parse the policies of each topic pattern."""
+    assert parse_rate_limits("a/#=tokens:5;b/+=tokens:1:10; c/*=sample:10;d=coalesce:500;") == (
+        ("a/#", RatePolicy("tokens", 5, 5)),
+        ("b/+", RatePolicy("tokens", 1, 10)),
+        ("c/*", RatePolicy("sample", 10)),
+        ("d", RatePolicy("coalesce", 0.5)),
+    )
+
+
+@pytest.mark.parametrize(
+    "value", ["tokens:5", "a=unknown:1", "a=sample", "a=sample:0", "a=coalesce:fast"]
+)
+def test_parse_rate_limits__invalid(value):
+    """Reject invalid policies."""
+    with pytest.raises(ValueError):
+        parse_rate_limits(value)
+
+
+def _suppressed_counter(limiter):
+    suppressed = []
+    limiter.on_suppressed = suppressed.append
+    return suppressed
+
+
+def test_rate_limiter__token_bucket():
+    """Allow bursts, then the rate of the bucket, per topic."""
+    limiter = RateLimiter(parse_rate_limits("noisy/#=tokens:2:3"))
+    suppressed = _suppressed_counter(limiter)
+
+    assert [limiter.check("noisy/a", None, 0) for _ in range(4)] == [True, True, True, False]
+    assert limiter.check("noisy/b", None, 0)
+    assert limiter.check("noisy/a", None, 0.5)
+    assert not limiter.check("noisy/a", None, 0.6)
+    assert limiter.check("quiet/a", None, 0.6)
+    assert suppressed == ["noisy/#", "noisy/#"]
+
+
+def test_rate_limiter__sample():
+    """Allow one message out of N."""
+    limiter = RateLimiter(parse_rate_limits("noisy/#=sample:3"))
+
+    assert [limiter.check("noisy/a", None, 0) for _ in range(7)] == [
+        True,
+        False,
+        False,
+        True,
+        False,
+        False,
+        True,
+    ]
+    assert limiter.states == 1
+
+
+def test_rate_limiter__coalesce():
+    """Apply the latest message at most once per interval."""
+    limiter = RateLimiter(parse_rate_limits("noisy/#=coalesce:1000"))
+    suppressed = _suppressed_counter(limiter)
+
+    assert limiter.check("noisy/a", "first", 0)
+    assert not limiter.check("noisy/a", "second", 0.2)
+    assert not limiter.check("noisy/a", "third", 0.4)
+    assert limiter.flush(0.9) == []
+    assert limiter.flush(1.0) == ["third"]
+    assert limiter.flush(2.5) == []
+    assert not limiter.check("noisy/a", "fourth", 1.5)
+    assert limiter.flush(2.0) == ["fourth"]
+    assert limiter.check("noisy/a", "fifth", 3.0)
+    assert suppressed == ["noisy/#"]
+
+
+def test_rate_limiter__drain():
+    """All the coalesced messages are returned, due or not."""
+    limiter = RateLimiter(parse_rate_limits("noisy/#=coalesce:1000"))
+    limiter.check("noisy/a", "first", 0)
+    limiter.check("noisy/a", "second", 0.2)
+    limiter.check("noisy/b", "third", 0.2)
+
+    assert limiter.drain() == ["second"]
+    assert limiter.pending == 0
@@ -0,0 +1,41 @@
+"""Unit tests of the topics index of the sharded scrapes."""
+
+import pytest
+
+from mqtt_exporter.shards import TopicIndex, hashmod, parse_shards
+
+
+def test_parse_shards():
+    """Parse named shards definitions."""
+    assert parse_shards("zigbee=zigbee2mqtt/#;zwave=zwave/#,zwavejs/#;") == {
+        "zigbee": ["zigbee2mqtt/#"],
+        "zwave": ["zwave/#", "zwavejs/#"],
+    }
+    assert not parse_shards("")
+    with pytest.raises(ValueError):
+        parse_shards("zigbee2mqtt/#")
+
+
+def test_topic_index():
+    """Topics are indexed by named shard, prefix and hash, until removed."""
+    index = TopicIndex({"zigbee": ["zigbee2mqtt/#"], "other": ["shellies/*"]}, hashmod_shards=2)
+    for topic in ("zigbee2mqtt/kitchen", "zigbee2mqtt/garage", "shellies/room", "zwave/node"):
+        index.add(topic)
+
+    assert sorted(index.named_shard("zigbee")) == ["zigbee2mqtt/garage", "zigbee2mqtt/kitchen"]
+    assert index.named_shard("unknown") is None
+    assert sorted(index.with_prefix("zigbee2mqtt/k")) == ["zigbee2mqtt/kitchen"]
+    assert sorted(index.with_prefix("z")) == [
+        "zigbee2mqtt/garage",
+        "zigbee2mqtt/kitchen",
+        "zwave/node",
+    ]
+    assert index.hash_shard(hashmod("zwave/node", 2)).count("zwave/node") == 1
+    assert sorted(index.hash_shard(0) + index.hash_shard(1)) == sorted(
+        ["zigbee2mqtt/kitchen", "zigbee2mqtt/garage", "shellies/room", "zwave/node"]
+    )
+
+    index.remove("zigbee2mqtt/kitchen")
+
+    assert index.named_shard("zigbee") == ["zigbee2mqtt/garage"]
+    assert index.with_prefix("zigbee2mqtt/k") == []
@@ -0,0 +1,148 @@
+"""Unit tests of the output sinks."""
+
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+from mqtt_exporter.sinks import (
+    BUFFER_FULL,
+    SEND_ERROR,
+    InfluxHttpSink,
+    Sink,
+    StatsdSink,
+    influx_line,
+    parse_sinks,
+    statsd_lines,
+)
+
+LABELS = (("topic", "zigbee2mqtt_kitchen"), ("room", "living room"))
+
+
+def test_influx_line():
+    """Tags are sorted and escaped, empty tags are omitted."""
+    assert (
+        influx_line("mqtt_temperature", (*LABELS, ("unit", "")), 21, 1700000000000000000)
+        == "mqtt_temperature,room=living\\ room,topic=zigbee2mqtt_kitchen value=21.0 "
+        "1700000000000000000"
+    )
+
+
+@pytest.mark.parametrize("value", [float("nan"), float("inf"), float("-inf")])
+def test_non_finite_values(value):
+    """NaN and infinite values are not sent, InfluxDB would reject the whole batch."""
+    assert influx_line("mqtt_temperature", LABELS, value, 1700000000000000000) is None
+    assert statsd_lines("mqtt_temperature", LABELS, value) == []
+
+
+def test_statsd_lines():
+    """StatsD gets the label values in the name, DogStatsD gets tags."""
+    assert statsd_lines("mqtt_temperature", LABELS, 21.5) == [
+        "mqtt_temperature.zigbee2mqtt_kitchen.living_room:21.5|g"
+    ]
+    # negative values are not relative to the previous value
+    assert statsd_lines("mqtt_power", (("topic", "inverter"),), -3) == [
+        "mqtt_power.inverter:0|g",
+        "mqtt_power.inverter:-3|g",
+    ]
+    assert statsd_lines("mqtt_temperature", LABELS, 21.5, dogstatsd=True) == [
+        "mqtt_temperature:21.5|g|#topic:zigbee2mqtt_kitchen,room:living_room"
+    ]
+
+
+def test_parse_sinks():
+    """Sinks are named by their URL, without credentials nor query."""
+    sinks = parse_sinks(
+        "influx+http://:token@localhost:8086/api/v2/write?org=home&bucket=iot;"
+        "influx+udp://localhost:8089; dogstatsd://localhost:8125"
+    )
+
+    assert [sink.name for sink in sinks] == [
+        "http://localhost:8086/api/v2/write",
+        "influx+udp://localhost:8089",
+        "dogstatsd://localhost:8125",
+    ]
+    assert sinks[0].token == "token"
+    assert sinks[0].url == "http://localhost:8086/api/v2/write?org=home&bucket=iot"
+    with pytest.raises(ValueError, match="unknown sink type"):
+        parse_sinks("graphite://localhost:2003")
+    with pytest.raises(ValueError, match="host and port are required"):
+        parse_sinks("statsd://localhost")
+
+
+def test_sink__drop_accounting():
+    """Points are dropped when the buffer is full, or when they cannot be sent."""
+    events = []
+
+    class FailingSink(Sink):
+        def send(self, points):
+            raise ConnectionRefusedError("refused")
+
+    sink = FailingSink(
+        "failing",
+        buffer_size=2,
+        on_sent=lambda *args: events.append(("sent", *args)),
+        on_dropped=lambda *args: events.append(("dropped", *args)),
+    )
+    for value in range(3):
+        sink.add("mqtt_power", (), value, 0)
+    sink.flush()
+
+    assert events == [("dropped", "failing", 1, BUFFER_FULL), ("dropped", "failing", 2, SEND_ERROR)]
+
+
+def test_influx_http_sink():
+    """Points are sent in one request, with the token."""
+    requests = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+            requests.append((self.path, self.headers["Authorization"], body.decode()))
+            self.send_response(204)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.handle_request, daemon=True).start()
+    sent = []
+    sink = InfluxHttpSink(
+        f"http://:token@127.0.0.1:{server.server_port}/api/v2/write?bucket=iot",
+        on_sent=lambda _, count: sent.append(count),
+    )
+    sink.add("mqtt_temperature", LABELS, 21.5, 1)
+    sink.add("mqtt_humidity", LABELS, 40, 2)
+    sink.flush()
+    server.server_close()
+
+    assert sent == [2]
+    assert requests == [
+        (
+            "/api/v2/write?bucket=iot",
+            "Token token",
+            "mqtt_temperature,room=living\\ room,topic=zigbee2mqtt_kitchen value=21.5 1\n"
+            "mqtt_humidity,room=living\\ room,topic=zigbee2mqtt_kitchen value=40.0 2",
+        )
+    ]
+
+
+def test_statsd_sink():
+    """Points are packed in datagrams."""
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as receiver:
+        receiver.bind(("127.0.0.1", 0))
+        receiver.settimeout(5)
+        sink = StatsdSink("127.0.0.1", receiver.getsockname()[1], dogstatsd=True)
+        for value in range(100):
+            sink.add("mqtt_temperature", LABELS, value, 0)
+        sink.flush()
+
+        lines = []
+        while len(lines) < 100:
+            datagram = receiver.recv(65536)
+            assert len(datagram) <= 1400
+            lines.extend(datagram.decode().split("\n"))
+
+    assert lines[99] == "mqtt_temperature:99|g|#topic:zigbee2mqtt_kitchen,room:living_room"
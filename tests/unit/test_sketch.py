@@ -0,0 +1,48 @@
+"""Unit tests of the heavy hitters sketch."""
+
+from mqtt_exporter.sketch import SpaceSaving, TopicStats
+
+
+def test_space_saving__exact_under_capacity():
+    """Weights are exact while the sketch is not full."""
+    sketch = SpaceSaving(3)
+    for key, weight in (("a", 1), ("b", 5), ("a", 2), ("c", 1)):
+        sketch.add(key, weight)
+
+    assert sketch.top(2) == [("b", 5, 0), ("a", 3, 0)]
+    assert sketch.total == 9
+
+
+def test_space_saving__heavy_hitters_kept():
+    """Heavy keys are tracked in a fixed memory, with bounded overestimation."""
+    sketch = SpaceSaving(20)
+    for i in range(10000):
+        sketch.add("heavy_1" if i % 4 == 0 else f"noise_{i}")
+        sketch.add("heavy_2" if i % 8 == 0 else f"noise_{i}_bis")
+
+    top = sketch.top(2)
+    assert [key for key, _, _ in top] == ["heavy_1", "heavy_2"]
+    for key, weight, error in top:
+        true_weight = 2500 if key == "heavy_1" else 1250
+        assert weight - error <= true_weight <= weight
+    assert len(sketch._weights) == 20
+    assert len(sketch._heap) <= 80
+
+
+def test_topic_stats():
+    """Topics are ranked per dimension, and exposed as metrics."""
+    stats = TopicStats(capacity=5, exposed=1, prefix="test_")
+    stats.record("small/busy", 10, 0.001)
+    stats.record("small/busy", 10, 0.001)
+    stats.record("large/quiet", 1000, 0.01)
+
+    top = stats.top()
+    assert top["messages"]["top"] == [{"topic": "small/busy", "value": 2, "max_error": 0}]
+    assert top["bytes"]["top"][0]["topic"] == "large/quiet"
+    assert top["bytes"]["total"] == 1020
+
+    metrics = {metric.name: metric for metric in stats.collect()}
+    assert metrics["test_top_topic_processing_seconds"].samples[0].labels == {
+        "topic": "large/quiet"
+    }
+    assert metrics["test_observed_messages"].samples[0].value == 3
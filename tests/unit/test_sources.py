@@ -0,0 +1,112 @@
+"""Unit tests of the sources of messages other than a broker."""
+
+import json
+import socket
+import threading
+import time
+
+import pytest
+
+from mqtt_exporter.sources import (
+    FileSource,
+    UnixSocketSource,
+    parse_line,
+    parse_source,
+)
+
+
+def _collect(messages):
+    def process(_client, _userdata, msg):
+        messages.append((msg.topic, msg.payload))
+
+    return process
+
+
+def test_parse_line():
+    """Lines are JSON objects or `topic payload`."""
+    msg = parse_line(b'{"topic": "a/b", "payload": {"temperature": 21}}\n')
+    assert (msg.topic, json.loads(msg.payload)) == ("a/b", {"temperature": 21})
+    msg = parse_line(b'{"topic": "a/b", "payload": "ON"}')
+    assert (msg.topic, msg.payload) == ("a/b", "ON")
+    msg = parse_line(b'a/b {"temperature": 21}\n')
+    assert (msg.topic, msg.payload) == ("a/b", b'{"temperature": 21}')
+    assert msg.properties is None
+    for line in (b"\n", b"a/b\n", b"{not json", b'{"payload": 1}'):
+        assert parse_line(line) is None
+
+
+def test_parse_source():
+    """Sources are given by their type and path."""
+    assert parse_source("tail:/var/log/mqtt.log").follow
+    assert not parse_source("file:/var/log/mqtt.log").follow
+    assert isinstance(parse_source("unix:/run/mqtt.sock"), UnixSocketSource)
+    with pytest.raises(ValueError):
+        parse_source("http://localhost")
+
+
+def test_file_source(tmp_path):
+    """The lines of a file are processed, invalid lines are counted."""
+    path = tmp_path / "messages.log"
+    path.write_bytes(b'a/b {"x": 1}\ninvalid\n\n{"topic": "c", "payload": 2}')
+    messages = []
+    invalid = []
+
+    source = FileSource(str(path), on_invalid=invalid.append)
+    assert source.run(_collect(messages)) == 2
+
+    assert messages == [("a/b", b'{"x": 1}'), ("c", "2")]
+    assert invalid == [str(path)]
+
+
+def test_file_source__follow(tmp_path, mocker):
+    """The lines appended to a followed file are processed once complete."""
+    mocker.patch("mqtt_exporter.sources.FOLLOW_INTERVAL", 0.01)
+    path = tmp_path / "messages.log"
+    path.write_bytes(b"a 1\n")
+    messages = []
+    source = FileSource(str(path), follow=True)
+    thread = threading.Thread(target=source.run, args=(_collect(messages),))
+    thread.start()
+
+    with open(path, "ab") as f:
+        f.write(b"b ")
+        f.flush()
+        time.sleep(0.05)
+        f.write(b"2\n")
+    # rotated
+    path.unlink()
+    path.write_bytes(b"c 3\n")
+    deadline = time.monotonic() + 5
+    while len(messages) < 3 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    source.stop()
+    thread.join()
+
+    assert messages == [("a", b"1"), ("b", b"2"), ("c", b"3")]
+
+
+def test_unix_socket_source(tmp_path):
+    """The messages written to the socket by other processes are processed."""
+    path = str(tmp_path / "mqtt.sock")
+    messages = []
+    source = UnixSocketSource(path)
+    thread = threading.Thread(target=source.run, args=(_collect(messages),))
+    thread.start()
+
+    deadline = time.monotonic() + 5
+    for payload in (b"1", b"2"):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            while True:
+                try:
+                    client.connect(path)
+                    break
+                except (FileNotFoundError, ConnectionRefusedError):
+                    assert time.monotonic() < deadline
+                    time.sleep(0.01)
+            client.sendall(b"a/b " + payload + b"\n")
+    while len(messages) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    source.stop()
+    thread.join()
+
+    assert sorted(messages) == [("a/b", b"1"), ("a/b", b"2")]
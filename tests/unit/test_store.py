@@ -0,0 +1,53 @@
+"""Unit tests of the series store."""
+
+import threading
+
+from mqtt_exporter.store import SeriesStore
+
+
+def test_series_store__topics():
+    """Topics are added with their first series, and removed with all their series."""
+    added = []
+    removed = []
+    store = SeriesStore(shards=4, on_new_topic=added.append, on_removed_topic=removed.append)
+
+    assert store.add("home/kitchen", ("temperature", ("home_kitchen",)))
+    assert not store.add("home/kitchen", ("humidity", ("home_kitchen",)))
+    assert store.add("home/garage", ("temperature", ("home_garage",)))
+
+    assert "home/kitchen" in store
+    assert len(store) == 2
+    assert sorted(store) == ["home/garage", "home/kitchen"]
+    assert sorted(store["home/kitchen"]) == [
+        ("humidity", ("home_kitchen",)),
+        ("temperature", ("home_kitchen",)),
+    ]
+    assert added == ["home/kitchen", "home/garage"]
+
+    assert sorted(store.pop("home/kitchen")) == [
+        ("humidity", ("home_kitchen",)),
+        ("temperature", ("home_kitchen",)),
+    ]
+    assert store.pop("home/kitchen") == ()
+    assert removed == ["home/kitchen"]
+    assert store.items() == [("home/garage", (("temperature", ("home_garage",)),))]
+
+
+def test_series_store__concurrent_updates():
+    """Each topic is new once, whatever the number of threads adding series."""
+    added = []
+    store = SeriesStore(on_new_topic=added.append)
+
+    def add_series(thread):
+        for i in range(1000):
+            store.add(f"topic_{i % 200}", (thread, i))
+
+    threads = [threading.Thread(target=add_series, args=(thread,)) for thread in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(store) == 200
+    assert sorted(added) == sorted(store)
+    assert sum(len(refs) for _, refs in store.items()) == 4000
@@ -0,0 +1,85 @@
+"""Unit tests of the network loop watchdog."""
+
+import logging
+import socket
+import threading
+from types import SimpleNamespace
+
+from mqtt_exporter.watchdog import RECOVERY_CHECKS, Watchdog, socket_backlog
+
+
+def _msg(topic, payload=b"{}"):
+    return SimpleNamespace(topic=topic, payload=payload)
+
+
+def test_socket_backlog():
+    """The bytes received and not read yet are counted."""
+    reader, writer = socket.socketpair()
+    with reader, writer:
+        assert socket_backlog(reader) == 0
+        writer.sendall(b"0123456789")
+        assert socket_backlog(reader) == 10
+    assert socket_backlog(None) == 0
+
+
+def test_watchdog__running_callback():
+    """A callback blocking the loop is measured while it runs."""
+    started = threading.Event()
+    release = threading.Event()
+    durations = []
+
+    def callback(_client, _userdata, _msg):
+        started.set()
+        release.wait()
+
+    watchdog = Watchdog(threshold=10, on_duration=durations.append)
+    watched = watchdog.measure(callback)
+    thread = threading.Thread(target=watched, args=(None, None, _msg("slow")))
+    thread.start()
+    started.wait()
+    try:
+        assert watchdog.check() > 0
+    finally:
+        release.set()
+        thread.join()
+
+    assert len(durations) == 1
+    assert watchdog.check() == 0
+
+
+def test_watchdog__load_shedding(caplog):
+    """Over the threshold, the slowest topics are logged and the messages shed until recovery."""
+    backlog = [0]
+    processed = []
+    shed = []
+    states = []
+    watchdog = Watchdog(
+        threshold=1,
+        slow_topics=2,
+        shed_load=True,
+        backlog=lambda: backlog[0],
+        on_shed=lambda: shed.append(1),
+        on_check=lambda lag, shedding: states.append(shedding),
+    )
+    watched = watchdog.measure(lambda _client, _userdata, msg: processed.append(msg.topic))
+    for topic, duration in (("fast", 0.001), ("slow", 0.5), ("slower", 0.9), ("slow", 0.1)):
+        watchdog.record(topic, 100, duration)
+
+    # 400 bytes processed in 1.501 seconds: 10000 bytes waiting are a 37.5 seconds lag
+    backlog[0] = 10000
+    with caplog.at_level(logging.WARNING, logger="mqtt-exporter"):
+        assert watchdog.check() > 37
+    assert "slowest topics: slower (0.900s), slow (0.500s)" in caplog.text
+    assert "fast" not in caplog.text
+
+    watched(None, None, _msg("shed"))
+    assert not processed
+    assert shed == [1]
+
+    backlog[0] = 0
+    for _ in range(RECOVERY_CHECKS):
+        watchdog.check()
+    watched(None, None, _msg("processed"))
+
+    assert processed == ["processed"]
+    assert states == [True] * RECOVERY_CHECKS + [False]